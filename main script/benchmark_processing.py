@@ -0,0 +1,276 @@
+# Benchmarks of the processing chain on synthetic speckle.
+# precision: peak memory (tracemalloc) and displacement accuracy of the original mixed precision
+#            path (dtype=None) against float64 and float32 end to end.
+# modes:     correlation maps computed per window, failures, accuracy and time of the correlation
+#            modes and subpixel methods of correlate_windows ('gradient' refines on the M x M
+#            windows and computes no maps after the integer peak).
+# recording: pack/unpack throughput of the 12-bit recording format and write/read time against .npy.
+# replay:    end-to-end throughput of FramePipeline fed by a ReplayCamera (synthetic recording or
+#            --recording PATH), as fast as possible or at the recorded frame times (--realtime).
+# distributed: process_series throughput of processing.distributed with 1, 2, 4, ... local worker
+#            processes (up to --workers), against SpeckleProcessor.process_series on this machine.
+#
+# Run from "main script":  python benchmark_processing.py [--bench precision|modes|recording|replay|distributed|all] [--size 512] [--M 64]
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import processing.speckle as speckle
+from processing.speckle import average_frames, temporal_contrast, process_window
+from processing.synthetic import make_speckle, fourier_shift, to_counts
+from camera.recording import RecordingWriter, Recording, pack12, unpack12
+from camera.replay_camera import ReplayCamera
+from camera.telemetry import LoopTelemetry
+from processing.pipeline import FramePipeline
+from processing.speckle import SpeckleProcessor
+from processing.distributed import Coordinator, start_local_workers
+
+
+def peak_memory(fn, *args, **kwargs):
+    """Runs fn and returns (result, peak traced bytes, seconds)"""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    dt = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, dt
+
+def stack_stage(frames, dtype):
+    Iavg = average_frames(frames, 'mean', dtype=dtype)
+    K = temporal_contrast(frames, dtype=dtype)
+    return Iavg, K
+
+def window_stage(Iref, Iobj, centres, M, dtype, method='chebyshev'):
+    return np.array([process_window(Iref, Iobj, r, c, M, method=method, dtype=dtype)[0] for r, c in centres])
+
+def bench_precision(args):
+    rng = np.random.default_rng(args.seed)
+    H = W = args.size
+    M = args.M
+    shifts = [(0, 0), (3, -2), (1.5, 0.5), (-2.25, 4.75)]
+    base = make_speckle(H, W, rng=rng)
+    frames = np.stack([to_counts(base, rng) for _ in range(args.frames)])
+    objects = [to_counts(fourier_shift(base, dy, dx), rng) for dy, dx in shifts]
+    centres = [(r, c) for r in range(M, H - M, 2*M) for c in range(M, W - M, 2*M)]
+
+    print(f"stack {frames.shape} {frames.dtype}, {len(centres)} windows of {M}x{M}")
+    print(f"{'dtype':>8} {'stack peak MB':>14} {'stack s':>8} {'window peak MB':>15} {'window s':>9}"
+          f" {'|u-true| int':>13} {'|u-true| frac':>14}")
+
+    results = {}
+    for dtype in (None, np.float64, np.float32):
+        (Iavg, K), stack_peak, stack_t = peak_memory(stack_stage, frames, dtype)
+        errors = []
+        win_peak = win_t = 0
+        for (dy, dx), obj in zip(shifts, objects):
+            obj = obj.astype(Iavg.dtype)
+            u, peak, t = peak_memory(window_stage, Iavg, obj, centres, M, dtype)
+            win_peak = max(win_peak, peak)
+            win_t += t
+            errors.append(np.abs(u - (dy + 1j*dx)))
+            results[(np.dtype(dtype).name if dtype else 'None', dy, dx)] = u
+        whole = [e for (dy, dx), e in zip(shifts, errors) if dy == int(dy) and dx == int(dx)]
+        frac = [e for (dy, dx), e in zip(shifts, errors) if not (dy == int(dy) and dx == int(dx))]
+        name = np.dtype(dtype).name if dtype else 'None'
+        print(f"{name:>8} {stack_peak/2**20:14.1f} {stack_t:8.3f} {win_peak/2**20:15.2f} {win_t:9.3f}"
+              f" {np.median(np.concatenate(whole)):13.4f} {np.median(np.concatenate(frac)):14.4f}")
+
+    # float32 against float64 on identical input
+    diff = max(np.max(np.abs(results[('float32', dy, dx)] - results[('float64', dy, dx)])) for dy, dx in shifts)
+    print(f"max |u(float32) - u(float64)| = {diff:.2e} px")
+
+# (label, process_window keyword arguments) compared by bench_modes
+MODE_CONFIGS = [
+    ('zmcc chebyshev', dict(corr_mode='zmcc', method='chebyshev')),
+    ('zmcc quadratic', dict(corr_mode='zmcc', method='quadratic')),
+    ('zmcc gradient', dict(corr_mode='zmcc', method='gradient')),
+    ('zncc', dict(corr_mode='zncc', corr_opts={'min_overlap': 0.25})),
+    ('phase a=0.5', dict(corr_mode='phase', corr_opts={'alpha': 0.5})),
+    ('phase a=1', dict(corr_mode='phase', corr_opts={'alpha': 1.0})),
+    ('phase gradient', dict(corr_mode='phase', corr_opts={'alpha': 0.5}, method='gradient')),
+]
+
+def bench_modes(args):
+    rng = np.random.default_rng(args.seed)
+    H = W = args.size
+    M = args.M
+    base = make_speckle(H, W, rng=rng)
+    shifts = [tuple(rng.uniform(-M/8, M/8, 2)) for _ in range(args.shifts)]
+    objects = [fourier_shift(base, dy, dx) for dy, dx in shifts]
+    objects = [o + rng.normal(0, args.noise * base.mean(), o.shape) for o in objects]
+    centres = [(r, c) for r in range(M, H - M, M) for c in range(M, W - M, M)]
+
+    # count correlation maps per window by wrapping the dispatcher (single process)
+    calls = [0]
+    correlation_map = speckle.correlation_map
+    def counted(*a, **kw):
+        calls[0] += 1
+        return correlation_map(*a, **kw)
+    speckle.correlation_map = counted
+
+    print(f"{len(shifts)} random shifts up to {M/8:.0f} px, {len(centres)} windows of {M}x{M}, noise {args.noise}")
+    # 'all' includes windows flagged e=1: the original zmcc loop flags most fractional shifts as not
+    # converged but still returns its estimate
+    print(f"{'mode':>16} {'maps/window':>12} {'failed':>7} {'median err px':>14} {'p90 err px':>11}"
+          f" {'median err all':>15} {'ms/window':>10}")
+    try:
+        for label, kwargs in MODE_CONFIGS:
+            calls[0] = 0
+            n = failed = 0
+            errors = []
+            errors_all = []
+            t0 = time.perf_counter()
+            for (dy, dx), obj in zip(shifts, objects):
+                for r, c in centres:
+                    u, _, e = process_window(base, obj, r, c, M, **kwargs)[:3]
+                    n += 1
+                    failed += e
+                    errors_all.append(abs(u - (dy + 1j*dx)))
+                    if not e:
+                        errors.append(errors_all[-1])
+            dt = time.perf_counter() - t0
+            med = np.median(errors) if errors else np.nan
+            p90 = np.percentile(errors, 90) if errors else np.nan
+            print(f"{label:>16} {calls[0]/n:12.2f} {failed/n:7.1%} {med:14.4f} {p90:11.4f}"
+                  f" {np.median(errors_all):15.4f} {1e3*dt/n:10.2f}")
+    finally:
+        speckle.correlation_map = correlation_map
+
+def bench_recording(args):
+    rng = np.random.default_rng(args.seed)
+    H, W = args.sensor
+    n = args.frames
+    frames = np.stack([to_counts(make_speckle(H, W, rng=rng), rng) for _ in range(min(n, 4))])
+    frames = frames[np.arange(n) % len(frames)]  # repeat a few patterns to keep generation cheap
+    mb = frames.nbytes / 1e6
+    print(f"{n} frames of {H}x{W} uint16, {mb:.0f} MB")
+
+    # best of 3, the first call also pays for page faults of the new arrays
+    t_pack = t_unpack = np.inf
+    for _ in range(3):
+        t0 = time.perf_counter()
+        packed = pack12(frames)
+        t_pack = min(t_pack, time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        unpacked = unpack12(packed, frames.size)
+        t_unpack = min(t_unpack, time.perf_counter() - t0)
+    assert np.array_equal(unpacked, frames.reshape(-1))
+    print(f"pack {mb / t_pack:8.0f} MB/s   unpack {mb / t_unpack:8.0f} MB/s   (uint16 MB per second)")
+
+    with tempfile.TemporaryDirectory() as d:
+        rec_path = os.path.join(d, 'frames.s12')
+        npy_path = os.path.join(d, 'frames.npy')
+        t0 = time.perf_counter()
+        with RecordingWriter(rec_path, (H, W)) as w:
+            w.write_frames(frames)
+        t_rec = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        np.save(npy_path, frames)
+        t_npy = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for _ in Recording(rec_path).iter_chunks():
+            pass
+        t_rec_read = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        stack = np.load(npy_path, mmap_mode='r')
+        for k in range(0, n, 64):
+            np.array(stack[k:k + 64])
+        t_npy_read = time.perf_counter() - t0
+        print(f"{'format':>8} {'MB on disk':>11} {'write s':>8} {'read s':>8}")
+        print(f"{'.s12':>8} {os.path.getsize(rec_path) / 1e6:11.1f} {t_rec:8.2f} {t_rec_read:8.2f}")
+        print(f"{'.npy':>8} {os.path.getsize(npy_path) / 1e6:11.1f} {t_npy:8.2f} {t_npy_read:8.2f}")
+        print("(reads may come from the page cache, compare against the disk bandwidth of the recording machine)")
+
+def bench_replay(args):
+    with tempfile.TemporaryDirectory() as d:
+        path = args.recording
+        if path is None:
+            # synthetic session: object frames moving by 0.1 px per frame, recorded at 50 fps
+            rng = np.random.default_rng(args.seed)
+            base = make_speckle(args.size, args.size, rng=rng)
+            peak = base.max()
+            path = os.path.join(d, 'session.s12')
+            with RecordingWriter(path, base.shape) as w:
+                for k in range(args.frames):
+                    w.write(to_counts(fourier_shift(base, 0.1 * k, 0), rng, peak=peak), timestamp_ns=k * 20e6)
+        camera = ReplayCamera(path, realtime=args.realtime, loop=False)
+        camera.telemetry = LoopTelemetry()
+        camera.arm_for_trigger("software")
+        Iref = camera.trigger_capture()
+        n = len(camera.frames) - 1
+        proc = SpeckleProcessor(M=args.M, n_workers=4)
+        pipeline = FramePipeline(camera.trigger_capture, n, Iref, processor=proc)
+        t0 = time.perf_counter()
+        pipeline.run()
+        dt = time.perf_counter() - t0
+        camera.release()
+    mode = 'realtime' if args.realtime else 'as fast as possible'
+    print(f"replayed {n} frames of {Iref.shape[0]}x{Iref.shape[1]} ({mode}), M = {args.M}: "
+          f"{dt:.2f} s, {n / dt:.1f} frames/s end to end")
+    print(f"{'stage':>12} {'frames':>7} {'fps':>8} {'busy':>6} {'max queue':>10}")
+    for name, st in pipeline.report().items():
+        print(f"{name:>12} {st['frames']:7d} {st['fps']:8.1f} {st['busy']:6.0%} {st['max_queue_depth']:10d}")
+    for name, st in camera.telemetry.summary()['stages'].items():
+        print(f"{'camera ' + name:>16}: mean {st['mean_ms']:.2f} ms, p95 {st['p95_ms']:.2f} ms")
+
+def bench_distributed(args):
+    rng = np.random.default_rng(args.seed)
+    base = make_speckle(args.size, args.size, rng=rng)
+    peak = base.max()
+    ref = np.stack([to_counts(base, rng, peak=peak) for _ in range(4)])
+    obj = np.stack([to_counts(fourier_shift(base, 0.1 * k, -0.05 * k), rng, peak=peak) for k in range(args.frames)])
+    proc = SpeckleProcessor(M=args.M, n_workers=args.workers)
+    t0 = time.perf_counter()
+    proc.process_series(ref, obj)
+    t_local = time.perf_counter() - t0
+    nwin = len(proc.grid(args.size, args.size)[0]) * len(proc.grid(args.size, args.size)[1]) * args.frames
+    print(f"{args.frames} frames of {args.size}x{args.size}, M = {args.M}: {nwin} windows")
+    print(f"{'process_series':>20} {args.workers:3d} processes {t_local:7.2f} s {nwin / t_local:9.0f} windows/s")
+    with tempfile.TemporaryDirectory() as d:
+        np.save(os.path.join(d, 'ref.npy'), ref)
+        np.save(os.path.join(d, 'obj.npy'), obj)
+        n = 1
+        while n <= args.workers:
+            with Coordinator(proc, host='127.0.0.1', port=0, chunk_frames=16) as co:
+                start_local_workers(n, *co.address, authkey=co.authkey)
+                co.wait_for_workers(n)
+                t0 = time.perf_counter()
+                co.process_series(os.path.join(d, 'ref.npy'), os.path.join(d, 'obj.npy'))
+                dt = time.perf_counter() - t0
+            print(f"{'distributed':>20} {n:3d} workers   {dt:7.2f} s {nwin / dt:9.0f} windows/s")
+            n *= 2
+
+def main():
+    ap = argparse.ArgumentParser(description='Processing benchmarks on synthetic speckle')
+    ap.add_argument('--bench', choices=['precision', 'modes', 'recording', 'replay', 'distributed', 'all'], default='all')
+    ap.add_argument('--frames', type=int, default=64)
+    ap.add_argument('--size', type=int, default=512)
+    ap.add_argument('--M', type=int, default=64)
+    ap.add_argument('--shifts', type=int, default=4, help='modes: number of random shifts')
+    ap.add_argument('--noise', type=float, default=0.02, help='modes: noise std relative to the mean intensity')
+    ap.add_argument('--sensor', type=int, nargs=2, default=[2048, 2448], help='recording: frame height and width')
+    ap.add_argument('--recording', default=None, help='replay: recording to replay (default: synthetic)')
+    ap.add_argument('--realtime', action='store_true', help='replay: honour the recorded frame times')
+    ap.add_argument('--workers', type=int, default=4, help='distributed: largest number of local workers')
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+    if args.bench in ('precision', 'all'):
+        bench_precision(args)
+    if args.bench in ('modes', 'all'):
+        bench_modes(args)
+    if args.bench in ('recording', 'all'):
+        bench_recording(args)
+    if args.bench in ('replay', 'all'):
+        bench_replay(args)
+    if args.bench in ('distributed', 'all'):
+        bench_distributed(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Result container of a frame burst, shared by CameraHandler and ReplayCamera.
+
+import numpy as np
+
+class BurstResult:
+    """
+    Frames from capture_burst.
+    frames: (N, H, W) array (or np.memmap), slots without a frame are left as zeros
+    timestamps_ns: camera timestamp of each frame (nan if not received or not available)
+    host_times: time.perf_counter() when each frame was received (nan if not received)
+    frame_counts: SDK frame counter of each frame (-1 if not received)
+    missed: indices of triggers that did not produce a frame within the poll timeout (retrigger them)
+    dropped: indices of frames the sensor produced but the host never received, seen as gaps in the
+             frame counter (the frame buffer overflowed or was drained too slowly: enlarge it)
+    """
+    def __init__(self, frames, timestamps_ns, host_times, frame_counts, missed, dropped=None):
+        self.frames = frames
+        self.timestamps_ns = timestamps_ns
+        self.host_times = host_times
+        self.frame_counts = frame_counts
+        self.missed = missed
+        self.dropped = np.array([], dtype=np.intp) if dropped is None else dropped
+
+    @property
+    def n_received(self):
+        return len(self.frames) - len(self.missed) - len(self.dropped)
+
+    def received_frames(self):
+        """Frames that were actually captured, in trigger order"""
+        ok = np.ones(len(self.frames), dtype=bool)
+        ok[self.missed] = False
+        ok[self.dropped] = False
+        return [self.frames[k] for k in np.flatnonzero(ok)]
+
+def burst_buffer(n_frames, H, W, out=None, path=None):
+    """
+    Frame buffer of a burst: out if given (shape checked), else a new .npy memmap at path, else a
+    zeroed uint16 array in RAM.
+    """
+    if out is None:
+        if path is not None:
+            return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint16, shape=(n_frames, H, W))
+        return np.zeros((n_frames, H, W), dtype=np.uint16)
+    if out.shape != (n_frames, H, W):
+        raise ValueError(f"out has shape {out.shape}, expected {(n_frames, H, W)}")
+    return out
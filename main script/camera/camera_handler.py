@@ -3,10 +3,15 @@
 
 from thorlabs_tsi_sdk.tl_camera import TLCameraSDK, OPERATION_MODE
 import numpy as np
+import time
+
+from camera.burst import BurstResult, burst_buffer
 
 class CameraHandler:
     # Detects available cameras and defines settings
     def __init__(self):
+        self.exposure_us = 11000  # Exposure used whenever the camera is (re)armed
+        self.frame_rate = None  # Frame rate limit in fps, None for free running
         self.sdk = TLCameraSDK() # Creates a TLCameraSDK instance. Can only exist one at a time
         available_cameras = self.sdk.discover_available_cameras() # Checks for available camera connections
         if len(available_cameras) < 1:
@@ -15,11 +20,80 @@ class CameraHandler:
             self.sdk.dispose() # Disposes the TLCameraSDK instance if no connection is found
         else:
             self.camera = self.sdk.open_camera(available_cameras[0]) # Opens the first camera detected
-            self.camera.exposure_time_us = 11000  # Set exposure to 11 ms
+            self.camera.exposure_time_us = self.exposure_us  # Default exposure 11 ms
             self.camera.frames_per_trigger_zero_for_unlimited = 0  # Start camera in continuous mode
             self.camera.image_poll_timeout_ms = 1000  # 1 second polling timeout
             self.camera.arm(2) # Readies the camera with an image buffer of 2
             self.camera.issue_software_trigger()
+        self.trigger_mode = "continuous"
+        self.telemetry = None  # optional camera.telemetry.LoopTelemetry, filled by trigger_capture
+
+    # ---- Sensor settings ----
+    def _disarm_for_settings(self):
+        # ROI and binning can only be changed while disarmed, returns mode to re-arm with
+        if self.camera.is_armed:
+            self.camera.disarm()
+        return self.trigger_mode
+
+    def set_exposure(self, exposure_us):
+        """Exposure time in microseconds, kept when the camera is re-armed"""
+        self.exposure_us = int(exposure_us)
+        if self.camera is not None:
+            self.camera.exposure_time_us = self.exposure_us
+            self.exposure_us = self.camera.exposure_time_us  # value actually used by the sensor
+
+    def set_frame_rate(self, fps=None):
+        """Limits the frame rate (fps), None disables frame rate control"""
+        self.frame_rate = fps
+        if self.camera is None:
+            return
+        if fps is None:
+            self.camera.is_frame_rate_control_enabled = False
+        else:
+            self.camera.frame_rate_control_value = float(fps)
+            self.camera.is_frame_rate_control_enabled = True
+
+    def set_roi(self, roi=None):
+        """
+        Sensor ROI (x0, y0, x1, y1) in unbinned sensor pixels, lower-right corner inclusive.
+        None resets to the full sensor. The camera may round the ROI, read it back with geometry().
+        """
+        if self.camera is None:
+            return
+        mode = self._disarm_for_settings()
+        if roi is None:
+            roi = (0, 0, self.camera.sensor_width_pixels - 1, self.camera.sensor_height_pixels - 1)
+        self.camera.roi = tuple(int(v) for v in roi)
+        self.arm_for_trigger(mode)
+
+    def set_binning(self, binx=1, biny=None):
+        """Sensor binning factors (biny defaults to binx)"""
+        if self.camera is None:
+            return
+        if biny is None:
+            biny = binx
+        mode = self._disarm_for_settings()
+        self.camera.binx = int(binx)
+        self.camera.biny = int(biny)
+        self.arm_for_trigger(mode)
+
+    def geometry(self):
+        """Current sensor geometry as a dict(roi=(x0, y0, x1, y1), binx, biny), matches processing.geometry"""
+        if self.camera is None:
+            return None
+        roi = self.camera.roi
+        return dict(roi=tuple(int(v) for v in roi), binx=int(self.camera.binx), biny=int(self.camera.biny))
+
+    def bayer_pattern(self):
+        """Bayer layout of the sensor ('RGGB', 'BGGR', 'GRBG', 'GBRG'), None for monochrome sensors"""
+        if self.camera is None:
+            return None
+        # order of the SDK FILTER_ARRAY_PHASE enum: BAYER_RED, BAYER_BLUE, GREEN_LEFT_OF_RED, GREEN_LEFT_OF_BLUE
+        patterns = ['RGGB', 'BGGR', 'GRBG', 'GBRG']
+        try:
+            return patterns[int(self.camera.color_filter_array_phase)]
+        except Exception:
+            return None
 
     # Defines image data retrieval
     def get_frame(self):
@@ -34,7 +108,8 @@ class CameraHandler:
 
     # ---- Placeholder for SLM trigger ----
     # Sets operation mode of camera
-    def arm_for_trigger(self, mode="software"):
+    def arm_for_trigger(self, mode="software", frames_to_buffer=1):
+        """frames_to_buffer: image buffer size for triggered modes (e.g. size of a burst)"""
         if self.camera is None:
             return False
         
@@ -45,34 +120,37 @@ class CameraHandler:
         
         if mode == "continuous":
             self.camera.operation_mode = OPERATION_MODE.SOFTWARE_TRIGGERED
-            self.camera.exposure_time_us = 11000  # Set exposure to 11 ms
+            self.camera.exposure_time_us = self.exposure_us
             self.camera.frames_per_trigger_zero_for_unlimited = 0  # Start camera in continuous mode
             self.camera.image_poll_timeout_ms = 1000  # 1 second polling timeout
             self.camera.arm(2)
 
         elif mode == "software":
             self.camera.operation_mode = OPERATION_MODE.SOFTWARE_TRIGGERED
-            self.camera.exposure_time_us = 11000  # Set exposure to 11 ms
+            self.camera.exposure_time_us = self.exposure_us
             self.camera.frames_per_trigger_zero_for_unlimited = 1  # Start camera with 1 frame per trigger
             self.camera.image_poll_timeout_ms = 1000  # 1 second polling timeout
-            self.camera.arm(1)
+            self.camera.arm(frames_to_buffer)
 
         elif mode == "hardware":
             self.camera.operation_mode = OPERATION_MODE.HARDWARE_TRIGGERED
-            self.camera.exposure_time_us = 11000  # Set exposure to 11 ms
+            self.camera.exposure_time_us = self.exposure_us
             self.camera.frames_per_trigger_zero_for_unlimited = 1  # Start camera with 1 frame per trigger
             self.camera.image_poll_timeout_ms = 1000  # 1 second polling timeout
-            self.camera.arm(1)
+            self.camera.arm(frames_to_buffer)
 
         else:
             raise ValueError(f"Unknown trigger mode: {mode}")
         
+        self.trigger_mode = mode
         return True
     
     def trigger_capture(self):
         """For software-triggered acquisition"""
         if self.camera is None:
             return None
+        if self.telemetry is not None:
+            return self._trigger_capture_timed(self.telemetry)
         self.camera.issue_software_trigger()
         frame = self.camera.get_pending_frame_or_null()
         if frame is not None:
@@ -89,6 +167,92 @@ class CameraHandler:
     
 
         return None
+
+    def _trigger_capture_timed(self, telemetry):
+        # trigger_capture with the trigger, SDK poll and buffer copy timed separately
+        with telemetry.stage('trigger'):
+            self.camera.issue_software_trigger()
+        with telemetry.stage('sdk_poll'):
+            frame = self.camera.get_pending_frame_or_null()
+        if frame is None:
+            telemetry.null()
+            return None
+        telemetry.frame(getattr(frame, 'frame_count', None))
+        with telemetry.stage('copy'):
+            image_copy = np.copy(frame.image_buffer)
+        return image_copy
+
+    def capture_burst(self, n_frames, mode="software", out=None, path=None, before_trigger=None):
+        """
+        Captures n_frames frames, one frame per software or hardware trigger.
+        The camera is armed with a buffer of n_frames so no trigger is lost while frames are drained.
+        out: optional preallocated (n_frames, H, W) uint16 array or np.memmap to write into
+        path: if out is None, frames are written to a .npy file on disk (memmapped) instead of RAM
+        before_trigger: optional callable(k), called before software trigger k (e.g. to set the SLM pattern)
+        Returns BurstResult, or None if no camera is connected.
+        In hardware mode the burst ends early if no trigger arrives within the poll timeout, the remaining
+        triggers are missed. Frame counter gaps before that are frames the host dropped (BurstResult.dropped).
+        """
+        if self.camera is None:
+            return None
+        if mode not in ("software", "hardware"):
+            raise ValueError(f"Burst mode must be 'software' or 'hardware', got {mode}")
+        previous_mode = self.trigger_mode
+
+        self.arm_for_trigger(mode, frames_to_buffer=n_frames)
+        H = self.camera.image_height_pixels
+        W = self.camera.image_width_pixels
+        out = burst_buffer(n_frames, H, W, out, path)
+
+        timestamps_ns = np.full(n_frames, np.nan)
+        host_times = np.full(n_frames, np.nan)
+        frame_counts = np.full(n_frames, -1, dtype=np.int64)
+        first_count = None
+
+        def store(k, frame):
+            out[k] = frame.image_buffer.reshape(H, W)  # single copy straight from the SDK buffer
+            host_times[k] = time.perf_counter()
+            frame_counts[k] = frame.frame_count
+            ts = getattr(frame, "time_stamp_relative_ns_or_null", None)
+            if ts is not None:
+                timestamps_ns[k] = ts
+
+        try:
+            if mode == "software":
+                for k in range(n_frames):
+                    if before_trigger is not None:
+                        before_trigger(k)
+                    self.camera.issue_software_trigger()
+                    frame = self.camera.get_pending_frame_or_null()
+                    if frame is not None:
+                        store(k, frame)
+            else:
+                k = 0
+                while k < n_frames:
+                    frame = self.camera.get_pending_frame_or_null()
+                    if frame is None:
+                        break  # no trigger within poll timeout, treat remaining as missed
+                    if first_count is None:
+                        first_count = frame.frame_count
+                    # frame counter gaps are frames the sensor produced but the host did not receive
+                    k = frame.frame_count - first_count
+                    if k >= n_frames:
+                        break
+                    store(k, frame)
+                    k += 1
+        finally:
+            # restore previous operation mode
+            if previous_mode is not None:
+                self.arm_for_trigger(previous_mode)
+
+        empty = frame_counts < 0
+        # empty slots before the last received frame are counter gaps, the ones after it missed triggers
+        n_gaps = 0
+        if mode == "hardware" and not empty.all():
+            n_gaps = int(np.flatnonzero(~empty)[-1])
+        dropped = np.flatnonzero(empty[:n_gaps])
+        missed = n_gaps + np.flatnonzero(empty[n_gaps:])
+        return BurstResult(out, timestamps_ns, host_times, frame_counts, missed, dropped)
     # ------------------------------------
 
     # Disarms the camera and disposes TLCameraSDK instance
@@ -0,0 +1,296 @@
+# Recording format for 12-bit camera frames, two pixels packed into 3 bytes (25 % smaller than uint16).
+#
+# File layout (little endian):
+#   magic b'SPK12REC' | uint32 header length | JSON header (H, W, chunk_frames, metadata)
+#   chunks of up to chunk_frames packed frames, each frame ceil(H*W/2)*3 bytes
+#   index: int64 chunk offsets, int64 frames per chunk, then per frame float64 timestamps_ns,
+#          float64 host_times and int64 frame_counts
+#   trailer: uint64 index offset | uint64 number of chunks | uint64 number of frames | magic b'SPK12IDX'
+# The index is written on close, a file without trailer is an unfinished recording and is rejected.
+#
+# Recording is read through a memmap and behaves like a read-only (N, H, W) uint16 stack: len(),
+# rec[k], rec[a:b] and rec[:, r0:r1, c0:c1] unpack only the frames (and rows) asked for, so it can be
+# passed to average_frames, temporal_contrast (with a dtype) or SpeckleProcessor.process_series
+# without unpacking the whole recording.
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'SPK12REC'
+INDEX_MAGIC = b'SPK12IDX'
+MAX_VALUE = 4095
+_TRAILER = struct.Struct('<QQQ8s')
+_BLOCK = 1 << 18  # pixel pairs per block, keeps the pack/unpack temporaries in cache
+
+def packed_size(n_pixels):
+    """Bytes of n_pixels packed pixels (odd counts are padded by one pixel)"""
+    return (n_pixels + 1) // 2 * 3
+
+def pack12(frames, out=None):
+    """
+    Packs 12-bit values (any uint16 array) into bytes, pixel pairs (a, b) become
+    a[0:8], a[8:12] | b[0:4] << 4, b[4:12]. Returns a 1D uint8 array of packed_size(frames.size).
+    Values above 4095 are not checked here (see RecordingWriter).
+    """
+    x = np.ascontiguousarray(frames, dtype=np.uint16).reshape(-1)
+    if x.size % 2:
+        x = np.append(x, np.uint16(0))
+    x = x.reshape(-1, 2)
+    n = len(x)
+    if out is None:
+        out = np.empty(n * 3, dtype=np.uint8)
+    packed = out.reshape(n, 3)
+    v = np.empty(min(n, _BLOCK), dtype=np.uint32)
+    for s in range(0, n, _BLOCK):
+        e = min(n, s + _BLOCK)
+        vv = v[:e - s]
+        # 24-bit word b << 12 | a, written as its 3 low bytes
+        np.left_shift(x[s:e, 1], 12, out=vv, dtype=np.uint32)
+        np.bitwise_or(vv, x[s:e, 0], out=vv)
+        packed[s:e] = vv.view(np.uint8).reshape(-1, 4)[:, :3]
+    return out
+
+def unpack12(packed, n_pixels, out=None):
+    """Inverse of pack12, returns a 1D uint16 array of n_pixels values (or writes into out)"""
+    p = np.asarray(packed, dtype=np.uint8).reshape(-1, 3)
+    n = len(p)
+    if out is None or n_pixels % 2:
+        pairs = np.empty((n, 2), dtype=np.uint16)
+    else:
+        pairs = out.reshape(n, 2)
+    w = np.zeros((min(n, _BLOCK), 4), dtype=np.uint8)
+    v = w.view('<u4').reshape(-1)
+    for s in range(0, n, _BLOCK):
+        e = min(n, s + _BLOCK)
+        w[:e - s, :3] = p[s:e]
+        np.bitwise_and(v[:e - s], 0xFFF, out=pairs[s:e, 0], casting='unsafe')
+        np.right_shift(v[:e - s], 12, out=pairs[s:e, 1], casting='unsafe')
+    if out is None:
+        return pairs.reshape(-1)[:n_pixels]
+    if n_pixels % 2:
+        out.reshape(-1)[:] = pairs.reshape(-1)[:n_pixels]
+    return out
+
+class RecordingWriter:
+    """
+    Writes frames to a packed 12-bit recording.
+    shape: (H, W) of the frames
+    chunk_frames: frames packed and written together, also the unit of the chunk index
+    metadata: optional dict stored in the header (exposure, geometry, bayer pattern, ...)
+    Use as a context manager or call close(), the index is only written on close.
+    """
+    def __init__(self, path, shape, chunk_frames=64, metadata=None):
+        self.path = path
+        self.shape = tuple(int(v) for v in shape)
+        self.chunk_frames = int(chunk_frames)
+        self.frame_bytes = packed_size(self.shape[0] * self.shape[1])
+        self._f = open(path, 'wb')
+        header = json.dumps({'version': 1, 'height': self.shape[0], 'width': self.shape[1], 'bits': 12,
+                             'chunk_frames': self.chunk_frames, 'metadata': metadata or {}}).encode()
+        self._f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self._buf = np.empty((self.chunk_frames,) + self.shape, dtype=np.uint16)
+        self._packed = np.empty(self.chunk_frames * self.frame_bytes, dtype=np.uint8)
+        self._n_buf = 0
+        self.chunk_offsets = []
+        self.chunk_sizes = []
+        self.timestamps_ns = []
+        self.host_times = []
+        self.frame_counts = []
+
+    def __len__(self):
+        return len(self.frame_counts)
+
+    def write(self, frame, timestamp_ns=np.nan, host_time=np.nan, frame_count=-1):
+        """Appends one (H, W) frame with its camera timestamp, host receive time and SDK frame counter"""
+        frame = np.asarray(frame)
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame has shape {frame.shape}, recording is {self.shape}")
+        if frame.max(initial=0) > MAX_VALUE:
+            raise ValueError("Frame has values above 12 bits")
+        self._buf[self._n_buf] = frame
+        self._n_buf += 1
+        self.timestamps_ns.append(timestamp_ns)
+        self.host_times.append(host_time)
+        self.frame_counts.append(frame_count)
+        if self._n_buf == self.chunk_frames:
+            self._flush()
+
+    def write_frames(self, frames, timestamps_ns=None, host_times=None, frame_counts=None):
+        """Appends a stack or list of frames, per frame metadata arrays are optional"""
+        for k in range(len(frames)):
+            self.write(frames[k],
+                       np.nan if timestamps_ns is None else timestamps_ns[k],
+                       np.nan if host_times is None else host_times[k],
+                       -1 if frame_counts is None else frame_counts[k])
+
+    def write_burst(self, result):
+        """Appends the received frames of a camera.burst.BurstResult with their timestamps"""
+        for k in range(len(result.frames)):
+            if result.frame_counts[k] >= 0:
+                self.write(result.frames[k], result.timestamps_ns[k], result.host_times[k], result.frame_counts[k])
+
+    def _flush(self):
+        if self._n_buf == 0:
+            return
+        n = self._n_buf
+        packed = self._packed[:n * self.frame_bytes]
+        for k in range(n):
+            pack12(self._buf[k], out=packed[k * self.frame_bytes:(k + 1) * self.frame_bytes])
+        self.chunk_offsets.append(self._f.tell())
+        self.chunk_sizes.append(n)
+        self._f.write(packed.data)
+        self._n_buf = 0
+
+    def close(self):
+        if self._f is None:
+            return
+        self._flush()
+        index_offset = self._f.tell()
+        for arr in (np.asarray(self.chunk_offsets, dtype='<i8'), np.asarray(self.chunk_sizes, dtype='<i8'),
+                    np.asarray(self.timestamps_ns, dtype='<f8'), np.asarray(self.host_times, dtype='<f8'),
+                    np.asarray(self.frame_counts, dtype='<i8')):
+            self._f.write(arr.tobytes())
+        self._f.write(_TRAILER.pack(index_offset, len(self.chunk_offsets), len(self), INDEX_MAGIC))
+        self._f.close()
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Recording:
+    """
+    Read-only packed 12-bit recording, indexable like an (N, H, W) uint16 array.
+    Attributes: shape, dtype, metadata, timestamps_ns, host_times, frame_counts (per frame),
+    chunk_offsets, chunk_sizes (chunk index).
+    np.asarray(recording) unpacks everything, use iter_chunks or slices for long recordings.
+    """
+    dtype = np.dtype(np.uint16)
+    ndim = 3
+
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a packed 12-bit recording")
+            (n_header,) = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(n_header))
+            if size < len(MAGIC) + 4 + n_header + _TRAILER.size:
+                raise ValueError(f"{path} has no index (recording not closed)")
+            f.seek(size - _TRAILER.size)
+            index_offset, n_chunks, n_frames, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{path} has no index (recording not closed)")
+            f.seek(index_offset)
+            index = f.read(size - _TRAILER.size - index_offset)
+        self.header = header
+        self.metadata = header.get('metadata', {})
+        self.chunk_frames = header['chunk_frames']
+        H, W = header['height'], header['width']
+        self.shape = (int(n_frames), H, W)
+        self.frame_bytes = packed_size(H * W)
+        counts = [n_chunks, n_chunks, n_frames, n_frames, n_frames]
+        arrays = []
+        pos = 0
+        for n, dt in zip(counts, ('<i8', '<i8', '<f8', '<f8', '<i8')):
+            arrays.append(np.frombuffer(index, dtype=dt, count=n, offset=pos))
+            pos += 8 * n
+        self.chunk_offsets, self.chunk_sizes, self.timestamps_ns, self.host_times, self.frame_counts = arrays
+        # first frame of every chunk, for frame -> chunk lookups
+        self._chunk_starts = np.concatenate([[0], np.cumsum(self.chunk_sizes)])
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if n_frames else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def n_chunks(self):
+        return len(self.chunk_offsets)
+
+    def frame_offset(self, k):
+        """Byte offset of frame k in the file"""
+        c = int(np.searchsorted(self._chunk_starts, k, side='right')) - 1
+        return int(self.chunk_offsets[c]) + (k - int(self._chunk_starts[c])) * self.frame_bytes
+
+    def read(self, start, stop, rows=None, out=None):
+        """
+        Frames start..stop-1 as an (n, H, W) uint16 array.
+        rows: optional (r0, r1), only these rows are unpacked (and read) when W is even
+        """
+        N, H, W = self.shape
+        r0, r1 = (0, H) if rows is None else rows
+        if W % 2 and (r0, r1) != (0, H):
+            # rows do not start on a pixel pair, unpack whole frames
+            block = self.read(start, stop)[:, r0:r1]
+            if out is None:
+                return block
+            out[...] = block
+            return out
+        n_pix = (r1 - r0) * W
+        if out is None:
+            out = np.empty((max(0, stop - start), r1 - r0, W), dtype=np.uint16)
+        b0 = r0 * W // 2 * 3
+        nbytes = packed_size(n_pix)
+        for j, k in enumerate(range(start, stop)):
+            off = self.frame_offset(k) + b0
+            unpack12(self._data[off:off + nbytes], n_pix, out=out[j])
+        return out
+
+    def frame(self, k):
+        """Frame k as an (H, W) uint16 array"""
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"Frame {k} out of range for {len(self)} frames")
+        return self.read(k, k + 1)[0]
+
+    def iter_chunks(self, chunk=None):
+        """Yields (n, H, W) blocks of at most chunk frames (default: the stored chunks)"""
+        chunk = self.chunk_frames if chunk is None else chunk
+        for k in range(0, len(self), chunk):
+            yield self.read(k, min(len(self), k + chunk))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if key and key[0] is Ellipsis:
+            key = (slice(None),) * (self.ndim - len(key) + 1) + key[1:]
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            return self.frame(int(first))[rest] if rest else self.frame(int(first))
+        if not isinstance(first, slice):
+            return np.stack([self.frame(int(k)) for k in np.arange(len(self))[first]])[(slice(None),) + rest]
+        start, stop, step = first.indices(len(self))
+        rows = None
+        if rest and isinstance(rest[0], slice) and rest[0].step in (None, 1):
+            r0, r1, _ = rest[0].indices(self.shape[1])
+            rows = (r0, max(r0, r1))
+            rest = (slice(None),) + rest[1:]
+        if step == 1:
+            block = self.read(start, stop, rows)
+        else:
+            ks = range(start, stop, step)
+            r0, r1 = (0, self.shape[1]) if rows is None else rows
+            block = np.empty((len(ks), r1 - r0, self.shape[2]), dtype=np.uint16)
+            for j, k in enumerate(ks):
+                self.read(k, k + 1, rows, out=block[j:j + 1])
+        return block[(slice(None),) + rest] if rest else block
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.read(0, len(self))
+        return arr if dtype is None else arr.astype(dtype)
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
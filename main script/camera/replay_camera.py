@@ -0,0 +1,245 @@
+# Camera backend that replays a recorded frame stack through the same interface as CameraHandler,
+# so the live view, captures, the frame pipeline and processing can be run and timed without a camera
+# (and without the Thorlabs SDK). Frames come from a packed recording (camera.recording), a .npy file
+# (memmapped) or an array in memory.
+#
+# realtime replay delivers frames at their recorded times: in continuous mode a poll returns the
+# newest due frame (older frames beyond the buffer are dropped like on the sensor, visible as frame
+# counter gaps in the telemetry), in triggered modes a trigger waits until the next frame is due.
+# Fast replay ("as fast as possible") delivers the next frame on every poll or trigger.
+
+import os
+import time
+
+import numpy as np
+
+from camera.burst import BurstResult, burst_buffer
+from camera.recording import Recording
+
+def open_frames(source):
+    """(N, H, W) stack of a .s12 recording path, a .npy path (memmapped), a Recording or an array"""
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        return Recording(source)
+    return source
+
+def frame_times(frames, fps):
+    """
+    Recorded time of every frame in seconds from the first: camera timestamps if all are known,
+    else host receive times, else a fixed interval of 1 / fps.
+    """
+    for name, scale in (('timestamps_ns', 1e-9), ('host_times', 1.0)):
+        t = getattr(frames, name, None)
+        if t is not None and len(t) == len(frames) and np.all(np.isfinite(t)) and np.all(np.diff(t) > 0):
+            return (np.asarray(t, dtype=np.float64) - t[0]) * scale
+    return np.arange(len(frames)) / fps
+
+class ReplayCamera:
+    """
+    Replays a recorded stack with the CameraHandler interface (get_frame, trigger_capture,
+    arm_for_trigger, capture_burst, settings, release).
+    source: see open_frames
+    realtime: True replays at the recorded frame times, False as fast as possible
+    speed: time scale of realtime replay (2 = twice as fast)
+    loop: start over at the end of the recording (frame counters keep increasing), otherwise
+          the camera returns no frames once the recording is exhausted
+    fps: frame rate used when the recording has no timestamps (default from the exposure)
+    buffer_frames: frames the simulated camera buffers in continuous mode before dropping the oldest
+    clock/sleep: time source, can be replaced for deterministic tests
+    """
+    def __init__(self, source, realtime=True, speed=1.0, loop=True, fps=None, buffer_frames=2,
+                 clock=time.perf_counter, sleep=time.sleep):
+        self.frames = open_frames(source)
+        if len(self.frames) == 0:
+            raise ValueError("Recording has no frames")
+        metadata = getattr(self.frames, 'metadata', {}) or {}
+        self.metadata = metadata
+        self.exposure_us = int(metadata.get('exposure_us', 11000))
+        self.frame_rate = None  # frame rate limit in fps, None for the recorded rate
+        self.realtime = realtime
+        self.speed = float(speed)
+        self.loop = loop
+        self.buffer_frames = max(1, int(buffer_frames))
+        self.clock = clock
+        self.sleep = sleep
+        self.recorded_times = frame_times(self.frames, fps or metadata.get('frame_rate') or 1e6 / self.exposure_us)
+        self.telemetry = None  # optional camera.telemetry.LoopTelemetry, filled by trigger_capture
+        self.camera = self.frames  # not None while "connected", like CameraHandler.camera
+        self.trigger_mode = "continuous"
+        self._schedule()
+        self.rewind()
+
+    # ---- replay clock ----
+    def _schedule(self):
+        # replay times (s from the first frame) with the frame rate limit and speed applied,
+        # period: duration of one pass including the interval back to the first frame
+        intervals = np.diff(self.recorded_times)
+        last = np.median(intervals) if len(intervals) else 1e6 / self.exposure_us * 1e-6
+        intervals = np.append(intervals, last)
+        if self.frame_rate:
+            intervals = np.maximum(intervals, 1.0 / self.frame_rate)
+        intervals = intervals / self.speed
+        self.times = np.concatenate([[0.0], np.cumsum(intervals[:-1])])
+        self.period = float(np.sum(intervals))
+
+    def _due(self, n):
+        """Replay time of absolute frame number n"""
+        N = len(self.frames)
+        return self._t0 + (n // N) * self.period + self.times[n % N]
+
+    def _last_due(self, now):
+        """Absolute number of the newest frame due at time now (-1 if none yet)"""
+        N = len(self.frames)
+        elapsed = now - self._t0
+        cycle = int(elapsed // self.period)
+        n = cycle * N + int(np.searchsorted(self.times, elapsed - cycle * self.period, side='right')) - 1
+        return n if self.loop else min(n, N - 1)
+
+    def _restart_clock(self):
+        # the next frame is due now, later frames follow at their replay intervals
+        self._t0 = self.clock() - (self._due(self._next) - self._t0)
+        self._last_time = None
+
+    def _exhausted(self):
+        return not self.loop and self._next >= len(self.frames)
+
+    def _read(self, n):
+        return np.array(self.frames[n % len(self.frames)])  # copy, like the SDK buffer copy
+
+    def _poll(self):
+        # continuous mode: number of the frame a free running camera has pending now, or None
+        if self._exhausted():
+            return None
+        if self.realtime:
+            due = self._last_due(self.clock())
+            if due < self._next:
+                return None
+            # the camera buffer only holds the newest buffer_frames frames
+            self._next = max(self._next, due - self.buffer_frames + 1)
+        n = self._next
+        self._next += 1
+        return n
+
+    def _triggered(self):
+        # triggered modes: a trigger delivers the next frame, not before its recorded interval has passed
+        if self._exhausted():
+            return None
+        n = self._next
+        if self.realtime and self._last_time is not None and n > 0:
+            wait = self._last_time + self._due(n) - self._due(n - 1) - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+        self._last_time = self.clock()
+        self._next += 1
+        return n
+
+    def _take(self):
+        return self._poll() if self.trigger_mode == "continuous" else self._triggered()
+
+    # ---- Sensor settings ----
+    def set_exposure(self, exposure_us):
+        """Stored for the interface only, the recorded frames keep their exposure"""
+        self.exposure_us = int(exposure_us)
+
+    def set_frame_rate(self, fps=None):
+        """Limits the replay frame rate (fps), None replays at the recorded rate"""
+        self.frame_rate = fps
+        self._schedule()
+        self._restart_clock()
+
+    def set_roi(self, roi=None):
+        """The recorded geometry is fixed, accepted for the interface only"""
+
+    def set_binning(self, binx=1, biny=None):
+        """The recorded geometry is fixed, accepted for the interface only"""
+
+    def geometry(self):
+        """Recorded sensor geometry (from the metadata), else the full frame unbinned"""
+        if self.camera is None:
+            return None
+        geometry = self.metadata.get('geometry')
+        if geometry is not None:
+            return dict(roi=tuple(int(v) for v in geometry['roi']), binx=int(geometry['binx']),
+                        biny=int(geometry['biny']))
+        H, W = self.frames.shape[1:]
+        return dict(roi=(0, 0, W - 1, H - 1), binx=1, biny=1)
+
+    def bayer_pattern(self):
+        if self.camera is None:
+            return None
+        return self.metadata.get('bayer_pattern')
+
+    # ---- Acquisition ----
+    def get_frame(self):
+        if self.camera is None:
+            return None
+        n = self._take()
+        return None if n is None else self._read(n)
+
+    def arm_for_trigger(self, mode="software", frames_to_buffer=1):
+        """Restarts the replay clock in the given mode, the position in the recording is kept"""
+        if self.camera is None:
+            return False
+        if mode not in ("continuous", "software", "hardware"):
+            raise ValueError(f"Unknown trigger mode: {mode}")
+        self._restart_clock()
+        self.trigger_mode = mode
+        return True
+
+    def trigger_capture(self):
+        if self.camera is None:
+            return None
+        if self.telemetry is None:
+            return self.get_frame()
+        telemetry = self.telemetry
+        with telemetry.stage('sdk_poll'):
+            n = self._take()
+        if n is None:
+            telemetry.null()
+            return None
+        telemetry.frame(n)
+        with telemetry.stage('copy'):
+            return self._read(n)
+
+    def capture_burst(self, n_frames, mode="software", out=None, path=None, before_trigger=None):
+        """Like CameraHandler.capture_burst, frames past the end of a non-looping recording are missed"""
+        if self.camera is None:
+            return None
+        if mode not in ("software", "hardware"):
+            raise ValueError(f"Burst mode must be 'software' or 'hardware', got {mode}")
+        previous_mode = self.trigger_mode
+        self.arm_for_trigger(mode, frames_to_buffer=n_frames)
+        H, W = self.frames.shape[1:]
+        out = burst_buffer(n_frames, H, W, out, path)
+        timestamps_ns = np.full(n_frames, np.nan)
+        host_times = np.full(n_frames, np.nan)
+        frame_counts = np.full(n_frames, -1, dtype=np.int64)
+        recorded_ns = getattr(self.frames, 'timestamps_ns', None)
+        try:
+            for k in range(n_frames):
+                if mode == "software" and before_trigger is not None:
+                    before_trigger(k)
+                n = self._triggered()
+                if n is None:
+                    break
+                out[k] = self._read(n)
+                host_times[k] = self.clock()
+                frame_counts[k] = n
+                if recorded_ns is not None:
+                    timestamps_ns[k] = recorded_ns[n % len(self.frames)]
+        finally:
+            self.arm_for_trigger(previous_mode)
+        missed = np.flatnonzero(frame_counts < 0)
+        return BurstResult(out, timestamps_ns, host_times, frame_counts, missed)
+
+    def rewind(self):
+        """Starts the replay over from the first frame"""
+        self._next = 0
+        self._t0 = self.clock()
+        self._last_time = None
+
+    def release(self):
+        if isinstance(self.frames, Recording):
+            self.frames.close()
+        self.camera = None
@@ -0,0 +1,160 @@
+# Timing and frame counters for the acquisition / live view loop.
+# CameraHandler records SDK poll and buffer copy times, MainWindow records the conversion and
+# display stages. Shown in the Diagnostics tab and exported as JSON for offline analysis.
+
+from collections import deque
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+import numpy as np
+
+class LatencyHistogram:
+    """
+    Histogram of durations with log-spaced bins between lo_s and hi_s seconds (values outside go
+    into the first/last bin). Keeps count, sum, min and max exactly, percentiles come from the bins.
+    """
+    def __init__(self, lo_s=1e-5, hi_s=1.0, n_bins=50):
+        self.edges = np.geomspace(lo_s, hi_s, n_bins + 1)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        k = int(np.searchsorted(self.edges, seconds, side='right')) - 1
+        self.counts[min(max(k, 0), len(self.counts) - 1)] += 1
+        self.n += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Upper edge of the bin holding the p-th percentile (0-100), nan if empty"""
+        if self.n == 0:
+            return float('nan')
+        k = int(np.searchsorted(np.cumsum(self.counts), p / 100 * self.n))
+        return float(min(self.edges[min(k, len(self.counts) - 1) + 1], self.max))
+
+    def summary(self):
+        return {
+            'n': self.n,
+            'mean_ms': 1e3 * self.total / self.n if self.n else float('nan'),
+            'p50_ms': 1e3 * self.percentile(50),
+            'p95_ms': 1e3 * self.percentile(95),
+            'p99_ms': 1e3 * self.percentile(99),
+            'max_ms': 1e3 * self.max if self.n else float('nan'),
+        }
+
+class LoopTelemetry:
+    """
+    Per-stage latency histograms and frame counters of a periodic acquisition loop.
+    target_fps: rate the loop is driven at (e.g. 1000 / QTimer interval)
+    keep_samples: number of recent (time, stage, seconds) samples kept for export
+    Usage per loop iteration: tick(), then stage(name) blocks or record(name, seconds),
+    frame(frame_count) for every SDK frame and null() for every empty poll.
+    Thread safe, so pipeline threads can record into the same instance.
+    """
+    def __init__(self, target_fps=None, keep_samples=10000):
+        self.target_fps = target_fps
+        self.keep_samples = keep_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.t0 = time.perf_counter()
+            self.histograms = {}  # stage name -> LatencyHistogram, in order of first use
+            self.samples = deque(maxlen=self.keep_samples)
+            self.ticks = 0
+            self._last_tick = None
+            self.frames = 0  # frames delivered by the SDK
+            self.null_frames = 0  # polls where get_pending_frame_or_null returned None
+            self.skipped_frames = 0  # gaps in the SDK frame counter (frames never seen by the loop)
+            self.first_frame_count = None
+            self.last_frame_count = None
+
+    def record(self, name, seconds):
+        now = time.perf_counter()
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = LatencyHistogram()
+            hist.add(seconds)
+            self.samples.append((now - self.t0, name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as stage name"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def tick(self):
+        """Marks the start of a loop iteration, the interval between ticks is recorded as 'interval'"""
+        now = time.perf_counter()
+        last = self._last_tick
+        self._last_tick = now
+        self.ticks += 1
+        if last is not None:
+            self.record('interval', now - last)
+
+    def frame(self, frame_count=None):
+        """A frame was received, frame_count: SDK frame counter (Frame.frame_count) if available"""
+        with self._lock:
+            self.frames += 1
+            if frame_count is None:
+                return
+            if self.first_frame_count is None:
+                self.first_frame_count = frame_count
+            elif self.last_frame_count is not None and frame_count > self.last_frame_count + 1:
+                self.skipped_frames += frame_count - self.last_frame_count - 1
+            self.last_frame_count = frame_count
+
+    def null(self):
+        with self._lock:
+            self.null_frames += 1
+
+    def achieved_fps(self):
+        """Loop iterations per second since reset"""
+        wall = (self._last_tick or self.t0) - self.t0
+        return self.ticks / wall if wall > 0 else 0.0
+
+    def frame_fps(self):
+        """Received frames per second since reset"""
+        wall = time.perf_counter() - self.t0
+        return self.frames / wall if wall > 0 else 0.0
+
+    def summary(self):
+        with self._lock:
+            stages = {name: hist.summary() for name, hist in self.histograms.items()}
+        return {
+            'elapsed_s': time.perf_counter() - self.t0,
+            'target_fps': self.target_fps,
+            'loop_fps': self.achieved_fps(),
+            'frame_fps': self.frame_fps(),
+            'ticks': self.ticks,
+            'frames': self.frames,
+            'null_frames': self.null_frames,
+            'skipped_frames': self.skipped_frames,
+            'first_frame_count': self.first_frame_count,
+            'last_frame_count': self.last_frame_count,
+            'stages': stages,
+        }
+
+    def export(self, path):
+        """Writes summary, histogram bins and the recent samples to a JSON file"""
+        with self._lock:
+            histograms = {name: {'edges_s': hist.edges.tolist(), 'counts': hist.counts.tolist()}
+                          for name, hist in self.histograms.items()}
+            samples = [list(s) for s in self.samples]
+        data = self.summary()
+        data['histograms'] = histograms
+        data['samples'] = {'columns': ['t_s', 'stage', 'seconds'], 'rows': samples}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+        return path
@@ -0,0 +1,140 @@
+# Reprocessing of recorded datasets on several machines (see processing.distributed).
+# Start workers on every machine that can read the data under the same paths, then the coordinator:
+#
+#   python distributed_reprocess.py worker COORDINATOR_HOST --authkey-file KEY [--port 5555] [--processes 8]
+#   python distributed_reprocess.py run REF OBJ [OBJ ...] --host 0.0.0.0 --authkey-file KEY [--port 5555]
+#                                   [--local-workers 4] [--series --k 1]
+#
+# Workers must prove they know the coordinator's key: KEY is a file with a shared secret (e.g. from
+# python -c "import secrets; print(secrets.token_hex(32))") readable only by the lab account, or set
+# SPECKLE_AUTHKEY. Without a key, run makes a random one and only --local-workers can connect. The
+# coordinator listens on 127.0.0.1 unless --host is given.
+# REF / OBJ are .s12 recordings or .npy stacks, PATH:START:STOP selects a frame range of one.
+# run writes <out-dir>/<name>_field.npz (u, c, e, sc, rows, cols) per object dataset, or with --series
+# <name>_u.npy, _c.npy and _e.npy (N//k, nrows, ncols), filled as the results arrive.
+#
+# Run from "main script".
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from processing.distributed import DEFAULT_PORT, Coordinator, run_worker, start_local_workers, source_shape
+from processing.speckle import SpeckleProcessor
+
+
+def parse_source(text):
+    """PATH or PATH:START:STOP (empty START / STOP for the start / end)"""
+    parts = text.rsplit(':', 2)
+    if len(parts) == 3 and all(p == '' or p.isdigit() for p in parts[1:]):
+        return (parts[0], int(parts[1] or 0), int(parts[2]) if parts[2] else None)
+    return text
+
+def dataset_name(source):
+    path = source[0] if isinstance(source, tuple) else source
+    name = os.path.splitext(os.path.basename(path))[0]
+    if isinstance(source, tuple):
+        name += f"_{source[1]}-{'end' if source[2] is None else source[2]}"
+    return name
+
+def read_authkey(path):
+    """Key from the file at path, else from SPECKLE_AUTHKEY, else None"""
+    if path:
+        with open(path, 'rb') as f:
+            key = f.read().strip()
+    else:
+        key = os.environ.get('SPECKLE_AUTHKEY', '').encode()
+    return key or None
+
+def worker(args):
+    authkey = read_authkey(args.authkey_file)
+    if authkey is None:
+        print("worker needs the coordinator's key: --authkey-file or SPECKLE_AUTHKEY")
+        return 2
+    if args.processes == 1:
+        run_worker(args.host, args.port, authkey)
+        return 0
+    workers = start_local_workers(args.processes, args.host, args.port, authkey)
+    for w in workers:
+        w.join()
+    return 0
+
+def run(args):
+    proc = SpeckleProcessor(M=args.M, dtype={'mixed': None, 'float32': np.float32, 'float64': np.float64}[args.precision],
+                            corr_mode=args.corr_mode, subpixel=args.subpixel)
+    ref = parse_source(args.ref)
+    objs = [parse_source(o) for o in args.obj]
+    os.makedirs(args.out_dir, exist_ok=True)
+    authkey = read_authkey(args.authkey_file)
+    with Coordinator(proc, host=args.host, port=args.port, authkey=authkey, rows_per_job=args.rows_per_job,
+                     chunk_frames=args.chunk_frames, task_timeout=args.timeout,
+                     worker_timeout=args.worker_timeout, log=print) as co:
+        if args.local_workers:
+            start_local_workers(args.local_workers, '127.0.0.1', co.port, co.authkey)
+        print(f"coordinator on {args.host}:{co.port}")
+        if authkey is None:
+            print("no --authkey-file / SPECKLE_AUTHKEY, only local workers can connect")
+        failed = 0
+        if args.series:
+            for obj in objs:
+                name = dataset_name(obj)
+                n = source_shape(obj)[0]
+                rows, cols = proc.grid(*co.prepared_shape(ref))
+                shape = (n // args.k, len(rows), len(cols))
+                out = [np.lib.format.open_memmap(os.path.join(args.out_dir, f"{name}_{key}.npy"), mode='w+',
+                                                 dtype=dtype, shape=shape)
+                       for key, dtype in (('u', np.complex64), ('c', np.float32), ('e', np.int8))]
+                co.process_series(ref, obj, k=args.k, method=args.method, out=out)
+                for a in out:
+                    a.flush()
+                failed += co.failed_jobs
+                print(f"{name}: {shape[0]} steps of {shape[1]}x{shape[2]} windows")
+        else:
+            results = co.process_datasets([(ref, obj) for obj in objs], method=args.method)
+            failed += co.failed_jobs
+            for obj, (u, c, e, sc, rows, cols) in zip(objs, results):
+                name = dataset_name(obj)
+                np.savez(os.path.join(args.out_dir, f"{name}_field.npz"), u=u, c=c, e=e, sc=sc,
+                         rows=np.asarray(rows), cols=np.asarray(cols))
+                print(f"{name}: {np.sum(e == 0)} of {e.size} windows solved")
+    if failed:
+        print(f"{failed} jobs failed, their windows have e = 1")
+    return 1 if failed else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Distributed reprocessing of recorded datasets')
+    sub = ap.add_subparsers(dest='command', required=True)
+    w = sub.add_parser('worker', help='run worker processes connecting to a coordinator')
+    w.add_argument('host')
+    w.add_argument('--port', type=int, default=DEFAULT_PORT)
+    w.add_argument('--authkey-file', help='file with the key shared with the coordinator')
+    w.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    r = sub.add_parser('run', help='coordinate the processing of datasets')
+    r.add_argument('ref', help='reference stack')
+    r.add_argument('obj', nargs='+', help='object stacks')
+    r.add_argument('--host', default='127.0.0.1', help='interface to listen on (0.0.0.0: all)')
+    r.add_argument('--port', type=int, default=DEFAULT_PORT)
+    r.add_argument('--authkey-file', help='file with the key shared with the workers')
+    r.add_argument('--local-workers', type=int, default=0, help='also start worker processes on this machine')
+    r.add_argument('--out-dir', default='.')
+    r.add_argument('--M', type=int, default=64)
+    r.add_argument('--precision', choices=['mixed', 'float32', 'float64'], default='mixed')
+    r.add_argument('--corr-mode', choices=['zmcc', 'zncc', 'phase'], default='zmcc')
+    r.add_argument('--subpixel', choices=['chebyshev', 'quadratic', 'gradient'], default='chebyshev')
+    r.add_argument('--method', choices=['mean', 'median'], default='mean', help='frame averaging')
+    r.add_argument('--series', action='store_true', help='displacement per object frame (or k frames)')
+    r.add_argument('--k', type=int, default=1, help='series: object frames averaged per step')
+    r.add_argument('--rows-per-job', type=int, default=2, help='grid rows per job')
+    r.add_argument('--chunk-frames', type=int, default=64, help='series: object frames per job')
+    r.add_argument('--timeout', type=float, default=600.0, help='seconds per job before it is sent elsewhere')
+    r.add_argument('--worker-timeout', type=float, default=60.0,
+                   help='seconds without any worker before the run fails')
+    args = ap.parse_args()
+    return worker(args) if args.command == 'worker' else run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
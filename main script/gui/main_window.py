@@ -5,30 +5,49 @@ Script starts here from main.py
 """
 
 from PySide6.QtWidgets import (
-    QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QLabel, QTextEdit, QLineEdit, QTableWidget, QTableWidgetItem, QGridLayout, QApplication, QTabWidget
+    QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QLabel, QTextEdit, QLineEdit, QTableWidget, QTableWidgetItem, QGridLayout, QApplication, QTabWidget, QFileDialog, QComboBox, QCheckBox
 )
 from PySide6.QtCore import Qt, QTimer, QSize
-from PySide6.QtGui import QIntValidator
+from PySide6.QtGui import QIntValidator, QDoubleValidator
 import numpy as np
+import os
 
 # Local imports
-from gui.widgets import ImageDisplay, MplCanvas
-from camera.camera_handler import CameraHandler
+from gui.widgets import ImageDisplay, FieldPlotWidget, RoiSelector, DiagnosticsPanel
+try:
+    from camera.camera_handler import CameraHandler
+except ImportError:  # no Thorlabs SDK, only a replay camera (camera_factory) can be used
+    CameraHandler = None
+from camera.telemetry import LoopTelemetry
 from processing.speckle import SpeckleProcessor
+from processing.bayer import debayer, crop_pattern
+from processing.decorrelation import g2_stack
+from processing.pipeline import FramePipeline
+from processing.calibration import CalibrationStore
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, camera_factory=None):
+        """camera_factory: callable returning the camera backend (default CameraHandler, e.g. a ReplayCamera)"""
         super().__init__()
         self.setWindowTitle("Speckle Imaging GUI")
         self.setGeometry(100, 100, 1200, 800) # Main window 1200x800 px
 
         # Storage for images
+        self.calibration_store = CalibrationStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "calibration"))
+        self.calibration = None  # active Calibration, None when not applied
         self.Iref = None
         self.object_images = [] 
 
         # Camera handler + processor
-        self.camera = CameraHandler()
+        self.live_interval_ms = 30
+        self.telemetry = LoopTelemetry(target_fps=1000 / self.live_interval_ms)
+        self.camera_factory = camera_factory or CameraHandler
+        if self.camera_factory is None:
+            raise ImportError("Thorlabs SDK not found, pass a camera_factory (e.g. main.py --replay)")
+        self.camera = self.camera_factory()
+        self.camera.telemetry = self.telemetry
         self.mode = "live"
+        self.slm_step = None  # optional callable(k) setting SLM pattern k before trigger k of an SLM burst
         self.processor = SpeckleProcessor()  # empty for now
 
         # Use a tab widget as central widget. First tab contains the existing main layout.
@@ -71,6 +90,52 @@ class MainWindow(QMainWindow):
         camera_mode_layout.insertStretch(0, 2)
         camera_layout.addLayout(camera_mode_layout)
 
+        # Sensor settings (exposure, binning, frame rate limit)
+        settings_layout = QHBoxLayout()
+        settings_layout.addWidget(QLabel("Exposure (ms):"))
+        self.exposure_input = QLineEdit("11")
+        self.exposure_input.setValidator(QDoubleValidator(0.01, 10000.0, 2))
+        self.exposure_input.setFixedWidth(50)
+        settings_layout.addWidget(self.exposure_input)
+        settings_layout.addWidget(QLabel("Binning:"))
+        self.binning_input = QComboBox()
+        self.binning_input.addItems(["1", "2", "4"])
+        settings_layout.addWidget(self.binning_input)
+        settings_layout.addWidget(QLabel("Max fps:"))
+        self.fps_input = QLineEdit()
+        self.fps_input.setPlaceholderText("free")
+        self.fps_input.setValidator(QDoubleValidator(0.1, 1000.0, 1))
+        self.fps_input.setFixedWidth(50)
+        settings_layout.addWidget(self.fps_input)
+        self.apply_settings_btn = QPushButton("Apply")
+        self.apply_settings_btn.clicked.connect(self.apply_camera_settings)
+        settings_layout.addWidget(self.apply_settings_btn)
+        camera_layout.addLayout(settings_layout)
+
+        # Colour plane of the Bayer sensor used for live view and processing
+        bayer_layout = QHBoxLayout()
+        bayer_layout.addWidget(QLabel("Colour plane:"))
+        self.bayer_input = QComboBox()
+        self.bayer_modes = {"Raw mosaic": None, "Red": "R", "Green": "G", "Blue": "B", "Luminance (2x2 sum)": "lum"}
+        self.bayer_input.addItems(list(self.bayer_modes))
+        self.bayer_input.currentTextChanged.connect(self.check_bayer_mode)
+        bayer_layout.addWidget(self.bayer_input)
+        bayer_layout.insertStretch(-1, 2)
+        camera_layout.addLayout(bayer_layout)
+
+        # Dark / flat calibration
+        calib_layout = QHBoxLayout()
+        self.capture_dark_btn = QPushButton("Capture Dark")
+        self.capture_dark_btn.clicked.connect(lambda: self.capture_calibration("dark"))
+        calib_layout.addWidget(self.capture_dark_btn)
+        self.capture_flat_btn = QPushButton("Capture Flat")
+        self.capture_flat_btn.clicked.connect(lambda: self.capture_calibration("flat"))
+        calib_layout.addWidget(self.capture_flat_btn)
+        self.apply_calibration_box = QCheckBox("Apply dark/flat")
+        self.apply_calibration_box.toggled.connect(self.load_calibration)
+        calib_layout.addWidget(self.apply_calibration_box)
+        camera_layout.addLayout(calib_layout)
+
         # Number of object images input
         num_input_layout = QHBoxLayout()
         self.num_images_label = QLabel("Number of desired object images (integer ≥ 1):")
@@ -127,11 +192,30 @@ class MainWindow(QMainWindow):
         self.capture_obj_btn.clicked.connect(self.capture_object)
         controls_layout.addWidget(self.capture_obj_btn, alignment=Qt.AlignCenter)
 
+        # Processing options
+        self.pre_register_box = QCheckBox("Pre-register global drift")
+        controls_layout.addWidget(self.pre_register_box, alignment=Qt.AlignCenter)
+        corr_layout = QHBoxLayout()
+        corr_layout.addWidget(QLabel("Correlation:"))
+        self.corr_input = QComboBox()
+        self.corr_modes = {"ZMCC (original)": "zmcc", "ZNCC (per shift)": "zncc", "Phase correlation": "phase"}
+        self.corr_input.addItems(list(self.corr_modes))
+        corr_layout.addWidget(self.corr_input)
+        controls_layout.addLayout(corr_layout)
+
         # Process data button
         self.process_speckle_btn = QPushButton("Process Speckle Images")
         self.process_speckle_btn.clicked.connect(self.process_speckle)
         controls_layout.addWidget(self.process_speckle_btn, alignment=Qt.AlignBottom)
 
+        # Capture and process at the same time, results follow the camera a few frames behind
+        self.pipeline_btn = QPushButton("Capture + Process (pipelined)")
+        self.pipeline_btn.clicked.connect(self.run_pipeline)
+        controls_layout.addWidget(self.pipeline_btn, alignment=Qt.AlignBottom)
+        self.pipeline = None
+        self.pipeline_timer = QTimer()
+        self.pipeline_timer.timeout.connect(self.poll_pipeline)
+
         controls_widget = QWidget()
         controls_widget.setLayout(controls_layout)
         main_layout.addWidget(controls_widget, 0, 1)
@@ -173,18 +257,43 @@ class MainWindow(QMainWindow):
         # ---------- Plot Tab ----------
         plot_page = QWidget()
         plot_layout = QVBoxLayout()
-        # create the matplotlib canvas and expose it as self.canvas for plotting
-        self.canvas = MplCanvas(self, width=6, height=6, dpi=100)
-        plot_layout.addWidget(self.canvas)
+        # pyqtgraph panel for displacement, correlation, error and contrast images
+        self.field_plot = FieldPlotWidget(self)
+        plot_layout.addWidget(self.field_plot)
         plot_page.setLayout(plot_layout)
         # keep a reference to the plot page so we can switch to it programmatically
         self.plot_page = plot_page
         self.tab_widget.addTab(plot_page, "Plot")
 
+        # ---------- ROI Tab ----------
+        roi_page = QWidget()
+        roi_layout = QVBoxLayout()
+        self.roi_selector = RoiSelector(self)
+        roi_layout.addWidget(self.roi_selector)
+        roi_button_layout = QHBoxLayout()
+        self.add_roi_btn = QPushButton("Add ROI")
+        self.add_roi_btn.clicked.connect(self.roi_selector.add_roi)
+        roi_button_layout.addWidget(self.add_roi_btn)
+        self.load_mask_btn = QPushButton("Load Mask")
+        self.load_mask_btn.clicked.connect(self.load_mask)
+        roi_button_layout.addWidget(self.load_mask_btn)
+        self.clear_roi_btn = QPushButton("Clear ROIs")
+        self.clear_roi_btn.clicked.connect(self.roi_selector.clear_rois)
+        roi_button_layout.addWidget(self.clear_roi_btn)
+        roi_layout.addLayout(roi_button_layout)
+        roi_page.setLayout(roi_layout)
+        self.tab_widget.addTab(roi_page, "ROI")
+
+        # ---------- Diagnostics Tab ----------
+        # live view loop timing: SDK poll, copy, conversion, display and paint
+        self.camera_display.telemetry = self.telemetry
+        self.diagnostics = DiagnosticsPanel(self.telemetry, self)
+        self.tab_widget.addTab(self.diagnostics, "Diagnostics")
+
         # Camera handler + timer
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_camera)
-        self.timer.start(30)  # ~30 FPS
+        self.timer.start(self.live_interval_ms)  # ~30 FPS
     
     def log_error(self, message: str):
         # Append error message to the error log
@@ -197,7 +306,8 @@ class MainWindow(QMainWindow):
     # Arms camera for image capturing, with settings assigned in camera_handler.py
     def activate_camera(self):
         if not self.camera or self.camera.camera is None:
-            self.camera = CameraHandler()
+            self.camera = self.camera_factory()
+            self.camera.telemetry = self.telemetry
             if self.camera.camera is None:
                 self.log_error("No camera connection found")
                 return
@@ -226,6 +336,27 @@ class MainWindow(QMainWindow):
             self.camera_status.setText("Camera disconnected")
             self.camera_status.setStyleSheet("color: red; font-weight: bold;")
 
+    # Applies exposure, binning and frame rate from the settings row
+    def apply_camera_settings(self):
+        if not self.camera or self.camera.camera is None:
+            self.log_error("No active camera. Please activate first")
+            return
+        try:
+            exposure_ms = float(self.exposure_input.text() or 11)
+            binning = int(self.binning_input.currentText())
+            fps = float(self.fps_input.text()) if self.fps_input.text() else None
+            self.camera.set_exposure(exposure_ms * 1000)
+            self.camera.set_binning(binning)
+            self.camera.set_frame_rate(fps)
+        except Exception as e:
+            self.log_error(f"Could not apply camera settings: {e}")
+            return
+        self.load_calibration()  # calibration frames are keyed by exposure and geometry
+        self.check_bayer_mode()
+        geometry = self.camera.geometry()
+        self.log_info(f"Exposure {self.camera.exposure_us / 1000:.2f} ms, binning {geometry['binx']}x{geometry['biny']}, "
+                      f"fps limit {fps if fps is not None else 'off'}")
+
     # Sets operation mode of camera to live feed
     def set_camera_mode_live_feed(self):
         if not self.camera or self.camera.camera is None:
@@ -263,6 +394,7 @@ class MainWindow(QMainWindow):
             self.Iref = frame
             self.camera_display.set_image(frame)
             self.iref_preview.set_image(frame)    # show captured reference in preview box
+            self.roi_selector.set_image(debayer(frame, *self.bayer_settings()))    # ROIs are drawn on the processed reference
             # self.log_info("Reference image captured")
              # Show shape of the frame (matrix size)
             h, w = frame.shape[:2]
@@ -278,32 +410,34 @@ class MainWindow(QMainWindow):
             self.log_error("No camera connected")
             return
 
-        # if (self.mode != "live") or (self.mode != "SLM"):
-        #     self.log_error("Select camera mode")
-        #     return
-
-        
-        # ------ Placeholder for SLM sync ------
-        # if self.mode == "SLM":
-            #num_images = int(self.num_images_input.text() or 0)
-            #if num_images <= 0:
-                #self.log_error("Number of object images should be integer ≥ 1")
-                #return
-
-        #   for i in range(num_images):
-        #       TODO: wait for SLM trigger or send SLM command here
-        #       frame = self.camera.trigger_capture()
-        #       self.object_images.append(frame)
-        #
-        #       if len(self.object_images) == 1:
-        #           self.first_obj_preview.set_image(frame)
-        #       elif len(self.object_images) == num_images:
-        #           self.last_obj_preview.set_image(frame)
-        #           self.log_info(f"Captured object frame #{len(self.object_images)}.")
-        # ---------------------------------------
-        # if self.mode == "SLM":
-        #     self.log_error("SLM currently not synced")
-        #     return
+        # SLM mode: capture the whole stack as one burst, one frame per trigger
+        if self.mode == "SLM":
+            num_images = int(self.num_images_input.text() or 0)
+            if num_images <= 0:
+                self.log_error("Number of object images should be integer ≥ 1")
+                return
+            result = self.camera.capture_burst(num_images, mode="software", before_trigger=self.slm_step)
+            if result is None:
+                return
+            frames = result.received_frames()
+            if len(result.missed) > 0:
+                self.log_error(f"Missed {len(result.missed)} of {num_images} triggers")
+            if len(result.dropped) > 0:
+                self.log_error(f"Dropped {len(result.dropped)} of {num_images} frames (produced by the sensor, not received)")
+            if not frames:
+                return
+            self.object_images.extend(frames)
+            self.camera_display.set_image(frames[-1])
+            self.object_count_label.setText(f"Captured: {len(self.object_images)}")
+            if len(self.object_images) == len(frames):
+                self.first_obj_preview.set_image(frames[0])
+            self.last_obj_preview.set_image(frames[-1])
+            t = result.host_times[np.isfinite(result.host_times)]
+            if len(t) > 1:
+                self.log_info(f"Captured {len(frames)} object frames at {(len(t) - 1) / (t[-1] - t[0]):.1f} fps")
+            else:
+                self.log_info(f"Captured {len(frames)} object frames")
+            return
 
         if self.mode == "live":
             frame = self.camera.trigger_capture()
@@ -320,10 +454,67 @@ class MainWindow(QMainWindow):
                 self.log_info(f"Captured object frame #{len(self.object_images)}.")
 
 
+    # Captures and stores a master dark or flat frame for the current exposure and geometry
+    def capture_calibration(self, kind):
+        if not self.camera or self.camera.camera is None:
+            self.log_error("No camera connected")
+            return
+        n = int(self.num_images_input.text() or 0) or 20
+        result = self.camera.capture_burst(n, mode="software")
+        if result is None or result.n_received == 0:
+            self.log_error(f"No frames captured for {kind}")
+            return
+        _, version = self.calibration_store.save(kind, result.received_frames(), self.camera.exposure_us,
+                                                 self.camera.geometry())
+        self.log_info(f"Stored master {kind} v{version} from {result.n_received} frames")
+        self.load_calibration()
+
+    # (Re)loads the calibration for the current settings when "Apply dark/flat" is checked
+    def load_calibration(self):
+        self.calibration = None
+        if not self.apply_calibration_box.isChecked():
+            return
+        if not self.camera or self.camera.camera is None:
+            self.log_error("No camera connected")
+            return
+        self.calibration = self.calibration_store.calibration(self.camera.exposure_us, self.camera.geometry())
+        if self.calibration is None:
+            self.log_error("No dark or flat frame stored for the current exposure and geometry")
+
+    # Applies dark/flat correction to a frame if enabled. The result is the calibration's reused
+    # buffer (overwritten by the next frame), copy it where a frame is kept.
+    def calibrate(self, frame):
+        if self.calibration is None or frame is None or self.calibration.shape != frame.shape:
+            return frame
+        return self.calibration.apply(frame)
+
+    # Selected Bayer stage as (mode, pattern), the pattern as seen from the top-left pixel of the sensor ROI
+    def bayer_settings(self):
+        mode = self.bayer_modes[self.bayer_input.currentText()]
+        pattern = None
+        if self.camera and self.camera.camera is not None:
+            pattern = self.camera.bayer_pattern()
+            geometry = self.camera.geometry()
+            if pattern is not None and geometry is not None:
+                pattern = crop_pattern(pattern, geometry['roi'])
+        return mode, pattern or "RGGB"
+
+    # Colour planes need the unbinned mosaic, falls back to the raw mosaic while the sensor bins
+    def check_bayer_mode(self):
+        if self.bayer_modes[self.bayer_input.currentText()] is None or not self.camera or self.camera.camera is None:
+            return
+        geometry = self.camera.geometry()
+        if geometry is not None and (geometry['binx'] > 1 or geometry['biny'] > 1):
+            self.log_error("Colour planes need binning 1, binned frames have no Bayer mosaic left")
+            self.bayer_input.setCurrentText("Raw mosaic")
+
     # Updates camera image displayed on GUI live feed
     def update_camera(self):
+        self.telemetry.tick()
         frame = self.camera.trigger_capture()
         if frame is not None:
+            with self.telemetry.stage('convert'):
+                frame = debayer(self.calibrate(frame), *self.bayer_settings())
             self.camera_display.set_image(frame)
     
     def closeEvent(self, event):
@@ -341,6 +532,90 @@ class MainWindow(QMainWindow):
         else:
             super().keyPressEvent(event)
 
+    # Streams object frames from the camera through preprocessing into correlation workers
+    def run_pipeline(self):
+        if not self.camera or self.camera.camera is None:
+            self.log_error("No camera connected")
+            return
+        if self.Iref is None:
+            self.log_error("Capture a reference image first")
+            return
+        if self.pipeline is not None and self.pipeline.is_running():
+            self.log_error("Pipeline already running")
+            return
+        num_images = int(self.num_images_input.text() or 0)
+        if num_images <= 0:
+            self.log_error("Number of object images should be integer ≥ 1")
+            return
+
+        bayer, pattern = self.bayer_settings()
+        preprocess = []
+        if self.calibration is not None:
+            preprocess.append(self.calibration)
+        if bayer is not None:
+            preprocess.append(lambda f: debayer(f, bayer, pattern))
+        mask = self.roi_selector.mask(debayer(self.Iref, bayer, pattern).shape[:2])
+        proc = SpeckleProcessor(M=64, n_workers=4, mask=mask, corr_mode=self.corr_modes[self.corr_input.currentText()])
+        self.timer.stop()  # the pipeline owns the camera while it runs
+        self.pipeline = FramePipeline(self.camera.trigger_capture, num_images, self.Iref, preprocess, proc)
+        self.pipeline.start()
+        self.pipeline_timer.start(200)
+        self.log_info(f"Pipeline started for {num_images} frames")
+
+    # Shows the latest field while the pipeline runs and the final result when it is done
+    def poll_pipeline(self):
+        p = self.pipeline
+        if p is None:
+            self.pipeline_timer.stop()
+            return
+        if p.fields:
+            u_image, c_image, e_image = p.fields[-1].dense()
+            self.field_plot.update_field(u_image, c_image, e_image, None, p.rows, p.cols)
+        if p.is_running():
+            return
+
+        self.pipeline_timer.stop()
+        self.timer.start(self.live_interval_ms)
+        if p.error is not None:
+            self.log_error(f"Pipeline failed: {p.error}")
+            return
+        for name, st in p.report().items():
+            self.log_info(f"{name}: {st['frames']} frames, {st['fps']:.1f} fps, max queue {st['max_queue_depth']}")
+        if p.field is not None:
+            u_image, c_image, e_image = p.field.dense()
+            self.field_plot.update_field(u_image, c_image, e_image, p.sc_image, p.rows, p.cols)
+            self.update_biomass_table({
+                "Mean contrast K": float(np.nanmean(p.sc_image)),
+                "Mean |u| (px)": float(np.nanmean(np.abs(u_image[e_image == 0]))) if np.any(e_image == 0) else float('nan'),
+            })
+
+    # Fills the biomass table with {property name: value}
+    def update_biomass_table(self, properties):
+        self.biomass_table.setRowCount(max(len(properties), self.biomass_table.rowCount()))
+        for i, (name, value) in enumerate(properties.items()):
+            self.biomass_table.setItem(i, 0, QTableWidgetItem(name))
+            text = "---" if value is None or not np.isfinite(value) else f"{value:.4g}"
+            self.biomass_table.setItem(i, 1, QTableWidgetItem(text))
+
+    # Loads a binary mask (.npy, nonzero = inside) to restrict processing
+    def load_mask(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Load mask", "", "NumPy array (*.npy)")
+        if not path:
+            return
+        try:
+            mask = np.load(path)
+        except Exception as e:
+            self.log_error(f"Could not load mask: {e}")
+            return
+        if mask.ndim != 2:
+            self.log_error("Mask must be a 2D array")
+            return
+        if self.roi_selector.shape is not None and mask.shape != self.roi_selector.shape:
+            self.log_error(f"Mask shape {mask.shape} does not match reference image {self.roi_selector.shape}")
+            return
+        self.roi_selector.set_mask(mask != 0)
+        self.log_info(f"Loaded mask with {int(np.count_nonzero(mask))} pixels")
+
     # Uses ref image and object image stack to retrieve processed speckle data. Currently only displays displacement field
     def process_speckle(self):
         if self.Iref is None or len(self.object_images) == 0:
@@ -351,20 +626,37 @@ class MainWindow(QMainWindow):
         Iref_stack = [self.Iref] * 10  # if you have only one ref; better capture N_ref frames
         Iobj_stack = self.object_images   # list of frames captured
 
-        proc = SpeckleProcessor(M=64, n_workers=4)
-        u_image, c_image, e_image, sc_image, rows, cols = proc.process(Iref_stack, Iobj_stack, method='mean')
-
-        # visualize correlation map and vector field on your canvas
-        U = np.real(u_image)
-        V = np.imag(u_image)
-        # draw quiver (use matplotlib axes in your MplCanvas)
-        # draw on the embedded canvas inside the Plot tab
-        if hasattr(self, 'canvas') and self.canvas is not None:
-            ax = self.canvas.ax
-            ax.clear()
-            ax.quiver(cols, rows, V, U)   # note mapping of axes depending on how rows/cols defined
-            ax.set_title("Displacement (quiver)")
-            self.canvas.draw()
+        # only windows inside the drawn ROIs / loaded mask are computed
+        bayer, pattern = self.bayer_settings()
+        mask = self.roi_selector.mask(debayer(self.Iref, bayer, pattern).shape[:2])
+        proc = SpeckleProcessor(M=64, n_workers=4, mask=mask, bayer=bayer, bayer_pattern=pattern,
+                                pre_register=self.pre_register_box.isChecked(), calibration=self.calibration,
+                                corr_mode=self.corr_modes[self.corr_input.currentText()])
+        # calibration, geometry and Bayer stages once, the object stack is used for g2 as well
+        Iref_stack = proc.prepare_stack(Iref_stack)
+        Iobj_stack = proc.prepare_stack(Iobj_stack)
+        u_image, c_image, e_image, sc_image, rows, cols = proc.process(Iref_stack, Iobj_stack, method='mean',
+                                                                       prepared=True)
+
+        # Biomass activity from speckle decorrelation of the object stack
+        properties = {
+            "Mean contrast K": float(np.nanmean(sc_image)),
+            "Mean |u| (px)": float(np.nanmean(np.abs(u_image[e_image == 0]))) if np.any(e_image == 0) else float('nan'),
+        }
+        if len(Iobj_stack) >= 3:
+            g2 = g2_stack(Iobj_stack, max_lag=min(len(Iobj_stack) // 2, 100), window=8, return_g2=False)
+            properties["Decorrelation time (frames)"] = float(np.nanmedian(g2['tau_c']))
+            properties["g2(1) - 1"] = float(g2['g2_mean'][1] - 1.0)
+        self.update_biomass_table(properties)
+
+        if proc.global_shift is not None:
+            self.log_info(f"Global shift dy={proc.global_shift[0]:.2f}, dx={proc.global_shift[1]:.2f} px")
+        if mask is not None:
+            self.log_info(f"Computed {int(np.count_nonzero(e_image >= 0))} of {e_image.size} windows inside ROI")
+
+        # visualize displacement, correlation, error and contrast in the Plot tab
+        if hasattr(self, 'field_plot') and self.field_plot is not None:
+            self.field_plot.update_field(u_image, c_image, e_image, sc_image, rows, cols)
             # switch to the plot tab so the user sees the result
             try:
                 plot_index = self.tab_widget.indexOf(self.plot_page)
@@ -373,5 +665,4 @@ class MainWindow(QMainWindow):
             except Exception:
                 pass
         else:
-            self.log_error("Plot canvas not available")
-
+            self.log_error("Plot widget not available")
@@ -1,12 +1,16 @@
 # Classes for displaying images. Used in main_window.py to display camera images onto a GUI
 
-from PySide6.QtWidgets import QLabel, QWidget, QVBoxLayout
+from PySide6.QtWidgets import (
+    QLabel, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QComboBox, QTableWidget, QTableWidgetItem, QFileDialog
+)
 from PySide6.QtGui import QImage, QPixmap
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer
+import time
 import numpy as np
+import math
+import pyqtgraph as pg
 
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+from processing.speckle import mask_from_rois
 
 # We use this to keep main_window modularized 
 
@@ -21,14 +25,32 @@ class ImageDisplay(QLabel):
         # Optional: center placeholder text
         self.setAlignment(Qt.AlignCenter)
         self.setText("Camera Display")
+        self.telemetry = None  # optional LoopTelemetry, records 'display' (set_image) and 'paint' times
+
+    def paintEvent(self, event):
+        if self.telemetry is None:
+            return super().paintEvent(event)
+        t0 = time.perf_counter()
+        super().paintEvent(event)
+        self.telemetry.record('paint', time.perf_counter() - t0)
 
     def set_image(self, frame: np.ndarray):
         if frame is None:
             return
+        if self.telemetry is not None:
+            with self.telemetry.stage('display'):
+                return self._set_image(frame)
+        return self._set_image(frame)
+
+    def _set_image(self, frame):
         if frame.ndim == 2:
             bit_depth = 16 if frame.dtype == np.uint else 8
             
-            if bit_depth == 16:
+            if np.issubdtype(frame.dtype, np.floating):
+                # e.g. dark/flat corrected frames, scale to 8 bit
+                top = float(np.nanmax(frame)) if frame.size else 0.0
+                frame8 = np.clip(frame * (255.0 / top if top > 0 else 0.0), 0, 255).astype(np.uint8)
+            elif bit_depth == 16:
                 frame8 = (frame >> (bit_depth - 8)).astype(np.uint8)
             else:
                 frame8 = frame.astype(np.uint8)
@@ -46,8 +68,267 @@ class ImageDisplay(QLabel):
         qt_image = QImage(frame_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
         self.setPixmap(QPixmap.fromImage(qt_image))
 
-class MplCanvas(FigureCanvas):
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.ax = self.fig.add_subplot(111)
-        super().__init__(self.fig)
+class FieldPlotWidget(pg.GraphicsLayoutWidget):
+    """
+    Fast display of processed speckle fields using pyqtgraph.
+    Shows |u| with a decimated vector overlay, the direction of u, c_image, e_image and sc_image.
+    All items are created once and updated in place, so it can be refreshed at camera rate.
+    """
+    def __init__(self, parent=None, max_vectors=900):
+        super().__init__(parent)
+        self.max_vectors = max_vectors  # upper limit on number of arrows drawn on top of |u|
+
+        self.plots = {}
+        self.images = {}
+        panels = [
+            ("mag", "Displacement |u| (px)", "viridis", 0, 0),
+            ("dir", "Direction of u (rad)", "CET-C1", 0, 1),
+            ("sc", "Temporal contrast K", "inferno", 0, 2),
+            ("c", "Peak correlation", "viridis", 1, 0),
+            ("e", "Error flag", "CET-L1", 1, 1),
+        ]
+        for key, title, cmap, row, col in panels:
+            plot = self.addPlot(row=row, col=col, title=title)
+            plot.setAspectLocked(True)
+            plot.invertY(True)  # image convention, row 0 on top
+            img = pg.ImageItem(axisOrder='row-major')
+            img.setColorMap(pg.colormap.get(cmap))
+            plot.addItem(img)
+            self.plots[key] = plot
+            self.images[key] = img
+
+        # Vector overlay, drawn as line segments (pairs of points)
+        self.vectors = pg.PlotDataItem(connect='pairs', pen=pg.mkPen('w', width=1))
+        self.plots["mag"].addItem(self.vectors)
+        # pan/zoom all panels together
+        for key in ("dir", "c", "e", "sc"):
+            self.plots[key].setXLink(self.plots["mag"])
+            self.plots[key].setYLink(self.plots["mag"])
+
+        self._grid = None  # (rows, cols) of last update, to avoid re-placing images every frame
+
+    @staticmethod
+    def _set(img, data, levels=None):
+        if levels is None:
+            finite = data[np.isfinite(data)]
+            if finite.size == 0:
+                levels = (0.0, 1.0)
+            else:
+                lo, hi = float(finite.min()), float(finite.max())
+                levels = (lo, hi if hi > lo else lo + 1.0)
+        img.setImage(data, autoLevels=False, levels=levels)
+
+    def _place(self, rows, cols):
+        """Map field images onto pixel coordinates of the camera frame"""
+        rows = np.asarray(rows, dtype=float)
+        cols = np.asarray(cols, dtype=float)
+        dr = rows[1] - rows[0] if len(rows) > 1 else 1.0
+        dc = cols[1] - cols[0] if len(cols) > 1 else 1.0
+        x0 = cols[0] - dc / 2
+        y0 = rows[0] - dr / 2
+        for key in ("mag", "dir", "c", "e"):
+            self.images[key].setRect(x0, y0, dc * len(cols), dr * len(rows))
+        self._grid = (rows, cols, dr, dc)
+
+    def update_field(self, u_image, c_image=None, e_image=None, sc_image=None, rows=None, cols=None):
+        """
+        Update all panels without clearing.
+        u_image: complex (nrows x ncols), real = vertical (rows), imag = horizontal (cols)
+        rows/cols: pixel centres of the windows (default: window indices)
+        """
+        nrows, ncols = u_image.shape
+        if rows is None:
+            rows = np.arange(nrows)
+        if cols is None:
+            cols = np.arange(ncols)
+        if (self._grid is None or len(self._grid[0]) != nrows or len(self._grid[1]) != ncols
+                or not np.array_equal(self._grid[0], rows) or not np.array_equal(self._grid[1], cols)):
+            self._place(rows, cols)
+        rows, cols, dr, dc = self._grid
+
+        U = np.real(u_image)
+        V = np.imag(u_image)
+        self._set(self.images["mag"], np.hypot(U, V))
+        self._set(self.images["dir"], np.arctan2(U, V), levels=(-np.pi, np.pi))
+        if c_image is not None:
+            self._set(self.images["c"], c_image, levels=(0.0, 1.0))
+        if e_image is not None:
+            self._set(self.images["e"], e_image.astype(np.float32), levels=(0.0, 1.0))
+        if sc_image is not None:
+            self._set(self.images["sc"], sc_image)
+
+        # Decimated vector overlay
+        step = max(1, int(math.ceil(math.sqrt(nrows * ncols / self.max_vectors))))
+        Ud = U[::step, ::step]
+        Vd = V[::step, ::step]
+        X, Y = np.meshgrid(cols[::step], rows[::step])
+        length = np.hypot(Ud, Vd)
+        finite = np.isfinite(length)
+        vmax = float(length[finite].max()) if np.any(finite) else 0.0
+        # scale so the longest arrow spans the spacing of the drawn vectors
+        scale = step * min(dr, dc) / vmax if vmax > 0 else 0.0
+        x = np.empty(2 * Ud.size)
+        y = np.empty(2 * Ud.size)
+        x[0::2] = X.ravel()
+        y[0::2] = Y.ravel()
+        x[1::2] = (X + scale * Vd).ravel()
+        y[1::2] = (Y + scale * Ud).ravel()
+        keep = np.repeat(finite.ravel(), 2)
+        self.vectors.setData(x[keep], y[keep])
+
+class RoiSelector(pg.GraphicsLayoutWidget):
+    """
+    Shows a frame (usually the reference image) where rectangular ROIs can be drawn.
+    A binary mask (e.g. loaded from file) can be combined with the ROIs.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.plot = self.addPlot(title="Regions of interest")
+        self.plot.setAspectLocked(True)
+        self.plot.invertY(True)
+        self.image = pg.ImageItem(axisOrder='row-major')
+        self.plot.addItem(self.image)
+        self.mask_overlay = pg.ImageItem(axisOrder='row-major')
+        self.mask_overlay.setOpacity(0.3)
+        self.plot.addItem(self.mask_overlay)
+        self.rois = []
+        self.binary_mask = None
+        self.shape = None
+
+    def set_image(self, frame):
+        if frame is None:
+            return
+        if frame.ndim == 3:
+            frame = frame.mean(axis=2)
+        self.shape = frame.shape[:2]
+        self.image.setImage(frame, autoLevels=True)
+
+    def add_roi(self):
+        """Adds a rectangular ROI in the middle of the current image"""
+        H, W = self.shape if self.shape is not None else (100, 100)
+        roi = pg.RectROI([W // 4, H // 4], [W // 2, H // 2], pen=pg.mkPen('y', width=2))
+        roi.addScaleHandle([0, 0], [1, 1])
+        self.plot.addItem(roi)
+        self.rois.append(roi)
+
+    def set_mask(self, mask):
+        """Binary mask (H x W), shown as overlay and OR'ed with the ROIs"""
+        self.binary_mask = None if mask is None else np.asarray(mask, dtype=bool)
+        if self.binary_mask is None:
+            self.mask_overlay.clear()
+        else:
+            self.mask_overlay.setImage(self.binary_mask.astype(np.uint8), levels=(0, 1))
+
+    def clear_rois(self):
+        for roi in self.rois:
+            self.plot.removeItem(roi)
+        self.rois = []
+        self.set_mask(None)
+
+    def roi_rects(self):
+        """ROIs as (r0, c0, height, width) in image pixels"""
+        rects = []
+        for roi in self.rois:
+            x, y = roi.pos()
+            w, h = roi.size()
+            rects.append((y, x, h, w))
+        return rects
+
+    def mask(self, shape):
+        """Combined boolean mask of shape (H, W), or None if nothing is selected"""
+        if not self.rois and self.binary_mask is None:
+            return None
+        mask = mask_from_rois(shape, self.roi_rects())
+        if self.binary_mask is not None and self.binary_mask.shape == tuple(shape):
+            mask |= self.binary_mask
+        return mask
+
+class DiagnosticsPanel(QWidget):
+    """
+    Live view of a camera.telemetry.LoopTelemetry: achieved vs target fps, frame counters,
+    a latency table per stage and the histogram of one stage. Refreshed once per second.
+    """
+    columns = ["Stage", "n", "mean (ms)", "p50 (ms)", "p95 (ms)", "p99 (ms)", "max (ms)"]
+
+    def __init__(self, telemetry, parent=None, refresh_ms=1000):
+        super().__init__(parent)
+        self.telemetry = telemetry
+        layout = QVBoxLayout()
+
+        self.rate_label = QLabel()
+        self.counter_label = QLabel()
+        layout.addWidget(self.rate_label)
+        layout.addWidget(self.counter_label)
+
+        self.table = QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.verticalHeader().setVisible(False)
+        layout.addWidget(self.table)
+
+        hist_layout = QHBoxLayout()
+        hist_layout.addWidget(QLabel("Histogram of stage:"))
+        self.stage_input = QComboBox()
+        hist_layout.addWidget(self.stage_input)
+        hist_layout.insertStretch(-1, 2)
+        self.reset_btn = QPushButton("Reset")
+        self.reset_btn.clicked.connect(self.reset)
+        hist_layout.addWidget(self.reset_btn)
+        self.export_btn = QPushButton("Export...")
+        self.export_btn.clicked.connect(self.export)
+        hist_layout.addWidget(self.export_btn)
+        layout.addLayout(hist_layout)
+
+        self.hist_plot = pg.PlotWidget()
+        self.hist_plot.setLogMode(x=True, y=False)
+        self.hist_plot.setLabel('bottom', 'latency', units='s')
+        self.hist_plot.setLabel('left', 'count')
+        self.hist_curve = self.hist_plot.plot(stepMode='center', fillLevel=0, brush=(80, 120, 200, 150))
+        layout.addWidget(self.hist_plot)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(refresh_ms)
+
+    def refresh(self):
+        summary = self.telemetry.summary()
+        target = summary['target_fps']
+        self.rate_label.setText(
+            f"Loop: {summary['loop_fps']:.1f} fps (target {target:.1f})    Frames: {summary['frame_fps']:.1f} fps"
+            if target else f"Loop: {summary['loop_fps']:.1f} fps    Frames: {summary['frame_fps']:.1f} fps")
+        self.counter_label.setText(
+            f"Frames received: {summary['frames']}    Null polls: {summary['null_frames']}    "
+            f"Skipped (SDK counter gaps): {summary['skipped_frames']}    "
+            f"SDK frame count: {summary['last_frame_count'] if summary['last_frame_count'] is not None else '---'}")
+
+        stages = summary['stages']
+        self.table.setRowCount(len(stages))
+        for i, (name, st) in enumerate(stages.items()):
+            values = [name, str(st['n'])] + [f"{st[k]:.2f}" for k in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+            for j, text in enumerate(values):
+                self.table.setItem(i, j, QTableWidgetItem(text))
+
+        # keep the stage list in sync without losing the selection
+        names = list(stages)
+        if names != [self.stage_input.itemText(i) for i in range(self.stage_input.count())]:
+            current = self.stage_input.currentText()
+            self.stage_input.blockSignals(True)
+            self.stage_input.clear()
+            self.stage_input.addItems(names)
+            if current in names:
+                self.stage_input.setCurrentText(current)
+            self.stage_input.blockSignals(False)
+        hist = self.telemetry.histograms.get(self.stage_input.currentText())
+        if hist is not None:
+            self.hist_curve.setData(hist.edges, hist.counts.astype(float))
+        else:
+            self.hist_curve.setData([], [])
+
+    def reset(self):
+        self.telemetry.reset()
+        self.refresh()
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export telemetry", "telemetry.json", "JSON (*.json)")
+        if path:
+            self.telemetry.export(path)
@@ -1,5 +1,6 @@
 # Main script. Calls main_window and opens GUI window.
 
+import argparse
 import os
 import sys
 
@@ -38,8 +39,25 @@ from gui.main_window import MainWindow
 # Contact: edwinahlqvist@gmail.com
 
 
+def parse_args(argv):
+    # Options of the GUI, remaining arguments are passed on to Qt
+    parser = argparse.ArgumentParser(description="Speckle imaging GUI")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recording (.s12 or .npy stack) instead of using the camera")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible instead of at the recorded frame times")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor for realtime replay")
+    parser.add_argument("--no-loop", action="store_true", help="stop at the end of the recording instead of starting over")
+    return parser.parse_known_args(argv[1:])
+
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv) # init the Qt application
-    window = MainWindow() # Main window class - control program from here
+    args, qt_args = parse_args(sys.argv)
+    camera_factory = None
+    if args.replay:
+        from camera.replay_camera import ReplayCamera
+        camera_factory = lambda: ReplayCamera(args.replay, realtime=not args.fast, speed=args.speed,
+                                              loop=not args.no_loop)
+    app = QApplication(sys.argv[:1] + qt_args) # init the Qt application
+    window = MainWindow(camera_factory) # Main window class - control program from here
     window.show()
     sys.exit(app.exec())
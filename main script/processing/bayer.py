@@ -0,0 +1,73 @@
+# Raw Bayer mosaic handling for the colour CS895CU sensor.
+# Extracts a single colour plane (strided view, no copy) or a half-resolution 2x2 sum.
+
+import numpy as np
+
+# Row/col offset of each colour inside a 2x2 Bayer cell, named by the top-left 2x2 layout
+BAYER_OFFSETS = {
+    'RGGB': {'R': (0, 0), 'G1': (0, 1), 'G2': (1, 0), 'B': (1, 1)},
+    'BGGR': {'B': (0, 0), 'G1': (0, 1), 'G2': (1, 0), 'R': (1, 1)},
+    'GRBG': {'G1': (0, 0), 'R': (0, 1), 'B': (1, 0), 'G2': (1, 1)},
+    'GBRG': {'G1': (0, 0), 'B': (0, 1), 'R': (1, 0), 'G2': (1, 1)},
+}
+
+BAYER_MODES = ('R', 'G', 'B', 'lum')
+
+def _even(raw):
+    # drop a trailing odd row/col so every plane has the same size
+    H, W = raw.shape[-2:]
+    return raw[..., :H - H % 2, :W - W % 2]
+
+def crop_pattern(pattern, roi):
+    """
+    Bayer layout of frames cropped to roi = (x0, y0, x1, y1): an odd x0 / y0 moves the colour phase
+    by one column / row, e.g. RGGB cropped at x0 = 1 is GRBG.
+    """
+    if pattern not in BAYER_OFFSETS:
+        raise ValueError(f"Unknown Bayer pattern: {pattern}")
+    dx, dy = int(roi[0]) % 2, int(roi[1]) % 2
+    return ''.join(pattern[2 * ((r + dy) % 2) + (c + dx) % 2] for r in (0, 1) for c in (0, 1))
+
+def bayer_plane(raw, channel='G', pattern='RGGB'):
+    """
+    One colour plane of a raw frame or stack (..., H, W) as a strided view (H/2, W/2), no data is copied.
+    channel: 'R', 'B', 'G' (same as 'G1') or 'G2'
+    """
+    if pattern not in BAYER_OFFSETS:
+        raise ValueError(f"Unknown Bayer pattern: {pattern}")
+    if channel == 'G':
+        channel = 'G1'
+    dy, dx = BAYER_OFFSETS[pattern][channel]
+    return _even(raw)[..., dy::2, dx::2]
+
+def bayer_luminance(raw, out=None, dtype=None):
+    """
+    Sum of each 2x2 Bayer cell, half resolution (..., H/2, W/2). The output is the only copy made.
+    dtype: output type, default uint16 for uint16 input (enough for the 12-bit sensor data) else float32
+    """
+    raw = _even(raw)
+    if dtype is None:
+        dtype = np.uint16 if raw.dtype == np.uint16 else np.float32
+    planes = [raw[..., 0::2, 0::2], raw[..., 0::2, 1::2], raw[..., 1::2, 0::2], raw[..., 1::2, 1::2]]
+    if out is None:
+        out = np.empty(planes[0].shape, dtype=dtype)
+    np.add(planes[0], planes[1], out=out, dtype=out.dtype, casting='unsafe')
+    np.add(out, planes[2], out=out, casting='unsafe')
+    np.add(out, planes[3], out=out, casting='unsafe')
+    return out
+
+def debayer(raw, mode=None, pattern='RGGB'):
+    """
+    Applies the selected Bayer stage to a frame, stack or list of frames.
+    mode: None (raw mosaic, unchanged), 'R', 'G', 'B' (single plane) or 'lum' (2x2 sum)
+    """
+    if mode is None:
+        return raw
+    if isinstance(raw, (list, tuple)):
+        return [debayer(f, mode, pattern) for f in raw]
+    if mode == 'lum':
+        return bayer_luminance(raw)
+    elif mode in ('R', 'G', 'B'):
+        return bayer_plane(raw, mode, pattern)
+    else:
+        raise ValueError(f"Bayer mode must be None or one of {BAYER_MODES}")
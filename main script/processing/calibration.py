@@ -0,0 +1,137 @@
+# Dark-frame and flat-field correction.
+# Master frames are averaged stacks, stored on disk as versioned .npy files keyed by exposure and
+# sensor geometry. Correction is one fused in-place float32 operation, (frame - dark) * gain,
+# writing into a reused buffer so it can run at full frame rate in the acquisition path.
+
+import os
+import json
+import time
+import numpy as np
+
+from processing.speckle import average_frames
+
+class Calibration:
+    """
+    Applies master dark and flat frames. Either may be None (then it is skipped).
+    gain = mean(flat - dark) / (flat - dark), so the corrected image keeps the mean level of the flat.
+    """
+    def __init__(self, dark=None, flat=None):
+        self.dark = None if dark is None else np.asarray(dark, dtype=np.float32)
+        self.gain = None
+        if flat is not None:
+            f = np.asarray(flat, dtype=np.float32)
+            if self.dark is not None:
+                f = f - self.dark
+            valid = f > 0
+            mean = f[valid].mean() if np.any(valid) else 1.0
+            self.gain = np.ones(f.shape, dtype=np.float32)
+            self.gain[valid] = mean / f[valid]  # dead pixels keep gain 1
+        self._buf = None
+
+    @property
+    def shape(self):
+        ref = self.dark if self.dark is not None else self.gain
+        return None if ref is None else ref.shape
+
+    def apply(self, frame, out=None):
+        """
+        Corrected float32 frame. Without out, an internal buffer is reused, so the result is
+        overwritten by the next call (copy it if it must be kept).
+        """
+        if out is None:
+            if self._buf is None or self._buf.shape != frame.shape:
+                self._buf = np.empty(frame.shape, dtype=np.float32)
+            out = self._buf
+        if self.dark is not None:
+            np.subtract(frame, self.dark, out=out, casting='unsafe')
+        else:
+            out[...] = frame
+        if self.gain is not None:
+            np.multiply(out, self.gain, out=out)
+        return out
+
+    __call__ = apply  # can be used directly as a preprocessing step
+
+    def apply_stack(self, frames):
+        """Corrects a stack (N,H,W) or list of frames into one new float32 stack"""
+        out = np.empty((len(frames),) + tuple(np.shape(frames[0])), dtype=np.float32)
+        for k in range(len(frames)):
+            self.apply(frames[k], out=out[k])
+        return out
+
+class CalibrationStore:
+    """
+    Master dark/flat frames on disk: <root>/<kind>_<key>_v<version>.npy plus a .json with metadata.
+    key is built from exposure and sensor geometry, loaded frames are cached in memory.
+    """
+    KINDS = ('dark', 'flat')
+
+    def __init__(self, root='calibration'):
+        self.root = root
+        self._cache = {}
+
+    @staticmethod
+    def key(exposure_us, geometry=None):
+        key = f"exp{int(round(exposure_us))}us"
+        if geometry is not None:
+            x0, y0, x1, y1 = geometry['roi']
+            key += f"_roi{x0}-{y0}-{x1}-{y1}_bin{geometry['binx']}x{geometry['biny']}"
+        return key
+
+    def _path(self, kind, key, version):
+        return os.path.join(self.root, f"{kind}_{key}_v{version}.npy")
+
+    def versions(self, kind, exposure_us, geometry=None):
+        """Stored versions for this kind/exposure/geometry, oldest first"""
+        prefix = f"{kind}_{self.key(exposure_us, geometry)}_v"
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            if name.startswith(prefix) and name.endswith('.npy'):
+                try:
+                    found.append(int(name[len(prefix):-4]))
+                except ValueError:
+                    pass
+        return sorted(found)
+
+    def save(self, kind, frames, exposure_us, geometry=None, method='mean'):
+        """Averages frames into a master frame and stores it as a new version, returns (master, version)"""
+        if kind not in self.KINDS:
+            raise ValueError(f"kind must be one of {self.KINDS}")
+        master = average_frames(frames, method=method).astype(np.float32)
+        key = self.key(exposure_us, geometry)
+        versions = self.versions(kind, exposure_us, geometry)
+        version = versions[-1] + 1 if versions else 1
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(kind, key, version)
+        np.save(path, master)
+        meta = dict(kind=kind, version=version, exposure_us=exposure_us, geometry=geometry,
+                    n_frames=len(frames), method=method, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        with open(path[:-4] + '.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        self._cache[(kind, key, version)] = master
+        return master, version
+
+    def load(self, kind, exposure_us, geometry=None, version=None):
+        """Master frame (latest version by default), or None if nothing is stored"""
+        if version is None:
+            versions = self.versions(kind, exposure_us, geometry)
+            if not versions:
+                return None
+            version = versions[-1]
+        key = self.key(exposure_us, geometry)
+        if (kind, key, version) not in self._cache:
+            path = self._path(kind, key, version)
+            if not os.path.exists(path):
+                return None
+            self._cache[(kind, key, version)] = np.load(path)
+        return self._cache[(kind, key, version)]
+
+    def calibration(self, exposure_us, geometry=None):
+        """Calibration from the latest stored dark and flat, or None if neither exists"""
+        dark = self.load('dark', exposure_us, geometry)
+        flat = self.load('flat', exposure_us, geometry)
+        if dark is None and flat is None:
+            return None
+        return Calibration(dark, flat)
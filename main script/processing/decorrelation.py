@@ -0,0 +1,121 @@
+# Dynamic speckle decorrelation: temporal intensity autocorrelation g2(tau) and decorrelation time maps.
+# g2(tau) = <I(t) I(t+tau)>_t / <I(t)>_t^2, computed with FFTs along the time axis.
+# Stacks are processed tile by tile so memory stays bounded for thousands of frames (and memmaps).
+
+import numpy as np
+from numpy.fft import rfft, irfft
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def _tile_g2(block, max_lag):
+    """
+    g2 for every pixel of a (N, h, w) block, returns (max_lag+1, h, w).
+    Uses zero padding to 2N so the FFT autocorrelation is linear (not circular),
+    normalised by the number of overlapping frames N - tau for every lag.
+    """
+    N = block.shape[0]
+    I = block.astype(np.float32, copy=False)
+    nfft = 1 << int(np.ceil(np.log2(2 * N)))
+    spec = rfft(I, n=nfft, axis=0)
+    acf = irfft(spec * np.conjugate(spec), n=nfft, axis=0)[:max_lag+1]
+    acf /= (N - np.arange(max_lag+1))[:, None, None]
+    mean = I.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g2 = np.where(mean > 0, acf / mean**2, np.nan)
+    return g2.astype(np.float32)
+
+def _bin_pixels(g2, window):
+    # average g2 over window x window pixel blocks
+    L, h, w = g2.shape
+    hb, wb = h // window, w // window
+    return g2[:, :hb*window, :wb*window].reshape(L, hb, window, wb, window).mean(axis=(2, 4))
+
+def decorrelation_time(g2, lags=None, level=1/np.e):
+    """
+    Decorrelation time from g2 curves (L, ...): first lag where (g2 - 1) drops below
+    level * (g2(1) - 1), linearly interpolated. g2(1) is used as start value since g2(0)
+    also contains the uncorrelated noise. Returns nan where the curve never drops below the level.
+    """
+    if lags is None:
+        lags = np.arange(g2.shape[0], dtype=np.float32)
+    g = g2 - 1.0
+    start = g[1]
+    target = level * start
+    below = g[1:] < target[None]
+    found = below.any(axis=0)
+    k = np.argmax(below, axis=0) + 1  # first lag index below the target
+    k0 = np.maximum(k - 1, 1)
+    gk = np.take_along_axis(g, k[None], axis=0)[0]
+    gk0 = np.take_along_axis(g, k0[None], axis=0)[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(gk0 != gk, (gk0 - target) / (gk0 - gk), 0.0)
+    tau = lags[k0] + np.clip(frac, 0, 1) * (lags[k] - lags[k0])
+    return np.where(found & (start > 0), tau, np.nan).astype(np.float32)
+
+def g2_stack(frames, max_lag=None, window=1, tile=64, n_workers=4, max_tile_bytes=256 * 2**20,
+             return_g2=True):
+    """
+    Temporal intensity autocorrelation of a stack (N, H, W) (array, list or np.memmap).
+    max_lag: largest lag in frames (default N // 2)
+    window: 1 for per-pixel results, otherwise g2 is averaged over window x window pixel blocks
+    tile: tile edge in pixels (rounded to a multiple of window); tiles are shrunk further so that the
+          FFTs of the n_workers tiles in flight stay below max_tile_bytes together. Tiles are processed
+          in parallel by n_workers threads, at most n_workers at a time.
+    return_g2: also return the g2 cube (max_lag+1, H', W'); otherwise only the maps are kept
+    Returns dict with
+        'tau_c': decorrelation time map (frames), 'beta': g2(1) - 1 map,
+        'g2_mean': g2 curve averaged over the image, 'g2': cube or None
+    """
+    if isinstance(frames, (list, tuple)):
+        frames = np.stack(frames)
+    N, H, W = frames.shape
+    if max_lag is None:
+        max_lag = N // 2
+    max_lag = int(min(max_lag, N - 1))
+    if max_lag < 1:
+        raise ValueError("Need at least 2 frames")
+
+    # bound memory: spectrum and its product (complex128) plus the inverse transform, per pixel
+    nfft = 1 << int(np.ceil(np.log2(2 * N)))
+    per_pixel = (nfft // 2 + 1) * 32 + nfft * 8
+    max_pixels = max(window * window, max_tile_bytes // max(1, n_workers) // per_pixel)
+    tile = max(window, (min(tile, int(np.sqrt(max_pixels))) // window) * window)
+
+    Hb, Wb = H // window, W // window
+    tau_c = np.full((Hb, Wb), np.nan, dtype=np.float32)
+    beta = np.full((Hb, Wb), np.nan, dtype=np.float32)
+    g2_cube = np.zeros((max_lag+1, Hb, Wb), dtype=np.float32) if return_g2 else None
+    g2_sum = np.zeros(max_lag+1, dtype=np.float64)
+    count = np.zeros(max_lag+1, dtype=np.int64)
+
+    def run(r0, c0):
+        block = np.asarray(frames[:, r0:r0+tile, c0:c0+tile])  # only this tile is read from a memmap
+        g2 = _tile_g2(block, max_lag)
+        if window > 1:
+            g2 = _bin_pixels(g2, window)
+        return r0 // window, c0 // window, g2
+
+    def store(br, bc, g2):
+        nonlocal g2_sum, count
+        h, w = g2.shape[1:]
+        tau_c[br:br+h, bc:bc+w] = decorrelation_time(g2)
+        beta[br:br+h, bc:bc+w] = g2[1] - 1.0
+        if g2_cube is not None:
+            g2_cube[:, br:br+h, bc:bc+w] = g2
+        finite = np.isfinite(g2)
+        g2_sum += np.where(finite, g2, 0).sum(axis=(1, 2))
+        count += finite.sum(axis=(1, 2))
+
+    # at most n_workers tiles in flight, the oldest is stored before the next one is submitted
+    tiles = [(r0, c0) for r0 in range(0, Hb * window, tile) for c0 in range(0, Wb * window, tile)]
+    with ThreadPoolExecutor(max_workers=n_workers) as ex:
+        in_flight = deque()
+        for r0, c0 in tiles:
+            if len(in_flight) >= n_workers:
+                store(*in_flight.popleft().result())
+            in_flight.append(ex.submit(run, r0, c0))
+        while in_flight:
+            store(*in_flight.popleft().result())
+
+    g2_mean = (g2_sum / np.maximum(count, 1)).astype(np.float32)
+    return {'tau_c': tau_c, 'beta': beta, 'g2_mean': g2_mean, 'g2': g2_cube}
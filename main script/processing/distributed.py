@@ -0,0 +1,537 @@
+# Distributed execution of SpeckleProcessor over TCP, for reprocessing many datasets on several machines.
+#
+# A Coordinator listens for workers (run_worker, one process per core on every machine, or
+# start_local_workers for several processes on this one). Datasets are split into jobs of a band of
+# grid rows (and, for time series, a chunk of object frames). Jobs only name the data: workers read the
+# frames from shared storage by path, frame range and pixel rows (.s12 recordings or .npy files, both
+# memmapped), so no images are sent over the network. Results come back per job and are written into
+# the u/c/e (and sc) arrays as they arrive, the arrays can be memmaps.
+#
+# Protocol: a connection starts with a mutual HMAC-SHA256 challenge-response on a shared authkey
+# (raw bytes, nothing is unpickled before both sides are authenticated). After that every message is
+# an 8 byte little endian length followed by a pickled dict with a 'type' ('hello', 'setup', 'job',
+# 'result', 'error' or 'stop'). The coordinator listens on 127.0.0.1 unless a host is given.
+#
+# A job whose worker disconnects or does not answer within task_timeout is sent to another worker,
+# a job that failed max_attempts times gets e = 1 for its windows (like a failed window in
+# SpeckleProcessor.process). A run fails with an error when no worker is connected for
+# worker_timeout seconds while jobs are pending. Results are the same as SpeckleProcessor.process / process_series;
+# pre_register, validate, adaptive and quality_metrics are not applied.
+
+import hashlib
+import hmac
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import secrets
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from camera.recording import Recording
+from processing.speckle import (SpeckleProcessor, average_frames, temporal_contrast, select_windows,
+                                process_window_batch, process_window_series, extract_window)
+
+DEFAULT_PORT = 5555
+_LENGTH = struct.Struct('<Q')
+_NONCE_BYTES = 32
+
+# ---- messages ----
+def send_message(sock, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_LENGTH.pack(len(data)))
+    sock.sendall(data)
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = sock.recv_into(view[pos:])
+        if k == 0:
+            raise EOFError("Connection closed")
+        pos += k
+    return buf
+
+def recv_message(sock):
+    (n,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return pickle.loads(_recv_exact(sock, n))
+
+def _digest(authkey, role, nonce):
+    return hmac.new(authkey, role + nonce, hashlib.sha256).digest()
+
+def authenticate(sock, authkey, role, peer_role):
+    """
+    Mutual challenge-response: both sides send a random nonce and answer the other's with
+    HMAC(authkey, role + nonce). The role (b'coordinator' / b'worker') keeps a peer from passing
+    by reflecting a challenge back. Raises multiprocessing.AuthenticationError on a wrong key.
+    """
+    nonce = os.urandom(_NONCE_BYTES)
+    sock.sendall(nonce)
+    peer_nonce = _recv_exact(sock, _NONCE_BYTES)
+    sock.sendall(_digest(authkey, role, bytes(peer_nonce)))
+    answer = _recv_exact(sock, hashlib.sha256().digest_size)
+    if not hmac.compare_digest(bytes(answer), _digest(authkey, peer_role, nonce)):
+        raise multiprocessing.AuthenticationError("Peer does not know the authkey")
+
+# ---- data sources ----
+def open_source(source):
+    """
+    (frames, start, stop) of a data source: path of a .s12 recording or .npy file (memmapped),
+    or (path, start, stop) for a frame range of one (stop None for the end)
+    """
+    if isinstance(source, (tuple, list)):
+        path, start, stop = source
+    else:
+        path, start, stop = source, 0, None
+    frames = np.load(path, mmap_mode='r') if str(path).endswith('.npy') else Recording(path)
+    stop = len(frames) if stop is None else min(stop, len(frames))
+    return frames, start, stop
+
+def source_shape(source):
+    """(N, H, W) of a data source"""
+    frames, start, stop = open_source(source)
+    try:
+        return (stop - start,) + tuple(frames.shape[1:])
+    finally:
+        if isinstance(frames, Recording):
+            frames.close()
+
+def load_frames(source, frames=None, rows=None):
+    """
+    Reads frames (f0, f1) (relative to the source's range, default all) and pixel rows (r0, r1)
+    (default all) of a source into an (f1 - f0, r1 - r0, W) array. Only these are read from storage.
+    """
+    stack, start, stop = open_source(source)
+    f0, f1 = (0, stop - start) if frames is None else frames
+    r0, r1 = (0, stack.shape[1]) if rows is None else rows
+    try:
+        return np.array(stack[start + f0:start + min(f1, stop - start), r0:r1])
+    finally:
+        if isinstance(stack, Recording):
+            stack.close()
+
+# ---- worker ----
+def _read(proc, source, frames, rows):
+    # frames and pixel rows of a source after the processor's calibration, geometry and Bayer stages.
+    # Without these stages only the rows asked for are read, otherwise whole frames are prepared.
+    if proc.calibration is None and proc.geometry is None and proc.bayer is None:
+        return load_frames(source, frames, rows)
+    return np.asarray(proc.prepare_stack(load_frames(source, frames)))[:, rows[0]:rows[1]]
+
+def _reference(proc, job, cache):
+    # averaged reference rows, kept for the following jobs of the same band
+    key = (repr(job['ref']), job['rows'], job['method'])
+    if key not in cache:
+        if len(cache) >= 8:
+            cache.clear()
+        cache[key] = average_frames(_read(proc, job['ref'], None, job['rows']), method=job['method'], dtype=proc.dtype)
+    return cache[key]
+
+def field_job(proc, job, cache):
+    """Windows of one band of SpeckleProcessor.process and the temporal contrast of its sc rows"""
+    p0, p1 = job['rows']
+    Iref = _reference(proc, job, cache)
+    stack = _read(proc, job['obj'], None, job['rows'])
+    Iobj = average_frames(stack, method=job['method'], dtype=proc.dtype)
+    centres = [(rr - p0, cc) for rr, cc in job['centres']]
+    results = process_window_batch(Iref, Iobj, centres, proc.M, **proc.correlation_options())
+    s0, s1 = job['sc_rows']
+    return {'u': np.array([r[0] for r in results], dtype=np.complex64),
+            'c': np.array([r[1] for r in results], dtype=np.float32),
+            'e': np.array([r[2] for r in results], dtype=np.int8),
+            'sc': temporal_contrast(stack[:, s0 - p0:s1 - p0], dtype=proc.dtype)}
+
+def series_job(proc, job, cache):
+    """Windows of one band over one chunk of object frames, like SpeckleProcessor.process_series"""
+    p0, p1 = job['rows']
+    M = proc.M
+    Iref = _reference(proc, job, cache)
+    frames = _read(proc, job['obj'], job['frames'], job['rows'])
+    k = job['k']
+    if k > 1:
+        frames = frames.reshape((-1, k) + frames.shape[1:]).mean(axis=1, dtype=proc.dtype)
+    corners = [(rr - p0 - M//2, cc - M//2) for rr, cc in job['centres']]
+    I1_wins = np.stack([extract_window(Iref, r0, c0, M) for r0, c0 in corners])
+    I2_wins = np.stack([extract_window(frames, r0, c0, M) for r0, c0 in corners])
+    u, c, e = process_window_series(I1_wins, I2_wins, **proc.correlation_options())
+    return {'u': u, 'c': c, 'e': e}
+
+JOB_KINDS = {'field': field_job, 'series': series_job}
+
+def _work(conn):
+    # runs jobs on one connection, True when the coordinator sent stop
+    processors = {}
+    cache = {}
+    while True:
+        message = recv_message(conn)
+        if message['type'] == 'stop':
+            return True
+        if message['type'] == 'setup':
+            processors = {message['run']: message['processor']}
+            cache.clear()
+            continue
+        try:
+            result = JOB_KINDS[message['kind']](processors[message['run']], message, cache)
+            reply = dict(result, type='result', id=message['id'])
+        except Exception as exc:
+            reply = {'type': 'error', 'id': message['id'], 'message': f"{type(exc).__name__}: {exc}"}
+        send_message(conn, reply)
+
+def run_worker(host, port=DEFAULT_PORT, authkey=None, name=None, retry_interval=2.0):
+    """
+    Worker main loop: connects to the coordinator at (host, port) and runs jobs until it is told to stop.
+    authkey: key shared with the coordinator (bytes), a wrong key raises multiprocessing.AuthenticationError
+    While the coordinator is not reachable or the connection drops, it tries again every retry_interval
+    seconds, so workers can be started before the coordinator (retry_interval None: return instead).
+    """
+    if not authkey:
+        raise ValueError("authkey is required")
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            with socket.create_connection((host, port)) as conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.settimeout(30.0)
+                authenticate(conn, authkey, b'worker', b'coordinator')
+                conn.settimeout(None)
+                send_message(conn, {'type': 'hello', 'name': name})
+                if _work(conn):
+                    return
+        except (OSError, EOFError):
+            pass
+        if retry_interval is None:
+            return
+        time.sleep(retry_interval)
+
+def start_local_workers(n, host='127.0.0.1', port=DEFAULT_PORT, authkey=None):
+    """
+    Starts n worker processes on this machine, they exit on the coordinator's stop (or with this process).
+    authkey: the coordinator's key (Coordinator.authkey)
+    """
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=run_worker, args=(host, port, authkey), kwargs={'retry_interval': 0.2},
+                           daemon=True)
+               for _ in range(n)]
+    for w in workers:
+        w.start()
+    return workers
+
+# ---- coordinator ----
+class Coordinator:
+    """
+    Hands out jobs to the workers connected on (host, port) and writes their results into the fields.
+    processor: SpeckleProcessor with the settings for the workers (sent once per run and worker)
+    host: interface to listen on, 127.0.0.1 (default) only accepts local workers, '0.0.0.0' all
+    authkey: key workers must prove they know (bytes), None makes a random one (see authkey), which
+             only workers started with it (e.g. start_local_workers) can use
+    rows_per_job: grid rows per job, chunk_frames: object frames per job in process_series
+    task_timeout: seconds a worker may take for one job before it is dropped and the job sent elsewhere
+    max_attempts: attempts per job before its windows are marked as failed
+    worker_timeout: seconds without any connected worker while jobs are pending before a run fails
+                    with RuntimeError (None waits for workers indefinitely)
+    log: callable for worker and retry messages (e.g. print), None for silent
+    Use as a context manager or call start() and close(). port 0 picks a free port (see address).
+    """
+    def __init__(self, processor=None, host='127.0.0.1', port=DEFAULT_PORT, authkey=None, rows_per_job=2,
+                 chunk_frames=64, task_timeout=600.0, max_attempts=3, worker_timeout=60.0, log=None):
+        self.processor = processor if processor is not None else SpeckleProcessor()
+        self.host = host
+        self.port = port
+        self.authkey = authkey or secrets.token_bytes(32)
+        self.rows_per_job = max(1, int(rows_per_job))
+        self.chunk_frames = chunk_frames
+        self.task_timeout = task_timeout
+        self.max_attempts = max_attempts
+        self.worker_timeout = worker_timeout
+        self.log = log
+        self.failed_jobs = 0  # jobs of the last run that failed max_attempts times
+
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._ids = itertools.count()
+        self._attempts = {}
+        self._setups = {}
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._handlers = []
+        self._listener = None
+        self._accept_thread = None
+        self._closing = False
+
+    # ---- connections ----
+    def start(self):
+        self._listener = socket.create_server((self.host, self.port))
+        self.port = self._listener.getsockname()[1]
+        self._accept_thread = threading.Thread(target=self._accept, daemon=True)
+        self._accept_thread.start()
+        return self
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    @property
+    def n_workers(self):
+        with self._lock:
+            return len(self._workers)
+
+    def wait_for_workers(self, n, timeout=None):
+        """Blocks until n workers are connected, returns False on timeout"""
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        while self.n_workers < n:
+            if t_end is not None and time.perf_counter() > t_end:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _accept(self):
+        while not self._closing:
+            try:
+                conn, addr = self._listener.accept()
+            except OSError:
+                return
+            t = threading.Thread(target=self._serve, args=(conn, addr), daemon=True)
+            self._handlers.append(t)
+            t.start()
+
+    def _say(self, text):
+        if self.log:
+            self.log(text)
+
+    def _serve(self, conn, addr):
+        # one thread per worker: sends the next job, waits for its reply
+        name = f"{addr[0]}:{addr[1]}"
+        sent_run = None
+        try:
+            conn.settimeout(30.0)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            authenticate(conn, self.authkey, b'coordinator', b'worker')
+            name = recv_message(conn).get('name', name)
+        except multiprocessing.AuthenticationError:
+            self._say(f"connection from {name} rejected (authentication failed)")
+            conn.close()
+            return
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            conn.close()
+            return
+        with self._lock:
+            self._workers.add(name)
+        self._say(f"worker {name} connected")
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    send_message(conn, {'type': 'stop'})
+                    return
+                try:
+                    conn.settimeout(self.task_timeout)
+                    if job['run'] != sent_run:
+                        send_message(conn, self._setups[job['run']])
+                        sent_run = job['run']
+                    send_message(conn, job)
+                    reply = recv_message(conn)
+                except (OSError, EOFError, pickle.UnpicklingError) as exc:
+                    self._retry(job, f"worker {name} lost ({type(exc).__name__})")
+                    return
+                if reply['type'] == 'error':
+                    self._retry(job, f"worker {name}: {reply['message']}")
+                else:
+                    self._results.put((job['id'], reply))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            with self._lock:
+                self._workers.discard(name)
+            self._say(f"worker {name} disconnected")
+
+    def _retry(self, job, reason):
+        n = self._attempts.get(job['id'], 0) + 1
+        self._attempts[job['id']] = n
+        if n >= self.max_attempts:
+            self._say(f"job {job['id']} failed {n} times, last: {reason}")
+            self._results.put((job['id'], None))
+        else:
+            self._say(f"job {job['id']} retried, {reason}")
+            self._jobs.put(job)
+
+    def _drop_jobs(self):
+        # removes the queued jobs of a failed run
+        while True:
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        """Stops the connected workers and the listener"""
+        self._closing = True
+        for _ in range(self.n_workers):
+            self._jobs.put(None)
+        if self._listener is not None:
+            self._listener.close()
+        for t in self._handlers:
+            t.join(timeout=5.0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, jobs):
+        """Queues jobs [(message, on_result)] and calls on_result(reply, or None if it failed) as they finish"""
+        run = next(self._ids)
+        self._setups = {run: {'type': 'setup', 'run': run, 'processor': self.processor}}
+        self._attempts = {}
+        self.failed_jobs = 0
+        pending = {}
+        for message, on_result in jobs:
+            message = dict(message, type='job', id=next(self._ids), run=run)
+            pending[message['id']] = on_result
+            self._jobs.put(message)
+        if pending and self.n_workers == 0:
+            self._say("waiting for workers")
+        last_worker = time.perf_counter()
+        while pending:
+            try:
+                job_id, reply = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if self.n_workers > 0 or self.worker_timeout is None:
+                    last_worker = time.perf_counter()
+                elif time.perf_counter() - last_worker > self.worker_timeout:
+                    self._drop_jobs()
+                    raise RuntimeError(f"No worker connected for {self.worker_timeout:g} s, "
+                                       f"{len(pending)} jobs not done")
+                continue
+            on_result = pending.pop(job_id, None)
+            if on_result is None:
+                continue  # late duplicate of a retried job
+            if reply is None:
+                self.failed_jobs += 1
+            on_result(reply)
+
+    # ---- job planning ----
+    def prepared_shape(self, source):
+        """(H, W) of the frames of a source after the processor's stages"""
+        proc = self.processor
+        if proc.calibration is None and proc.geometry is None and proc.bayer is None:
+            return source_shape(source)[1:]
+        return np.shape(proc.prepare_stack(load_frames(source, (0, 1))))[1:]
+
+    def _bands(self, rows, tasks, H):
+        """
+        Splits the grid in bands of rows_per_job grid rows.
+        Returns [(task indices, centres, rows to read (p0, p1), sc rows (s0, s1))]
+        """
+        M = self.processor.M
+        groups = [range(i, i + self.rows_per_job) for i in range(0, len(rows), self.rows_per_job)]
+        bands = []
+        for g, group in enumerate(groups):
+            ks = [k for k, t in enumerate(tasks) if t[0] in group]
+            s0, s1 = H * g // len(groups), H * (g + 1) // len(groups)
+            p0 = max(0, min([s0] + [tasks[k][2] - M//2 for k in ks]))
+            p1 = min(H, max([s1] + [tasks[k][2] - M//2 + M for k in ks]))
+            bands.append((ks, [(tasks[k][2], tasks[k][3]) for k in ks], (p0, p1), (s0, s1)))
+        return bands
+
+    # ---- processing ----
+    def process_datasets(self, pairs, method='mean', mask=None):
+        """
+        SpeckleProcessor.process for several (Iref_source, Iobj_source) pairs, with the jobs of all pairs
+        in one queue. Sources: see open_source, readable by every worker under the same path.
+        Returns list of (u_image, c_image, e_image, sc_image, rows, cols); sc is nan in failed bands.
+        """
+        proc = self.processor
+        if mask is None:
+            mask = proc.mask
+        results = []
+        jobs = []
+        for ref, obj in pairs:
+            H, W = self.prepared_shape(ref)
+            rows, cols = proc.grid(H, W)
+            tasks = select_windows(rows, cols, mask)
+            u = np.full((len(rows), len(cols)), np.nan, dtype=np.complex64)
+            c = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            e = np.full((len(rows), len(cols)), -1, dtype=np.int8)
+            sc = np.full((H, W), np.nan, dtype=np.float32 if proc.dtype is None else proc.dtype)
+            results.append((u, c, e, sc, rows, cols))
+            for ks, centres, band_rows, sc_rows in self._bands(rows, tasks, H):
+                ir = np.array([tasks[k][0] for k in ks], dtype=int)
+                ic = np.array([tasks[k][1] for k in ks], dtype=int)
+
+                def store(reply, ir=ir, ic=ic, fields=(u, c, e, sc), sc_rows=sc_rows):
+                    u, c, e, sc = fields
+                    if reply is None:
+                        u[ir, ic], c[ir, ic], e[ir, ic] = 0, 0, 1
+                        return
+                    u[ir, ic], c[ir, ic], e[ir, ic] = reply['u'], reply['c'], reply['e']
+                    sc[sc_rows[0]:sc_rows[1]] = reply['sc']
+
+                message = dict(kind='field', ref=ref, obj=obj, method=method, centres=centres,
+                               rows=band_rows, sc_rows=sc_rows)
+                jobs.append((message, store))
+        self._run(jobs)
+        return results
+
+    def process(self, Iref_source, Iobj_source, method='mean', mask=None):
+        """Like SpeckleProcessor.process on the workers, for sources instead of stacks"""
+        return self.process_datasets([(Iref_source, Iobj_source)], method, mask)[0]
+
+    def process_series(self, Iref_source, Iobj_source, k=1, method='mean', mask=None, out=None):
+        """
+        Like SpeckleProcessor.process_series on the workers, jobs are a band of grid rows over
+        chunk_frames object frames.
+        out: optional (u_series, c_series, e_series) arrays of shape (N//k, nrows, ncols) to write into,
+             e.g. memmaps from np.lib.format.open_memmap for long series
+        Returns: u_series, c_series, e_series, rows, cols
+        """
+        proc = self.processor
+        if mask is None:
+            mask = proc.mask
+        H, W = self.prepared_shape(Iref_source)
+        rows, cols = proc.grid(H, W)
+        tasks = select_windows(rows, cols, mask)
+        nsteps = source_shape(Iobj_source)[0] // k
+        shape = (nsteps, len(rows), len(cols))
+        if out is None:
+            u = np.empty(shape, dtype=np.complex64)
+            c = np.empty(shape, dtype=np.float32)
+            e = np.empty(shape, dtype=np.int8)
+        else:
+            u, c, e = out
+            if u.shape != shape or c.shape != shape or e.shape != shape:
+                raise ValueError(f"out arrays must have shape {shape}")
+        u[...] = np.nan
+        c[...] = 0
+        e[...] = -1
+
+        chunk = max(1, self.chunk_frames // k) * k  # whole k-groups per chunk
+        jobs = []
+        for ks, centres, band_rows, _ in self._bands(rows, tasks, H):
+            if not ks:
+                continue
+            ir = np.array([tasks[n][0] for n in ks], dtype=int)
+            ic = np.array([tasks[n][1] for n in ks], dtype=int)
+            for f0 in range(0, nsteps * k, chunk):
+                f1 = min(f0 + chunk, nsteps * k)
+
+                def store(reply, ir=ir, ic=ic, s0=f0 // k, s1=f1 // k):
+                    if reply is None:
+                        u[s0:s1, ir, ic], c[s0:s1, ir, ic], e[s0:s1, ir, ic] = 0, 0, 1
+                        return
+                    u[s0:s1, ir, ic] = reply['u'].T
+                    c[s0:s1, ir, ic] = reply['c'].T
+                    e[s0:s1, ir, ic] = reply['e'].T
+
+                message = dict(kind='series', ref=Iref_source, obj=Iobj_source, method=method, k=k,
+                               frames=(f0, f1), centres=centres, rows=band_rows)
+                jobs.append((message, store))
+        self._run(jobs)
+        return u, c, e, rows, cols
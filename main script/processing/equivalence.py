@@ -0,0 +1,251 @@
+# Equivalence checks of the processing chain against the frozen reference (processing.reference).
+# Synthetic speckle pairs with known shifts are processed by every backend, i.e. every combination of
+# precision policy (dtype), correlation engine (corr_mode + subpixel method) and executor, and the
+# results are compared to the reference with the explicit tolerances below.
+#
+# Which windows are compared: the reference flags most windows with fractional shifts as failed
+# (e = 1, its in-window roll wraps speckle around, see processing.reference). Integer shifts are
+# therefore made on speckle repeating every M pixels, where that roll is exact and the reference
+# solves them. A check fails when fewer than MIN_COMPARED of all windows are solved by both.
+# The reference algorithm must reproduce the e flags (and on the bit identical path u / c of the failed
+# windows as well).
+# Other engines only have to reproduce the windows the reference solved; windows they solve in
+# addition are reported as 'recovered' and checked against the true shift instead.
+
+import time
+
+import numpy as np
+
+from processing import reference
+from processing.speckle import (SpeckleProcessor, average_frames, temporal_contrast, fftcorr_subwindow,
+                                process_window_batch, extract_window)
+from processing.subpixel_refinement import subpixel_chebyshev
+from processing.synthetic import speckle_pair
+
+PRECISIONS = {'mixed': None, 'float64': np.float64, 'float32': np.float32}
+
+# (name, SpeckleProcessor keyword arguments); 'zmcc chebyshev' is the reference algorithm
+ENGINES = [
+    ('zmcc chebyshev', dict(corr_mode='zmcc', subpixel='chebyshev')),
+    ('zmcc gradient', dict(corr_mode='zmcc', subpixel='gradient')),
+    ('zncc', dict(corr_mode='zncc')),
+    ('phase', dict(corr_mode='phase')),
+    ('phase gradient', dict(corr_mode='phase', subpixel='gradient')),
+]
+
+# serial:  process_window_batch over the whole grid in this process
+# windows: SpeckleProcessor.process, one window per process pool task
+# batches: SpeckleProcessor.process with adaptive batching at a single window size
+EXECUTORS = ('serial', 'windows', 'batches')
+
+# Tolerances, absolute. u in pixels, c and sc (temporal contrast) unitless.
+# The reference algorithm has to match closely, tighter for the original mixed precision path
+# (bit identical); other engines are different estimators and get the u tolerance of their accuracy.
+# c is only compared for zmcc, the other engines normalise the map differently.
+# e: fraction of the reference's solved windows a backend may flag as failed.
+# flags: e has to equal the reference's (reference algorithm).
+# failed: u / c of the reference's failed windows are compared too. Only for the bit identical path, the
+# diverged iterations of a failed window turn rounding differences into pixels.
+# truth: median |u - true shift| over all windows a backend solved.
+TOLERANCES = {
+    ('zmcc chebyshev', 'mixed'): dict(u=0.0, c=0.0, sc=0.0, e=0.0, flags=True, failed=True, truth=0.05),
+    ('zmcc chebyshev', 'float64'): dict(u=1e-5, c=1e-6, sc=1e-6, e=0.0, flags=True, failed=False, truth=0.05),
+    ('zmcc chebyshev', 'float32'): dict(u=1e-4, c=1e-5, sc=1e-5, e=0.0, flags=True, failed=False, truth=0.05),
+    'zmcc': dict(u=0.05, c=2e-2, sc=1e-4, e=0.02, flags=False, failed=False, truth=0.05),
+    'other': dict(u=0.05, c=None, sc=1e-4, e=0.02, flags=False, failed=False, truth=0.05),
+}
+
+# smallest fraction of all windows that has to be solved by the reference and a backend
+MIN_COMPARED = 0.5
+
+# component comparisons on single windows, max abs difference per precision
+COMPONENT_TOLERANCES = {
+    'fftcorr_subwindow': {'mixed': 0.0, 'float64': 1e-6, 'float32': 1e-5},
+    'subpixel_chebyshev': {'mixed': 0.0, 'float64': 1e-9, 'float32': 1e-4},
+    'temporal_contrast': {'mixed': 0.0, 'float64': 1e-5, 'float32': 1e-4},
+}
+
+DEFAULT_SHIFTS = [(0, 0), (3, -2), (-5, 4), (7, 1), (-3, 2), (5, 3), (1.5, 0.5), (-2.25, 4.75)]
+
+def tolerances(engine, precision):
+    if (engine, precision) in TOLERANCES:
+        return TOLERANCES[(engine, precision)]
+    return TOLERANCES['zmcc' if engine.startswith('zmcc') else 'other']
+
+def make_cases(size=256, shifts=None, n_frames=4, seed=0, M=None):
+    """
+    Synthetic cases [(shift, Iref_stack, Iobj_stack)], one speckle pattern per shift.
+    M: window size, integer shifts then get speckle repeating every M pixels (solved by the reference)
+    """
+    rng = np.random.default_rng(seed)
+    shifts = DEFAULT_SHIFTS if shifts is None else shifts
+    cases = []
+    for shift in shifts:
+        period = M if M is not None and all(float(s).is_integer() for s in shift) else None
+        cases.append((shift,) + speckle_pair(size, size, shift, n_frames, rng=rng, period=period))
+    return cases
+
+def reference_fields(cases, M):
+    """reference.process for every case, (u, c, e, sc) per case"""
+    return [reference.process(ref, obj, M)[:4] for _, ref, obj in cases]
+
+# ---- backends ----
+def run_serial(proc, Iref_stack, Iobj_stack):
+    """SpeckleProcessor.process without a process pool"""
+    Iref = average_frames(Iref_stack, dtype=proc.dtype)
+    Iobj = average_frames(Iobj_stack, dtype=proc.dtype)
+    sc = temporal_contrast(Iobj_stack, dtype=proc.dtype)
+    rows, cols = proc.grid(*Iref.shape)
+    centres = [(rr, cc) for rr in rows for cc in cols]
+    results = process_window_batch(Iref, Iobj, centres, proc.M, **proc.correlation_options())
+    shape = (len(rows), len(cols))
+    u = np.array([r[0] for r in results], dtype=np.complex64).reshape(shape)
+    c = np.array([r[1] for r in results], dtype=np.float32).reshape(shape)
+    e = np.array([r[2] for r in results], dtype=np.int8).reshape(shape)
+    return u, c, e, sc
+
+def make_processor(M, engine_kwargs, precision, executor, n_workers=4):
+    kwargs = dict(engine_kwargs, dtype=PRECISIONS[precision])
+    if executor == 'batches':
+        kwargs.update(adaptive=True, window_sizes=(M,), contrast_limits=())
+    return SpeckleProcessor(M=M, n_workers=n_workers, **kwargs)
+
+def run_backend(cases, M, engine_kwargs, precision, executor, n_workers=4):
+    """Fields (u, c, e, sc) per case and the total processing time"""
+    proc = make_processor(M, engine_kwargs, precision, executor, n_workers)
+    fields = []
+    t0 = time.perf_counter()
+    for _, ref, obj in cases:
+        if executor == 'serial':
+            fields.append(run_serial(proc, ref, obj))
+        else:
+            fields.append(proc.process(ref, obj)[:4])
+    return fields, time.perf_counter() - t0
+
+def _max_diff(parts):
+    # largest difference of all parts, NaN if any difference is NaN (a NaN must not pass a check)
+    parts = [p for p in parts if p.size]
+    return float(np.max(np.concatenate(parts))) if parts else 0.0
+
+def compare_fields(cases, ref_fields, fields, tol, min_compared=MIN_COMPARED):
+    """Differences of one backend to the reference, with passed and the reasons it failed"""
+    du, dc, dsc = [], [], []
+    lost = solved_ref = recovered = compared = windows = 0
+    truth_err = []
+    for (shift, _, _), (u0, c0, e0, sc0), (u, c, e, sc) in zip(cases, ref_fields, fields):
+        true = shift[0] + 1j*shift[1]
+        both = (e0 == 0) & (e == 0)
+        windows += e0.size
+        compared += int(np.sum(both))
+        solved_ref += int(np.sum(e0 == 0))
+        lost += int(np.sum((e0 == 0) & (e != 0)))
+        recovered += int(np.sum((e0 != 0) & (e == 0)))
+        same = (e0 == e) if tol['failed'] else both
+        du.append(np.abs(u[same].astype(complex) - u0[same]))
+        dc.append(np.abs(c[same].astype(float) - c0[same]))
+        dsc.append(np.abs(sc.astype(float) - sc0).ravel())
+        truth_err.extend(np.abs(u[e == 0].astype(complex) - true))
+    du, dc, dsc = _max_diff(du), _max_diff(dc), _max_diff(dsc)
+    truth = float(np.median(truth_err)) if truth_err else np.nan
+    reasons = []
+    if not du <= tol['u']:
+        reasons.append(f"u differs by {du:.3g} px > {tol['u']:g}")
+    if tol['c'] is not None and not dc <= tol['c']:
+        reasons.append(f"c differs by {dc:.3g} > {tol['c']:g}")
+    if not dsc <= tol['sc']:
+        reasons.append(f"sc differs by {dsc:.3g} > {tol['sc']:g}")
+    if solved_ref and lost / solved_ref > tol['e']:
+        reasons.append(f"{lost} of {solved_ref} reference windows failed")
+    if tol['flags'] and (lost or recovered):
+        reasons.append(f"e differs from the reference in {lost + recovered} windows")
+    if compared < min_compared * windows:
+        reasons.append(f"only {compared} of {windows} windows compared < {min_compared:.0%}")
+    if not truth_err or not truth <= tol['truth']:
+        reasons.append(f"median error to the true shift {truth:.3g} px > {tol['truth']:g}")
+    return dict(du=du, dc=dc, dsc=dsc, compared=compared, windows=windows, lost=lost, recovered=recovered,
+                truth=truth, passed=not reasons, reasons=reasons)
+
+def check_backends(cases, M, engines=None, precisions=None, executors=None, n_workers=4, log=print):
+    """
+    Runs every engine/precision/executor combination on cases and compares it to the reference.
+    Returns a list of result dicts (engine, precision, executor, seconds + compare_fields keys).
+    """
+    engines = ENGINES if engines is None else [(n, k) for n, k in ENGINES if n in engines]
+    precisions = list(PRECISIONS) if precisions is None else precisions
+    executors = EXECUTORS if executors is None else executors
+    t0 = time.perf_counter()
+    ref_fields = reference_fields(cases, M)
+    if log:
+        log(f"reference: {time.perf_counter() - t0:.2f} s")
+    results = []
+    for name, kwargs in engines:
+        for precision in precisions:
+            for executor in executors:
+                fields, seconds = run_backend(cases, M, kwargs, precision, executor, n_workers)
+                result = dict(engine=name, precision=precision, executor=executor, seconds=seconds)
+                result.update(compare_fields(cases, ref_fields, fields, tolerances(name, precision)))
+                results.append(result)
+                if log:
+                    log(format_result(result))
+    return results
+
+def fastest_passing(results):
+    """Fastest backend that passed, None if none did"""
+    passed = [r for r in results if r['passed']]
+    return min(passed, key=lambda r: r['seconds']) if passed else None
+
+def format_result(r):
+    status = 'ok  ' if r['passed'] else 'FAIL'
+    line = (f"{status} {r['engine']:>15} {r['precision']:>8} {r['executor']:>8} {r['seconds']:7.2f} s"
+            f"  du {r['du']:.2e}  dc {r['dc']:.2e}  dsc {r['dsc']:.2e}  compared {r['compared']}/{r['windows']}"
+            f"  lost {r['lost']}  recovered {r['recovered']}  |u-true| {r['truth']:.4f}")
+    if r['reasons']:
+        line += "  (" + "; ".join(r['reasons']) + ")"
+    return line
+
+# ---- single components ----
+def check_components(cases, M, precisions=None, n_windows=16, seed=0, log=print):
+    """
+    fftcorr_subwindow, subpixel_chebyshev and temporal_contrast against the reference on windows and
+    stacks of cases. Returns list of dicts (component, precision, max_diff, tol, passed).
+    """
+    rng = np.random.default_rng(seed)
+    precisions = list(PRECISIONS) if precisions is None else precisions
+    pairs = []
+    for _, ref, obj in cases:
+        Iref = ref.mean(axis=0)
+        Iobj = obj.mean(axis=0)
+        H, W = Iref.shape
+        for _ in range(max(1, n_windows // len(cases))):
+            r0, c0 = rng.integers(0, H - M), rng.integers(0, W - M)
+            pairs.append((extract_window(Iref, r0, c0, M), extract_window(Iobj, r0, c0, M)))
+    results = []
+    for precision in precisions:
+        dtype = PRECISIONS[precision]
+        wdtype = np.float32 if dtype is None else dtype
+
+        diff = 0.0
+        cheb = 0.0
+        for I1, I2 in pairs:
+            c0 = reference.fftcorr_subwindow(I1.astype(np.float32), I2.astype(np.float32))
+            c = fftcorr_subwindow(I1.astype(wdtype), I2.astype(wdtype), dtype=dtype)
+            diff = max(diff, float(np.max(np.abs(c - c0))))
+            # 3x3 patch around the reference peak, like process_window
+            r, col = np.unravel_index(np.argmax(c0), c0.shape)
+            if 0 < r < c0.shape[0] - 1 and 0 < col < c0.shape[1] - 1:
+                dn0, C0 = reference.subpixel_chebyshev(c0[r-1:r+2, col-1:col+2])
+                patch = c0[r-1:r+2, col-1:col+2]
+                dn, C = subpixel_chebyshev(patch if dtype is None else patch.astype(dtype), dtype)
+                cheb = max(cheb, float(np.max(np.abs(dn - dn0))), abs(float(C - C0)))
+        sc = max(float(np.max(np.abs(temporal_contrast(obj, dtype=dtype) - reference.temporal_contrast(obj))))
+                 for _, _, obj in cases)
+
+        for component, value in (('fftcorr_subwindow', diff), ('subpixel_chebyshev', cheb),
+                                 ('temporal_contrast', sc)):
+            tol = COMPONENT_TOLERANCES[component][precision]
+            result = dict(component=component, precision=precision, max_diff=value, tol=tol, passed=value <= tol)
+            results.append(result)
+            if log:
+                log(f"{'ok  ' if result['passed'] else 'FAIL'} {component:>18} {precision:>8}"
+                    f"  max diff {value:.2e} (tol {tol:g})")
+    return results
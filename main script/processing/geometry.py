@@ -0,0 +1,47 @@
+# Software equivalent of the sensor ROI and binning settings in camera_handler.py.
+# Lets recorded full-frame data be reprocessed at the same reduced geometry as a live capture.
+
+import numpy as np
+
+def crop_frames(frames, roi):
+    """
+    Crop a frame or stack (..., H, W) to roi = (x0, y0, x1, y1), lower-right corner inclusive
+    (same convention as the camera ROI). Returns a view, no data is copied.
+    """
+    x0, y0, x1, y1 = (int(v) for v in roi)
+    if x1 < x0 or y1 < y0:
+        raise ValueError(f"Invalid ROI {roi}")
+    return frames[..., y0:y1+1, x0:x1+1]
+
+def bin_frames(frames, binx=1, biny=1, mode='sum'):
+    """
+    Bin a frame or stack (..., H, W) by binx (cols) x biny (rows).
+    Trailing rows/cols that do not fill a whole bin are dropped, like the sensor does.
+    mode: 'sum' (uint16 input gives uint32) or 'mean' (float32)
+    """
+    frames = np.asarray(frames)
+    if binx == 1 and biny == 1:
+        return frames
+    H, W = frames.shape[-2:]
+    Hb, Wb = H // biny, W // binx
+    trimmed = frames[..., :Hb*biny, :Wb*binx]
+    blocks = trimmed.reshape(frames.shape[:-2] + (Hb, biny, Wb, binx))
+    if mode == 'sum':
+        dtype = np.uint32 if np.issubdtype(frames.dtype, np.integer) else np.float32
+        return blocks.sum(axis=(-3, -1), dtype=dtype)
+    elif mode == 'mean':
+        return blocks.mean(axis=(-3, -1), dtype=np.float32)
+    else:
+        raise ValueError("mode must be 'sum' or 'mean'")
+
+def apply_geometry(frames, roi=None, binx=1, biny=1, mode='sum'):
+    """
+    Crop then bin a frame or stack, in the same order as the sensor (ROI is in unbinned pixels).
+    frames: array (H,W) or (N,H,W), list of frames or np.memmap. Only the ROI is read from a memmap.
+    """
+    if isinstance(frames, (list, tuple)):
+        # crop each frame before stacking so only the ROI is copied
+        frames = np.stack([crop_frames(np.asarray(f), roi) if roi is not None else f for f in frames])
+    elif roi is not None:
+        frames = crop_frames(frames, roi)
+    return bin_frames(frames, binx, biny, mode=mode)
@@ -0,0 +1,265 @@
+# Pipelined capture -> preprocess -> correlate execution.
+# Every stage runs in its own thread and stages are linked by bounded queues, so a slow stage
+# blocks the one before it (backpressure) instead of frames piling up in memory.
+# Each stage reports its throughput and the depth of its input queue.
+
+import threading
+import queue
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from processing.speckle import SpeckleProcessor, select_windows, process_window_batch, SparseField
+
+_END = object()  # end-of-stream marker passed through the queues
+
+class StageStats:
+    """Counters for one pipeline stage"""
+    def __init__(self, name, in_queue=None):
+        self.name = name
+        self.in_queue = in_queue
+        self.count = 0
+        self.busy_s = 0.0
+        self.t_start = None
+        self.t_end = None
+        self.max_depth = 0
+        self.depth_sum = 0
+
+    def sample_queue(self):
+        if self.in_queue is not None:
+            depth = self.in_queue.qsize()
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_sum += depth
+
+    def as_dict(self):
+        end = self.t_end if self.t_end is not None else time.perf_counter()
+        wall = end - self.t_start if self.t_start is not None else 0.0
+        return {
+            'frames': self.count,
+            'fps': self.count / wall if wall > 0 else 0.0,
+            'busy': self.busy_s / wall if wall > 0 else 0.0,  # fraction of time spent working
+            'queue_depth': self.in_queue.qsize() if self.in_queue is not None else 0,
+            'max_queue_depth': self.max_depth,
+            'mean_queue_depth': self.depth_sum / self.count if self.count else 0.0,
+        }
+
+class FramePipeline:
+    """
+    Streams n_frames frames from source through preprocessing into correlation workers.
+    source: callable returning a frame or None (e.g. CameraHandler.trigger_capture)
+    Iref: reference image (raw, the preprocess chain is applied to it once)
+    preprocess: list of callables frame -> frame applied in order (dark/flat correction, binning, ...)
+    processor: SpeckleProcessor giving M, grid, mask and n_workers (default SpeckleProcessor())
+    accumulate: number of consecutive frames averaged before correlation (1 = every frame)
+    queue_size: capacity of each queue between stages
+    max_null: consecutive None frames from source before capture stops
+    After run()/wait(): mean, sc_image (temporal contrast), fields (list of SparseField per correlated
+    step, in order) and field (SparseField of the mean image).
+    """
+    def __init__(self, source, n_frames, Iref, preprocess=(), processor=None, accumulate=1,
+                 queue_size=8, max_null=20, keep_frames=False):
+        self.source = source
+        self.n_frames = n_frames
+        self.preprocess = list(preprocess)
+        self.processor = processor if processor is not None else SpeckleProcessor()
+        self.accumulate = max(1, int(accumulate))
+        self.max_null = max_null
+        self.keep_frames = keep_frames
+
+        self.Iref = self._preprocess(Iref).astype(np.float32)
+        rows, cols = self.processor.grid(*self.Iref.shape)
+        self.rows, self.cols = rows, cols
+        self.tasks = select_windows(rows, cols, self.processor.mask)
+
+        self.q_pre = queue.Queue(maxsize=queue_size)
+        self.q_corr = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            'capture': StageStats('capture'),
+            'preprocess': StageStats('preprocess', self.q_pre),
+            'correlate': StageStats('correlate', self.q_corr),
+        }
+        self.null_frames = 0
+
+        self.frames = []
+        self.fields = []
+        self.field = None
+        self.mean = None
+        self.sc_image = None
+        self.error = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _put(self, q, item):
+        # blocking put that gives up if a later stage has failed (nobody is draining the queue)
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self.error is not None:
+                    return False
+
+    def _get(self, q):
+        # blocking get that ends the stage once any stage has failed: the end marker from the stage
+        # before may then never arrive (its _put gave up on a full queue)
+        while self.error is None:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _preprocess(self, frame):
+        for step in self.preprocess:
+            frame = step(frame)
+        return frame
+
+    # ---- stages ----
+    def _capture(self):
+        st = self.stats['capture']
+        st.t_start = time.perf_counter()
+        null_run = 0
+        try:
+            while st.count < self.n_frames and not self._stop.is_set():
+                t0 = time.perf_counter()
+                frame = self.source()
+                st.busy_s += time.perf_counter() - t0
+                if frame is None:
+                    self.null_frames += 1
+                    null_run += 1
+                    if null_run >= self.max_null:
+                        break
+                    continue
+                null_run = 0
+                st.count += 1
+                if not self._put(self.q_pre, frame):  # blocks when preprocessing falls behind
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            st.t_end = time.perf_counter()
+            self._put(self.q_pre, _END)
+
+    def _preprocess_stage(self):
+        st = self.stats['preprocess']
+        st.t_start = time.perf_counter()
+        s1 = s2 = None
+        n = 0
+        acc = None
+        n_acc = 0
+        try:
+            while True:
+                st.sample_queue()
+                frame = self._get(self.q_pre)
+                if frame is _END:
+                    break
+                t0 = time.perf_counter()
+                f = self._preprocess(frame).astype(np.float32)
+                if self.keep_frames:
+                    self.frames.append(f)
+                # running sums for the mean image and temporal contrast
+                if s1 is None:
+                    s1 = np.zeros(f.shape, dtype=np.float64)
+                    s2 = np.zeros(f.shape, dtype=np.float64)
+                    acc = np.zeros(f.shape, dtype=np.float32)
+                s1 += f
+                s2 += np.square(f, dtype=np.float64)
+                n += 1
+                acc += f
+                n_acc += 1
+                st.busy_s += time.perf_counter() - t0
+                st.count += 1
+                if n_acc == self.accumulate:
+                    if not self._put(self.q_corr, acc / n_acc):  # blocks when correlation falls behind
+                        break
+                    acc = np.zeros_like(acc)
+                    n_acc = 0
+        except Exception as e:
+            self.error = e
+        finally:
+            if n > 0:
+                self.mean = (s1 / n).astype(np.float32)
+                std = np.sqrt(np.maximum(s2 / n - (s1 / n)**2, 0.0))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    self.sc_image = np.where(self.mean > 0, std / self.mean, 0.0).astype(np.float32)
+            st.t_end = time.perf_counter()
+            self._put(self.q_corr, _END)
+
+    def _correlate_frame(self, ex, frame):
+        # one frame, windows split over the worker processes
+        proc = self.processor
+        per_task = max(1, int(np.ceil(len(self.tasks) / max(1, proc.n_workers))))
+        chunks = [self.tasks[k:k + per_task] for k in range(0, len(self.tasks), per_task)]
+        futures = [ex.submit(process_window_batch, self.Iref, frame, [(t[2], t[3]) for t in chunk], proc.M,
+                             **proc.correlation_options())
+                   for chunk in chunks]
+        u = np.zeros(len(self.tasks), dtype=np.complex64)
+        c = np.zeros(len(self.tasks), dtype=np.float32)
+        e = np.ones(len(self.tasks), dtype=np.int8)
+        k = 0
+        for chunk, fut in zip(chunks, futures):
+            try:
+                results = fut.result()
+            except Exception:
+                results = [(0+0j, 0.0, 1)] * len(chunk)
+            for result in results:
+                u[k], c[k], e[k] = result[:3]
+                k += 1
+        idx_r = [t[0] for t in self.tasks]
+        idx_c = [t[1] for t in self.tasks]
+        return SparseField(self.rows, self.cols, idx_r, idx_c, u, c, e)
+
+    def _correlate_stage(self):
+        st = self.stats['correlate']
+        st.t_start = time.perf_counter()
+        try:
+            with ProcessPoolExecutor(max_workers=self.processor.n_workers) as ex:
+                while True:
+                    st.sample_queue()
+                    frame = self._get(self.q_corr)
+                    if frame is _END:
+                        break
+                    t0 = time.perf_counter()
+                    self.fields.append(self._correlate_frame(ex, frame))
+                    st.busy_s += time.perf_counter() - t0
+                    st.count += 1
+                # final field from the mean of all frames
+                if self.mean is not None and not self._stop.is_set() and self.error is None:
+                    self.field = self._correlate_frame(ex, self.mean)
+        except Exception as e:
+            self.error = e
+        finally:
+            st.t_end = time.perf_counter()
+
+    # ---- control ----
+    def start(self):
+        """Starts all stages in background threads"""
+        for target in (self._capture, self._preprocess_stage, self._correlate_stage):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def is_running(self):
+        return any(t.is_alive() for t in self._threads)
+
+    def stop(self):
+        """Stops capturing, frames already captured are still processed"""
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        for t in self._threads:
+            t.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def run(self):
+        """Runs the whole pipeline and returns when the final field is ready"""
+        return self.start().wait()
+
+    def report(self):
+        """Throughput and queue depth of every stage as {stage: dict}"""
+        out = {name: st.as_dict() for name, st in self.stats.items()}
+        out['capture']['null_frames'] = self.null_frames
+        return out
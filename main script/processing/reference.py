@@ -0,0 +1,320 @@
+# Frozen copy of the original processing chain (speckle.py and subpixel_refinement.py as first
+# written), used as the reference implementation by processing.equivalence. Do not optimise or fix
+# anything here: faster or corrected paths in speckle.py are checked against these results.
+# Known quirks are kept on purpose, e.g. quadratic_refine returns the negated offset, subpixel_chebyshev
+# returns [dx, dy] and the fractional loop of process_window rarely converges for non-integer shifts.
+
+import numpy as np
+from numpy.fft import fft2, ifft2, fftshift
+import math
+
+# ---------- Quadratic (parabola fit) ----------
+def quadratic_refine(m):
+    """
+    Simple quadratic interpolation around max of 3x3 patch.
+    Returns dn = [dy, dx] subpixel offset.
+    """
+    r, c = np.unravel_index(np.argmax(m), m.shape)
+    if 0 < r < m.shape[0]-1 and 0 < c < m.shape[1]-1:
+        dx = 0.5 * (m[r, c+1] - m[r, c-1]) / (m[r, c+1] - 2*m[r, c] + m[r, c-1])
+        dy = 0.5 * (m[r+1, c] - m[r-1, c]) / (m[r+1, c] - 2*m[r, c] + m[r-1, c])
+    else:
+        dx, dy = 0.0, 0.0
+    return np.array([dy, dx])
+
+
+# ---------- Chebyshev polynomial approximation ----------
+# Mostly translated from MATLAB code by Mikael Sjödahl
+def chebyshev_eval(xy, a):
+    x, y = xy
+    T1x = x; T2x = 2*x**2 - 1; dT2x = 4*x
+    T1y = y; T2y = 2*y**2 - 1; dT2y = 4*y
+
+    T = np.array([1, T1y, T2y, T1x, T1x*T1y, T1x*T2y, T2x, T2x*T1y, T2x*T2y])
+    dTx = np.array([0,0,0,1, T1y, T2y, dT2x, dT2x*T1y, dT2x*T2y])
+    dTy = np.array([0,1,dT2y,0, T1x, T1x*dT2y, 0, T2x, T2x*dT2y])
+    d2Txx = np.array([0,0,0,0,0,0,4,4*T1y,4*T2y])
+    d2Txy = np.array([0,0,0,0,1,dT2y,0,dT2x,dT2x*dT2y])
+    d2Tyy = np.array([0,0,4,0,0,4*T1x,0,0,4*T2x])
+
+    C = T @ a
+    dC = np.array([dTx @ a, dTy @ a])
+    d2C = np.array([[d2Txx @ a, d2Txy @ a],
+                    [d2Txy @ a, d2Tyy @ a]])
+    return C, dC, d2C
+
+
+def subpixel_chebyshev(m):
+    """
+    Subpixel peak refinement using Chebyshev expansion.
+    m : 3x3 patch around peak
+    Returns (dn, Cpeak)
+    """
+    b = m.flatten()
+    pts = [-1, 0, 1]
+    Tmat = []
+    for yy in pts:
+        for xx in pts:
+            row = [
+                1, yy, 2*yy**2-1, xx,
+                xx*yy, xx*(2*yy**2-1),
+                2*xx**2-1, (2*xx**2-1)*yy, (2*xx**2-1)*(2*yy**2-1)
+            ]
+            Tmat.append(row)
+    Tmat = np.array(Tmat)
+    a = np.linalg.solve(Tmat, b)
+
+    xy = np.array([0.0, 0.0])
+    for _ in range(5):
+        C, dC, d2C = chebyshev_eval(xy, a)
+        try:
+            step = np.linalg.solve(d2C, -dC)
+        except np.linalg.LinAlgError:
+            break
+        xy += step
+        if np.linalg.norm(step) < 1e-6:
+            break
+
+    C, _, _ = chebyshev_eval(xy, a)
+    return xy, C
+
+
+def average_frames(frames, method='mean'):
+    """frames: list or array shape (Nframes, H, W)"""
+    arr = np.asarray(frames)
+    if method == 'mean':
+        return np.mean(arr, axis=0)
+    elif method == 'median':
+        return np.median(arr, axis=0)
+    else:
+        raise ValueError("method must be 'mean' or 'median'")
+
+def temporal_contrast(frames):
+    """Temporal speckle contrast K = std / mean (frames: N,H,W)"""
+    arr = np.asarray(frames).astype(np.float32)
+    mean = np.mean(arr, axis=0)
+    std = np.std(arr, axis=0)
+    # Avoid divide by zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        K = np.where(mean > 0, std / mean, 0.0)
+    return K
+
+# ---- helpers for correlation and peak finding ----
+def fftcorr_subwindow(I1_win, I2_win):
+    """
+    Compute normalized cross-correlation between two windows (M x M).
+    Returns correlation matrix c of size (2M x 2M).
+    """
+    M = I1_win.shape[0]
+    big = 2 * M
+    # place windows centered in big array
+    P = M // 2
+    i1 = np.zeros((big, big), dtype=np.float32)
+    i2 = np.zeros_like(i1)
+    i1[P:P+M, P:P+M] = I1_win - np.mean(I1_win)
+    i2[P:P+M, P:P+M] = I2_win - np.mean(I2_win)
+
+    in1 = i1 * i1
+    in2 = i2 * i2
+
+    # shift only reference (i1)
+    f11 = fft2(fftshift(i1))
+    f22 = fft2(i2)
+    u12 = f11 * np.conjugate(f22)
+    U12 = fft2(u12)
+    I12 = np.abs(U12)
+    norm = (big ** 2) * math.sqrt(np.sum(in1) * np.sum(in2))
+    if norm == 0:
+        return np.zeros_like(I12)
+    c = I12 / norm
+    return c
+
+def integer_peak_from_corr(c):
+    """
+    Given correlation array c (2M x 2M), return integer displacement D = [dy, dx]
+    measured relative to center (center index = M, M).
+    """
+    big = c.shape[0]
+    M = big // 2
+    # find global maximum
+    idx = np.argmax(c)
+    r, col = divmod(idx, big)
+    dy = r - M   # positive means shift down (rows)
+    dx = col - M # positive means shift right (cols)
+    return np.array([dy, dx], dtype=float), (r, col)
+
+def subpixel_from_3x3(c, peak_r, peak_c):
+    """
+    Fit a 1D quadratic in x and y separately using values at -1,0,+1
+    Return fractional correction [dy, dx] (subpixel) relative to integer peak.
+    Uses formula: delta = (c[-1] - c[+1]) / (2*(c[-1] - 2*c0 + c[+1])) (if denom!=0)
+    """
+    big = c.shape[0]
+    # ensure we have a 3x3 inside bounds
+    if peak_r <= 0 or peak_r >= big-1 or peak_c <= 0 or peak_c >= big-1:
+        return np.array([0.0, 0.0])
+    # extract 3 points in y for center column
+    cy_m = c[peak_r-1, peak_c]
+    cy_0 = c[peak_r,   peak_c]
+    cy_p = c[peak_r+1, peak_c]
+    denom_y = 2.0*(cy_m - 2.0*cy_0 + cy_p)
+    if denom_y == 0:
+        dy = 0.0
+    else:
+        dy = (cy_m - cy_p) / denom_y
+
+    # extract 3 points in x for center row
+    cx_m = c[peak_r, peak_c-1]
+    cx_0 = cy_0
+    cx_p = c[peak_r, peak_c+1]
+    denom_x = 2.0*(cx_m - 2.0*cx_0 + cx_p)
+    if denom_x == 0:
+        dx = 0.0
+    else:
+        dx = (cx_m - cx_p) / denom_x
+
+    # clamp to sensible range (-1..1)
+    dy = float(np.clip(dy, -1.0, 1.0))
+    dx = float(np.clip(dx, -1.0, 1.0))
+    return np.array([dy, dx], dtype=float)
+
+
+# single-window processing function for parallelization
+def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, method='chebyshev'):
+    """
+    Process one interrogation window centered at (center_r, center_c).
+    Returns (u_complex, peak_corr, error_flag)
+    u_complex = real = vertical (rows), imag = horizontal (cols)
+    """
+    H, W = Iref.shape
+    half = M//2
+    # extract windows with bounds check (pad if necessary)
+    r0 = int(center_r - half); c0 = int(center_c - half)
+    # pad image if indices go out
+    pad_top = max(0, -r0)
+    pad_left = max(0, -c0)
+    pad_bottom = max(0, r0+M - H)
+    pad_right = max(0, c0+M - W)
+    if any(p>0 for p in (pad_top, pad_bottom, pad_left, pad_right)):
+        # pad both Iref and Iobj with zeros (or reflect) — choose reflect to avoid artificial edges
+        ref_p = np.pad(Iref, ((pad_top,pad_bottom),(pad_left,pad_right)), mode='reflect')
+        obj_p = np.pad(Iobj, ((pad_top,pad_bottom),(pad_left,pad_right)), mode='reflect')
+        r0 += pad_top
+        c0 += pad_left
+    else:
+        ref_p = Iref
+        obj_p = Iobj
+
+    I1_win = ref_p[r0:r0+M, c0:c0+M].astype(np.float32)
+    I2_win = obj_p[r0:r0+M, c0:c0+M].astype(np.float32)
+
+    # integer loop (at most a few iterations)
+    D = np.array([0.0, 0.0])
+    e = 0
+    snurra = 0
+    while True:
+        snurra += 1
+        c = fftcorr_subwindow(I1_win, I2_win)
+        Dcorr, (rpeak, cpeak) = integer_peak_from_corr(c)
+        if np.all(Dcorr == 0) or snurra>10 or np.linalg.norm(Dcorr) > M/2:
+            D = D + Dcorr
+            if snurra>10 or np.linalg.norm(Dcorr) > M/2:
+                e = 1
+            break
+        D = D + Dcorr
+        # shift I2_win integer amount for next iteration
+        # For efficiency: perform circular shift inside MxM window
+        dy, dx = int(Dcorr[0]), int(Dcorr[1])
+        I2_win = np.roll(I2_win, -dy, axis=0)  # negative because we measured I2 relative movement
+        I2_win = np.roll(I2_win, -dx, axis=1)
+        if snurra>10:
+            e = 1
+            break
+
+    if e:
+        return 0+0j, 0.0, 1
+
+    # subpixel refinement: take 3x3 around peak and compute quadratic correction
+    # Initial mask around current peak in c
+    small = c  # last computed correlation from integer loop
+    # take local 3x3 around (rpeak, cpeak)
+    # quadratic polynomials
+    
+    # --- Subpixel refinement ---
+    patch = c[rpeak-1:rpeak+2, cpeak-1:cpeak+2]
+
+    # Choose refinement method
+    if method == "quadratic":
+        dn = quadratic_refine(patch)
+    elif method == "chebyshev":
+        dn, Cpeak = subpixel_chebyshev(patch)
+    else:
+        dn = subpixel_from_3x3(small, rpeak, cpeak)
+
+    
+
+    F = dn.copy()
+    snurra = 0
+    # iterative fractional refine
+    while np.hypot(F[0], F[1]) > tol and snurra < max_iter:
+        snurra += 1
+        # shift I2_win by fractional F using simple bilinear interpolation
+        # create an interpolated window: use scipy? to avoid dependency, implement manual interp
+        # but here we'll use numpy's map_coordinates if available; to keep minimal, do simple Fourier shift:
+        # apply subpixel shift using phase ramp in Fourier domain
+        # shift via multiplication in freq domain (efficient)
+        Mbig = M
+        # compute Fourier shift
+        Freq = fft2(I2_win)
+        ky = np.fft.fftfreq(Mbig)
+        kx = np.fft.fftfreq(Mbig)
+        KX, KY = np.meshgrid(kx, ky)
+        phase = np.exp(-2j*np.pi*(F[0]*KY + F[1]*KX))
+        I2_shift = np.real(ifft2(Freq * phase))
+        c = fftcorr_subwindow(I1_win, I2_shift)
+        Dcorr_sub, (rpeak, cpeak) = integer_peak_from_corr(c)
+        dn = subpixel_from_3x3(c, rpeak, cpeak)
+        F = F + dn
+        I2_win = I2_shift  # update for next iter
+    if snurra>=max_iter:
+        e = 1
+
+    U = D + F
+    # final peak correlation value at center region
+    peak_corr = c[rpeak, cpeak] if c is not None else 0.0
+    u_complex = float(U[0]) + 1j*float(U[1])
+    return u_complex, float(peak_corr), int(e)
+
+def grid(H, W, M):
+    """Window centres of SpeckleProcessor(M).process for an image of size H x W"""
+    rows = list(range(M//2, H - M//2, M))
+    cols = list(range(M//2, W - M//2, M))
+    return rows, cols
+
+def process(Iref_stack, Iobj_stack, M=64, rows=None, cols=None, method='mean'):
+    """
+    SpeckleProcessor.process as originally written, serial instead of a process pool
+    (windows are independent, so the results are the same).
+    Returns: u_image, c_image, e_image, sc_image, rows, cols
+    """
+    Iref = average_frames(Iref_stack, method=method)
+    Iobj = average_frames(Iobj_stack, method=method)
+    sc_image = temporal_contrast(Iobj_stack)
+
+    H, W = Iref.shape
+    if rows is None or cols is None:
+        rows, cols = grid(H, W, M)
+
+    u_image = np.zeros((len(rows), len(cols)), dtype=np.complex64)
+    c_image = np.zeros((len(rows), len(cols)), dtype=np.float32)
+    e_image = np.zeros((len(rows), len(cols)), dtype=np.int8)
+    for i, rr in enumerate(rows):
+        for j, cc in enumerate(cols):
+            try:
+                u_complex, peak_corr, err = process_window(Iref, Iobj, rr, cc, M)
+            except Exception:
+                u_complex, peak_corr, err = 0+0j, 0.0, 1
+            u_image[i, j] = u_complex
+            c_image[i, j] = peak_corr
+            e_image[i, j] = err
+    return u_image, c_image, e_image, sc_image, rows, cols
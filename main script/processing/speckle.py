@@ -1,65 +1,326 @@
 # Calculates displacement and correlation images using pixel intensity data of images.
 # Correlation calculations are based on the zero mean cross-correlation method (ZMCC).
+#
+# Precision policy: functions take dtype=None (default) or a float type (np.float32 / np.float64).
+# None keeps the original behaviour (float32 windows, numpy.fft in double precision, float64 averages).
+# With a dtype, all images, windows and spectra (via scipy.fft, which keeps single precision) use
+# that precision and stacks are reduced chunk by chunk instead of being copied as a whole.
 
 import numpy as np
 from numpy.fft import fft2, ifft2, fftshift
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import scipy.fft
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from functools import partial
 import math
 
 # Internal imports
-from processing.subpixel_refinement import quadratic_refine, subpixel_chebyshev
+from processing.subpixel_refinement import quadratic_refine, subpixel_chebyshev, subpixel_gaussian, gradient_refine
+from processing.geometry import apply_geometry, bin_frames
+from processing.bayer import debayer, crop_pattern
+from processing.validation import normalized_median_test, neighbour_prediction
 
-def average_frames(frames, method='mean'):
-    """frames: list or array shape (Nframes, H, W)"""
-    arr = np.asarray(frames)
+def _fft(dtype):
+    # transforms for the precision policy, numpy.fft for the original double precision path
+    return np.fft if dtype is None else scipy.fft
+
+def _window_dtype(dtype):
+    return np.float32 if dtype is None else dtype
+
+def _complex_dtype(dtype):
+    return np.result_type(dtype, np.complex64)
+
+def iter_chunks(frames, chunk=16):
+    """
+    Yields (n, H, W) blocks of a stack without copying the whole stack.
+    frames: list of frames (each yielded as a 1-frame view), array or np.memmap (read chunk frames at a time)
+    """
+    if isinstance(frames, (list, tuple)):
+        for f in frames:
+            yield np.asarray(f)[None]
+    else:
+        for k in range(0, len(frames), chunk):
+            yield np.asarray(frames[k:k+chunk])
+
+def median_frames(frames, max_tile_bytes=256 * 2**20, n_workers=4):
+    """
+    Exact per-pixel median of a stack (N, H, W), same result as np.median(frames, axis=0).
+    frames: list of frames, array or np.memmap; only one tile of pixel columns per worker is in memory.
+    The image is split into tiles (full-width row bands, or column blocks if one row is too large) so
+    that the n_workers tiles in flight stay below max_tile_bytes together. Tiles are processed in
+    parallel by threads, each with an in place np.partition along the frame axis.
+    """
+    is_list = isinstance(frames, (list, tuple))
+    first = np.asarray(frames[0])
+    N = len(frames)
+    H, W = first.shape
+    src = first.dtype
+    # np.median returns float64 for integer stacks and keeps float types
+    out = np.empty((H, W), dtype=src if np.issubdtype(src, np.floating) else np.float64)
+
+    per_tile = max(1, max_tile_bytes // max(1, n_workers) // (N * src.itemsize))  # pixels per tile
+    if per_tile >= W:
+        th, tw = min(H, per_tile // W), W
+    else:
+        th, tw = 1, per_tile
+    half = N // 2
+    kth = [half - 1, half] if N % 2 == 0 else [half]
+
+    def run(r0, c0):
+        r1, c1 = min(H, r0 + th), min(W, c0 + tw)
+        if is_list:
+            block = np.empty((N, r1 - r0, c1 - c0), dtype=src)
+            for k, f in enumerate(frames):
+                block[k] = np.asarray(f)[r0:r1, c0:c1]
+        else:
+            block = np.array(frames[:, r0:r1, c0:c1])  # only this tile is read from a memmap
+        block.partition(kth, axis=0)
+        if N % 2:
+            out[r0:r1, c0:c1] = block[half]
+        else:
+            out[r0:r1, c0:c1] = np.mean(block[half-1:half+1], axis=0, dtype=out.dtype)
+
+    tiles = [(r0, c0) for r0 in range(0, H, th) for c0 in range(0, W, tw)]
+    with ThreadPoolExecutor(max_workers=n_workers) as ex:
+        list(ex.map(lambda rc: run(*rc), tiles))
+    return out
+
+def average_frames(frames, method='mean', dtype=None):
+    """
+    frames: list or array shape (Nframes, H, W)
+    dtype: precision policy, with a dtype the mean is accumulated chunk by chunk in that precision
+    The median is computed tile by tile (median_frames), also for lists and memmapped stacks.
+    """
+    if method == 'mean' and dtype is not None:
+        acc = None
+        n = 0
+        for block in iter_chunks(frames):
+            s = block.sum(axis=0, dtype=dtype)
+            acc = s if acc is None else np.add(acc, s, out=acc)
+            n += len(block)
+        acc /= n
+        return acc
     if method == 'mean':
-        return np.mean(arr, axis=0)
+        return np.mean(np.asarray(frames), axis=0)
     elif method == 'median':
-        return np.median(arr, axis=0)
+        med = median_frames(frames)
+        return med if dtype is None else med.astype(dtype, copy=False)
     else:
         raise ValueError("method must be 'mean' or 'median'")
 
-def temporal_contrast(frames):
-    """Temporal speckle contrast K = std / mean (frames: N,H,W)"""
-    arr = np.asarray(frames).astype(np.float32)
-    mean = np.mean(arr, axis=0)
-    std = np.std(arr, axis=0)
+def temporal_contrast(frames, dtype=None):
+    """
+    Temporal speckle contrast K = std / mean (frames: N,H,W)
+    dtype: precision policy, with a dtype mean and variance are updated frame by frame (Welford)
+           so only frame sized temporaries are made and the stack is never converted as a whole
+    """
+    if dtype is None:
+        arr = np.asarray(frames).astype(np.float32)
+        mean = np.mean(arr, axis=0)
+        std = np.std(arr, axis=0)
+    else:
+        n = 0
+        mean = m2 = None
+        for block in iter_chunks(frames):
+            for frame in block:
+                x = frame.astype(dtype)
+                n += 1
+                if mean is None:
+                    mean, m2 = x, np.zeros_like(x)
+                    continue
+                delta = x - mean
+                mean += delta / n
+                x -= mean
+                delta *= x
+                m2 += delta
+        std = np.sqrt(m2 / n)
     # Avoid divide by zero
     with np.errstate(divide='ignore', invalid='ignore'):
         K = np.where(mean > 0, std / mean, 0.0)
-    return K
+    return K if dtype is None else K.astype(dtype, copy=False)
 
 # ---- helpers for correlation and peak finding ----
-def fftcorr_subwindow(I1_win, I2_win):
+def reference_spectrum(I1_win, dtype=None):
+    """
+    Reference part of fftcorr_subwindow: spectrum of the padded zero-mean window and its energy.
+    Computed once per reference window and reused for every object window compared to it.
+    """
+    M = I1_win.shape[0]
+    big = 2 * M
+    P = M // 2
+    i1 = np.zeros((big, big), dtype=_window_dtype(dtype))
+    i1[P:P+M, P:P+M] = I1_win - np.mean(I1_win)
+    in1 = i1 * i1
+    # shift only reference (i1)
+    f11 = _fft(dtype).fft2(fftshift(i1))
+    return f11, np.sum(in1)
+
+def fftcorr_subwindow(I1_win, I2_win, ref=None, dtype=None):
     """
     Compute normalized cross-correlation between two windows (M x M).
+    ref: optional precomputed reference_spectrum(I1_win)
+    dtype: precision policy (None = original double precision transforms)
     Returns correlation matrix c of size (2M x 2M).
     """
-    M = I1_win.shape[0]
+    M = I2_win.shape[0]
     big = 2 * M
     # place windows centered in big array
     P = M // 2
-    i1 = np.zeros((big, big), dtype=np.float32)
-    i2 = np.zeros_like(i1)
-    i1[P:P+M, P:P+M] = I1_win - np.mean(I1_win)
+    if ref is None:
+        ref = reference_spectrum(I1_win, dtype)
+    f11, e1 = ref
+    i2 = np.zeros((big, big), dtype=_window_dtype(dtype))
     i2[P:P+M, P:P+M] = I2_win - np.mean(I2_win)
 
-    in1 = i1 * i1
     in2 = i2 * i2
 
-    # shift only reference (i1)
-    f11 = fft2(fftshift(i1))
-    f22 = fft2(i2)
+    fft = _fft(dtype)
+    f22 = fft.fft2(i2)
     u12 = f11 * np.conjugate(f22)
-    U12 = fft2(u12)
+    U12 = fft.fft2(u12)
     I12 = np.abs(U12)
-    norm = (big ** 2) * math.sqrt(np.sum(in1) * np.sum(in2))
+    norm = (big ** 2) * math.sqrt(e1 * np.sum(in2))
     if norm == 0:
         return np.zeros_like(I12)
     c = I12 / norm
     return c
 
+def zncc_reference(I1_win, dtype=None):
+    """
+    Reference part of zncc_subwindow: conjugate spectrum of the zero-padded window and
+    summed-area tables of the window and its square.
+    """
+    M = I1_win.shape[0]
+    a = np.asarray(I1_win, dtype=np.float64 if dtype is None else dtype)
+    a = a - np.mean(a)  # ZNCC does not depend on the offset, this keeps the sums small
+    F1 = np.conjugate(_fft(dtype).rfft2(a, s=(2*M, 2*M)))
+    S = np.zeros((M + 1, M + 1), dtype=a.dtype)
+    S2 = np.zeros((M + 1, M + 1), dtype=a.dtype)
+    S[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+    S2[1:, 1:] = (a * a).cumsum(axis=0).cumsum(axis=1)
+    return F1, S, S2
+
+def zncc_subwindow(I1_win, I2_win, ref=None, min_overlap=0.25, dtype=None):
+    """
+    Zero-mean normalised cross-correlation for every shift (M x M windows).
+    Unlike fftcorr_subwindow, mean and energy are taken over the overlap of the two windows at each
+    shift, so values at large shifts are not biased towards zero. The overlap sums come from one
+    padded FFT correlation and summed-area tables, O(M^2 log M) like fftcorr_subwindow.
+    ref: optional precomputed zncc_reference(I1_win)
+    min_overlap: shifts where the overlap is less than this fraction of M*M are set to 0
+    Returns correlation matrix c of size (2M x 2M), same layout as fftcorr_subwindow (zero shift at M, M).
+    """
+    M = I2_win.shape[0]
+    big = 2 * M
+    if ref is None:
+        ref = zncc_reference(I1_win, dtype)
+    F1, S1, S11 = ref
+    fft = _fft(dtype)
+    b = np.asarray(I2_win, dtype=S1.dtype)
+    b = b - np.mean(b)
+    S2 = np.zeros((M + 1, M + 1), dtype=b.dtype)
+    S22 = np.zeros((M + 1, M + 1), dtype=b.dtype)
+    S2[1:, 1:] = b.cumsum(axis=0).cumsum(axis=1)
+    S22[1:, 1:] = (b * b).cumsum(axis=0).cumsum(axis=1)
+    # sum over the overlap of I1(p) * I2(p + d) for all shifts d, zero shift moved to index M
+    S12 = fftshift(fft.irfft2(F1 * fft.rfft2(b, s=(big, big)), s=(big, big)))
+
+    # overlap rectangle for shift d = index - M: rows [max(0, -d), min(M, M - d)) of I1,
+    # the same rows moved by d in I2. Index 0 (d = -M) has no overlap.
+    d = np.arange(big) - M
+    lo1 = np.clip(-d, 0, M); hi1 = np.clip(M - d, 0, M)
+    lo2 = np.clip(d, 0, M); hi2 = np.clip(M + d, 0, M)
+    def box(T, lo, hi):
+        return T[hi[:, None], hi[None, :]] - T[lo[:, None], hi[None, :]] - T[hi[:, None], lo[None, :]] \
+            + T[lo[:, None], lo[None, :]]
+    n = (hi1 - lo1)[:, None] * (hi1 - lo1)[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s1 = box(S1, lo1, hi1)
+        s2 = box(S2, lo2, hi2)
+        cov = S12 - s1 * s2 / n
+        var1 = box(S11, lo1, hi1) - s1 * s1 / n
+        var2 = box(S22, lo2, hi2) - s2 * s2 / n
+        c = cov / np.sqrt(var1 * var2)
+    ok = (n >= min_overlap * M * M) & (var1 > 0) & (var2 > 0)
+    return np.where(ok, c, 0.0).astype(S1.dtype, copy=False)
+
+def phase_reference(I1_win, dtype=None):
+    """Reference part of phase_subwindow: conjugate spectrum of the Hann weighted zero-mean window, its modulus and the weight"""
+    M = I1_win.shape[0]
+    a = np.asarray(I1_win, dtype=np.float64 if dtype is None else dtype)
+    win = np.outer(np.hanning(M), np.hanning(M)).astype(a.dtype)
+    F1 = np.conjugate(_fft(dtype).fft2((a - np.mean(a)) * win))
+    return F1, np.abs(F1), win
+
+def phase_subwindow(I1_win, I2_win, ref=None, alpha=0.5, dtype=None):
+    """
+    Phase correlation of two M x M windows: the cross spectrum is divided by (|F1| |F2|)^alpha.
+    alpha = 1 is pure phase correlation (whitened spectrum), alpha = 0 is plain cross-correlation and
+    values in between weight the two. Pure phase gives the sharpest peak but also whitens the noise
+    outside the speckle band, alpha around 0.5 is the better compromise for speckle sampled at a
+    few pixels per grain. Windows are Hann weighted against edge effects, the map is normalised so
+    a perfect match gives 1 for every alpha.
+    ref: optional precomputed phase_reference(I1_win)
+    Returns correlation matrix c of size (2M x 2M), same layout as fftcorr_subwindow (zero shift at M, M).
+    The correlation is circular over M, so shifts are resolved up to +-M/2 and the rest of the map is 0.
+    """
+    M = I2_win.shape[0]
+    if ref is None:
+        ref = phase_reference(I1_win, dtype)
+    F1, A1, win = ref
+    fft = _fft(dtype)
+    b = np.asarray(I2_win, dtype=win.dtype)
+    F2 = fft.fft2((b - np.mean(b)) * win)
+    A2 = np.abs(F2)
+    eps = np.finfo(win.dtype).tiny
+    R = F1 * F2 / np.maximum(A1 * A2, eps) ** alpha
+    # Cauchy-Schwarz bound of the map, M*M for pure phase
+    norm = math.sqrt(np.sum(A1 ** (2 - 2*alpha)) * np.sum(A2 ** (2 - 2*alpha))) / (M * M)
+    c = np.zeros((2*M, 2*M), dtype=win.dtype)
+    if norm > 0:
+        # circular map with zero shift at M//2, placed so zero shift lands on M, M
+        P = M // 2
+        c[P:P+M, P:P+M] = fftshift(np.real(fft.ifft2(R))) / norm
+    return c
+
+# correlation map used by correlate_windows, see correlation_reference / correlation_map
+CORR_MODES = ('zmcc', 'zncc', 'phase')
+
+def correlation_reference(I1_win, corr_mode='zmcc', dtype=None):
+    """Precomputed reference part for correlation_map"""
+    if corr_mode == 'zmcc':
+        return reference_spectrum(I1_win, dtype)
+    elif corr_mode == 'zncc':
+        return zncc_reference(I1_win, dtype)
+    elif corr_mode == 'phase':
+        return phase_reference(I1_win, dtype)
+    raise ValueError(f"corr_mode must be one of {CORR_MODES}")
+
+def fourier_shift_window(win, shift, dtype=None):
+    """Moves the content of a window by shift = (dy, dx) pixels (periodic) with a Fourier phase ramp"""
+    fft = _fft(dtype)
+    ky = np.fft.fftfreq(win.shape[0])[:, None]
+    kx = np.fft.fftfreq(win.shape[1])[None, :]
+    phase = np.exp(-2j*np.pi*(shift[0]*ky + shift[1]*kx))
+    if dtype is not None:
+        phase = phase.astype(_complex_dtype(dtype))
+    return np.real(fft.ifft2(fft.fft2(win) * phase)).astype(win.dtype, copy=False)
+
+def correlation_map(I1_win, I2_win, ref=None, corr_mode='zmcc', corr_opts=None, dtype=None):
+    """
+    Correlation map (2M x 2M) of the selected mode:
+    'zmcc': fftcorr_subwindow, normalised by the energy of the whole windows (original method)
+    'zncc': zncc_subwindow, normalised per shift over the overlap (corr_opts: min_overlap)
+    'phase': phase_subwindow, whitened spectrum with a sharp peak (corr_opts: alpha)
+    """
+    opts = corr_opts or {}
+    if corr_mode == 'zmcc':
+        return fftcorr_subwindow(I1_win, I2_win, ref, dtype)
+    elif corr_mode == 'zncc':
+        return zncc_subwindow(I1_win, I2_win, ref, dtype=dtype, **opts)
+    elif corr_mode == 'phase':
+        return phase_subwindow(I1_win, I2_win, ref, dtype=dtype, **opts)
+    raise ValueError(f"corr_mode must be one of {CORR_MODES}")
+
 def integer_peak_from_corr(c):
     """
     Given correlation array c (2M x 2M), return integer displacement D = [dy, dx]
@@ -109,35 +370,144 @@ def subpixel_from_3x3(c, peak_r, peak_c):
     dx = float(np.clip(dx, -1.0, 1.0))
     return np.array([dy, dx], dtype=float)
 
+def subpixel_gaussian_peak(c, peak_r, peak_c, dtype=None):
+    """subpixel_gaussian on the 3x3 neighbourhood of the peak, [0, 0] at the border"""
+    big = c.shape[0]
+    if peak_r <= 0 or peak_r >= big-1 or peak_c <= 0 or peak_c >= big-1:
+        return np.array([0.0, 0.0])
+    return subpixel_gaussian(c[peak_r-1:peak_r+2, peak_c-1:peak_c+2], dtype)
+
+# subpixel peak estimator (c, rpeak, cpeak) -> [dy, dx] used by refine_shift for each correlation mode
+PEAK_ESTIMATORS = {'zncc': subpixel_from_3x3, 'phase': subpixel_gaussian_peak}
+# estimators that take the dtype of the precision policy
+PEAK_ESTIMATOR_DTYPE = ('phase',)
+# modes whose map is circular over M: the object window is moved back by the whole estimate
+CIRCULAR_MODES = ('phase',)
+
+def refine_shift(I1_win, I2_win, c, ref, max_iter=10, tol=1e-3, corr_mode='zncc', corr_opts=None, dtype=None):
+    """
+    Subpixel displacement of I2_win relative to I1_win.
+    c: correlation map of the windows, its integer peak plus the estimator of corr_mode is the first
+    estimate. Every step moves the original I2_win back by the estimate with a Fourier shift,
+    recomputes the map and adds the remaining peak offset, until the correction is below tol.
+    For linear maps ('zncc') the integer peak D is left in place (only the fraction is shifted, so
+    little content wraps around), circular maps ('phase') are centred on the whole estimate.
+    Used by the new correlation modes, 'zmcc' keeps the original loop in correlate_windows.
+    Returns (F, c, rpeak, cpeak, e), e = 1 if not converged in max_iter steps
+    """
+    M = I1_win.shape[0]
+    estimator = PEAK_ESTIMATORS[corr_mode]
+    if corr_mode in PEAK_ESTIMATOR_DTYPE:
+        estimator = partial(estimator, dtype=dtype)
+    D, (rpeak, cpeak) = integer_peak_from_corr(c)
+    F = D + estimator(c, rpeak, cpeak)
+    base = np.zeros(2) if corr_mode in CIRCULAR_MODES else D
+    for _ in range(max_iter):
+        c = correlation_map(I1_win, fourier_shift_window(I2_win, base - F, dtype), ref, corr_mode, corr_opts, dtype)
+        _, (rpeak, cpeak) = integer_peak_from_corr(c)
+        dn = np.array([rpeak - M, cpeak - M], dtype=float) - base + estimator(c, rpeak, cpeak)
+        F = F + dn
+        if np.hypot(dn[0], dn[1]) <= tol:
+            return F, c, rpeak, cpeak, 0
+    return F, c, rpeak, cpeak, 1
+
+QUALITY_METRICS = ('ppr', 'snr', 'width')
+
+def correlation_quality(c, rpeak, cpeak, exclude=2):
+    """
+    Quality of correlation maps that are already computed, no correlations are redone.
+    c: (2M x 2M) map or batch (B, 2M, 2M), rpeak/cpeak: peak indices (scalars or length B)
+    exclude: half size of the region around the peak ignored when looking for the second peak
+    Returns (ppr, snr, width), scalars or arrays of length B:
+        ppr   = peak / highest value outside the peak region (peak-to-second-peak ratio)
+        snr   = peak / RMS of the whole map
+        width = mean FWHM (px) of a 3-point Gaussian fit in y and x through the peak (nan if not defined)
+    """
+    single = c.ndim == 2
+    c = c.reshape((-1,) + c.shape[-2:])
+    B, big, _ = c.shape
+    rpeak = np.broadcast_to(np.asarray(rpeak, dtype=int), (B,))
+    cpeak = np.broadcast_to(np.asarray(cpeak, dtype=int), (B,))
+    b = np.arange(B)
+    peak = c[b, rpeak, cpeak]
+
+    idx = np.arange(big)
+    near_r = np.abs(idx[None, :] - rpeak[:, None]) <= exclude
+    near_c = np.abs(idx[None, :] - cpeak[:, None]) <= exclude
+    near = near_r[:, :, None] & near_c[:, None, :]
+    second = np.where(near, -np.inf, c).max(axis=(1, 2))
+    rms = np.sqrt(np.mean(np.square(c, dtype=np.float64), axis=(1, 2)))
+
+    # 3-point Gaussian width, neighbours wrap at the border (only used for the estimate)
+    def gauss_fwhm(cm, c0, cp):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d2 = np.log(cm) - 2*np.log(c0) + np.log(cp)
+            return np.where(d2 < 0, 2*np.sqrt(2*np.log(2)) * np.sqrt(-1.0/d2), np.nan)
+    wy = gauss_fwhm(c[b, (rpeak-1) % big, cpeak], peak, c[b, (rpeak+1) % big, cpeak])
+    wx = gauss_fwhm(c[b, rpeak, (cpeak-1) % big], peak, c[b, rpeak, (cpeak+1) % big])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ppr = np.where(second > 0, peak / second, np.inf)
+        snr = np.where(rms > 0, peak / rms, 0.0)
+    width = 0.5 * (wy + wx)
+    if single:
+        return float(ppr[0]), float(snr[0]), float(width[0])
+    return ppr, snr, width
+
+def extract_window(img, r0, c0, M):
+    """
+    M x M window with top-left corner (r0, c0) of an image or stack (..., H, W). Parts outside the image are
+    mirrored (same as np.pad mode='reflect') to avoid artificial edges.
+    """
+    H, W = img.shape[-2:]
+    if r0 >= 0 and c0 >= 0 and r0 + M <= H and c0 + M <= W:
+        return img[..., r0:r0+M, c0:c0+M]
+    def reflect(idx, n):
+        idx = np.abs(idx)
+        return np.where(idx >= n, 2*(n-1) - idx, idx)
+    ri = reflect(np.arange(r0, r0+M), H)
+    ci = reflect(np.arange(c0, c0+M), W)
+    return img[..., ri[:, None], ci]
 
 # single-window processing function for parallelization
-def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, method='chebyshev'):
+def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, method='chebyshev', offset=None,
+                   quality=False, dtype=None, corr_mode='zmcc', corr_opts=None):
     """
     Process one interrogation window centered at (center_r, center_c).
-    Returns (u_complex, peak_corr, error_flag)
+    offset: optional predicted integer displacement (dy, dx), the object window is taken at the
+            shifted position and the result still is the total displacement
+    quality: also return (ppr, snr, width) from correlation_quality of the final correlation map
+    dtype: precision policy (see top of file)
+    corr_mode, corr_opts: correlation map, see correlation_map
+    Returns (u_complex, peak_corr, error_flag) or (u_complex, peak_corr, error_flag, (ppr, snr, width))
     u_complex = real = vertical (rows), imag = horizontal (cols)
     """
-    H, W = Iref.shape
     half = M//2
-    # extract windows with bounds check (pad if necessary)
     r0 = int(center_r - half); c0 = int(center_c - half)
-    # pad image if indices go out
-    pad_top = max(0, -r0)
-    pad_left = max(0, -c0)
-    pad_bottom = max(0, r0+M - H)
-    pad_right = max(0, c0+M - W)
-    if any(p>0 for p in (pad_top, pad_bottom, pad_left, pad_right)):
-        # pad both Iref and Iobj with zeros (or reflect) — choose reflect to avoid artificial edges
-        ref_p = np.pad(Iref, ((pad_top,pad_bottom),(pad_left,pad_right)), mode='reflect')
-        obj_p = np.pad(Iobj, ((pad_top,pad_bottom),(pad_left,pad_right)), mode='reflect')
-        r0 += pad_top
-        c0 += pad_left
-    else:
-        ref_p = Iref
-        obj_p = Iobj
+    oy, ox = (0, 0) if offset is None else (int(round(offset[0])), int(round(offset[1])))
 
-    I1_win = ref_p[r0:r0+M, c0:c0+M].astype(np.float32)
-    I2_win = obj_p[r0:r0+M, c0:c0+M].astype(np.float32)
+    I1_win = extract_window(Iref, r0, c0, M).astype(_window_dtype(dtype))
+    I2_win = extract_window(Iobj, r0 + oy, c0 + ox, M).astype(_window_dtype(dtype))
+    result = correlate_windows(I1_win, I2_win, max_iter, tol, method, quality=quality, dtype=dtype,
+                               corr_mode=corr_mode, corr_opts=corr_opts)
+    return (result[0] + oy + 1j*ox,) + result[1:]
+
+def correlate_windows(I1_win, I2_win, max_iter=10, tol=1e-3, method='chebyshev', ref=None, quality=False,
+                      dtype=None, corr_mode='zmcc', corr_opts=None):
+    """
+    Displacement of I2_win relative to I1_win (both M x M, float32).
+    ref: optional precomputed correlation_reference(I1_win, corr_mode), reused for all correlations
+    method: subpixel fit for 'zmcc', the other corr_modes refine with their own estimator (refine_shift).
+            'gradient' (any corr_mode) replaces the Fourier shift loop by gradient_refine on the M x M
+            windows, starting from the integer peak, so no maps are computed after the integer stage.
+    Returns (u_complex, peak_corr, error_flag), plus quality metrics if quality, same as process_window.
+    """
+    M = I1_win.shape[0]
+    if ref is None:
+        ref = correlation_reference(I1_win, corr_mode, dtype)
+    if corr_mode != 'zmcc':
+        return _correlate_refined(I1_win, I2_win, ref, max_iter, tol, method, quality, dtype, corr_mode, corr_opts)
+    I2_orig = I2_win
 
     # integer loop (at most a few iterations)
     D = np.array([0.0, 0.0])
@@ -145,7 +515,7 @@ def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, met
     snurra = 0
     while True:
         snurra += 1
-        c = fftcorr_subwindow(I1_win, I2_win)
+        c = correlation_map(I1_win, I2_win, ref, corr_mode, corr_opts, dtype)
         Dcorr, (rpeak, cpeak) = integer_peak_from_corr(c)
         if np.all(Dcorr == 0) or snurra>10 or np.linalg.norm(Dcorr) > M/2:
             D = D + Dcorr
@@ -163,8 +533,14 @@ def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, met
             break
 
     if e:
+        if quality:
+            return 0+0j, 0.0, 1, (np.nan, np.nan, np.nan)
         return 0+0j, 0.0, 1
 
+    if method == "gradient":
+        U, e = gradient_refine(I1_win, I2_orig, D, max_iter, tol, dtype)
+        return _window_result(U, c, rpeak, cpeak, e, quality)
+
     # subpixel refinement: take 3x3 around peak and compute quadratic correction
     # Initial mask around current peak in c
     small = c  # last computed correlation from integer loop
@@ -178,7 +554,7 @@ def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, met
     if method == "quadratic":
         dn = quadratic_refine(patch)
     elif method == "chebyshev":
-        dn, Cpeak = subpixel_chebyshev(patch)
+        dn, Cpeak = subpixel_chebyshev(patch, dtype)
     else:
         dn = subpixel_from_3x3(small, rpeak, cpeak)
 
@@ -196,13 +572,16 @@ def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, met
         # shift via multiplication in freq domain (efficient)
         Mbig = M
         # compute Fourier shift
-        Freq = fft2(I2_win)
+        fft = _fft(dtype)
+        Freq = fft.fft2(I2_win)
         ky = np.fft.fftfreq(Mbig)
         kx = np.fft.fftfreq(Mbig)
         KX, KY = np.meshgrid(kx, ky)
         phase = np.exp(-2j*np.pi*(F[0]*KY + F[1]*KX))
-        I2_shift = np.real(ifft2(Freq * phase))
-        c = fftcorr_subwindow(I1_win, I2_shift)
+        if dtype is not None:
+            phase = phase.astype(_complex_dtype(dtype))
+        I2_shift = np.real(fft.ifft2(Freq * phase))
+        c = correlation_map(I1_win, I2_shift, ref, corr_mode, corr_opts, dtype)
         Dcorr_sub, (rpeak, cpeak) = integer_peak_from_corr(c)
         dn = subpixel_from_3x3(c, rpeak, cpeak)
         F = F + dn
@@ -214,36 +593,346 @@ def process_window(Iref, Iobj, center_r, center_c, M, max_iter=10, tol=1e-3, met
     # final peak correlation value at center region
     peak_corr = c[rpeak, cpeak] if c is not None else 0.0
     u_complex = float(U[0]) + 1j*float(U[1])
+    if quality:
+        return u_complex, float(peak_corr), int(e), correlation_quality(c, rpeak, cpeak)
     return u_complex, float(peak_corr), int(e)
 
+def _window_result(U, c, rpeak, cpeak, e, quality):
+    # result tuple of correlate_windows for the refinements added next to the original loop
+    if e:
+        if quality:
+            return 0+0j, 0.0, 1, (np.nan, np.nan, np.nan)
+        return 0+0j, 0.0, 1
+    u_complex = float(U[0]) + 1j*float(U[1])
+    if quality:
+        return u_complex, float(c[rpeak, cpeak]), 0, correlation_quality(c, rpeak, cpeak)
+    return u_complex, float(c[rpeak, cpeak]), 0
+
+def _correlate_refined(I1_win, I2_win, ref, max_iter, tol, method, quality, dtype, corr_mode, corr_opts):
+    # correlate_windows for the new modes: the first map already has the right integer peak,
+    # so there is no integer roll loop and refine_shift (or gradient_refine) resolves the displacement
+    M = I1_win.shape[0]
+    c = correlation_map(I1_win, I2_win, ref, corr_mode, corr_opts, dtype)
+    D, (rpeak, cpeak) = integer_peak_from_corr(c)
+    if np.linalg.norm(D) > M/2:
+        return _window_result(D, c, rpeak, cpeak, 1, quality)
+    if method == 'gradient':
+        F, e = gradient_refine(I1_win, I2_win, D, max_iter, tol, dtype)
+    else:
+        F, c, rpeak, cpeak, e = refine_shift(I1_win, I2_win, c, ref, max_iter, tol, corr_mode, corr_opts, dtype)
+    return _window_result(F, c, rpeak, cpeak, e, quality)
+
+def process_window_series(I1_wins, I2_wins, max_iter=10, tol=1e-3, method='chebyshev', dtype=None,
+                          corr_mode='zmcc', corr_opts=None):
+    """
+    Batch of windows over a series of object frames, for parallel time series processing.
+    I1_wins: (nwin, M, M) reference windows, I2_wins: (nwin, nframes, M, M) object windows
+    The reference spectrum of each window is computed once per call and reused for all frames of
+    I2_wins (process_series recomputes it for every frame chunk, a small part of a task's work).
+    Returns u (nwin, nframes) complex, c (nwin, nframes), e (nwin, nframes)
+    """
+    nwin, nframes = I2_wins.shape[:2]
+    u = np.zeros((nwin, nframes), dtype=np.complex64)
+    c = np.zeros((nwin, nframes), dtype=np.float32)
+    e = np.zeros((nwin, nframes), dtype=np.int8)
+    for w in range(nwin):
+        I1_win = I1_wins[w].astype(_window_dtype(dtype))
+        ref = correlation_reference(I1_win, corr_mode, dtype)
+        for f in range(nframes):
+            try:
+                u[w, f], c[w, f], e[w, f] = correlate_windows(
+                    I1_win, I2_wins[w, f].astype(_window_dtype(dtype)), max_iter, tol, method, ref=ref, dtype=dtype,
+                    corr_mode=corr_mode, corr_opts=corr_opts)
+            except Exception:
+                e[w, f] = 1
+    return u, c, e
+
+def reference_spectra(I1_wins, dtype=None):
+    """reference_spectrum for a batch of windows (B, M, M) with one batched FFT, returns list of (f11, e1)"""
+    B, M = I1_wins.shape[:2]
+    big = 2 * M
+    P = M // 2
+    i1 = np.zeros((B, big, big), dtype=_window_dtype(dtype))
+    i1[:, P:P+M, P:P+M] = I1_wins - np.mean(I1_wins, axis=(1, 2), keepdims=True)
+    f11 = _fft(dtype).fft2(fftshift(i1, axes=(1, 2)), axes=(1, 2))
+    e1 = np.sum(i1 * i1, axis=(1, 2))
+    return [(f11[b], e1[b]) for b in range(B)]
+
+def process_window_batch(Iref, Iobj, centres, M, max_iter=10, tol=1e-3, method='chebyshev', offsets=None,
+                         quality=False, dtype=None, corr_mode='zmcc', corr_opts=None):
+    """
+    Several windows of the same size M in one task. The images are sent to the worker once per batch
+    and the reference spectra of all windows are computed in one batched FFT.
+    centres: list of (center_r, center_c), offsets: optional list of (dy, dx) per window
+    Returns list of process_window results
+    """
+    if not centres:
+        return []
+    half = M//2
+    if offsets is None:
+        offsets = [(0, 0)] * len(centres)
+    offsets = [(int(round(oy)), int(round(ox))) for oy, ox in offsets]
+    I1_wins = np.stack([extract_window(Iref, int(rr - half), int(cc - half), M) for rr, cc in centres]).astype(_window_dtype(dtype))
+    if corr_mode == 'zmcc':
+        refs = reference_spectra(I1_wins, dtype)
+    else:
+        refs = [correlation_reference(w, corr_mode, dtype) for w in I1_wins]
+    results = []
+    for (rr, cc), (oy, ox), I1_win, ref in zip(centres, offsets, I1_wins, refs):
+        I2_win = extract_window(Iobj, int(rr - half) + oy, int(cc - half) + ox, M).astype(_window_dtype(dtype))
+        try:
+            result = correlate_windows(I1_win, I2_win, max_iter, tol, method, ref=ref, quality=quality, dtype=dtype,
+                                       corr_mode=corr_mode, corr_opts=corr_opts)
+        except Exception:
+            result = (0+0j, 0.0, 1, (np.nan, np.nan, np.nan)) if quality else (0+0j, 0.0, 1)
+        results.append((result[0] + oy + 1j*ox,) + result[1:])
+    return results
+
+# ---- adaptive window size ----
+def local_contrast(img, rows, cols, M):
+    """
+    Speckle contrast std/mean and mean intensity of the M x M box around every grid centre,
+    from summed-area tables (cost independent of M). Returns (K, mean), both (nrows x ncols).
+    """
+    img = np.asarray(img, dtype=np.float64)
+    H, W = img.shape
+    S = np.zeros((H + 1, W + 1))
+    S2 = np.zeros((H + 1, W + 1))
+    S[1:, 1:] = img.cumsum(axis=0).cumsum(axis=1)
+    S2[1:, 1:] = (img * img).cumsum(axis=0).cumsum(axis=1)
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    r0 = np.clip(rows - M//2, 0, H)[:, None]; r1 = np.clip(rows - M//2 + M, 0, H)[:, None]
+    c0 = np.clip(cols - M//2, 0, W)[None, :]; c1 = np.clip(cols - M//2 + M, 0, W)[None, :]
+    def box(T):
+        return T[r1, c1] - T[r0, c1] - T[r1, c0] + T[r0, c0]
+    n = np.maximum((r1 - r0) * (c1 - c0), 1)
+    mean = box(S) / n
+    var = np.maximum(box(S2) / n - mean**2, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        K = np.where(mean > 0, np.sqrt(var) / mean, 0.0)
+    return K, mean
+
+def choose_window_sizes(K, sizes=(32, 64, 128), limits=(0.5, 0.25)):
+    """
+    Window size per grid point from local contrast K: K >= limits[0] gets sizes[0] (smallest),
+    limits[0] > K >= limits[1] gets sizes[1], and so on; the lowest contrast gets the largest size.
+    """
+    sizes = sorted(sizes)
+    if len(limits) != len(sizes) - 1:
+        raise ValueError("Need one contrast limit less than the number of window sizes")
+    # number of limits K is below, limits are in decreasing order
+    level = np.zeros(K.shape, dtype=int)
+    for lim in limits:
+        level += K < lim
+    return np.asarray(sizes)[level]
+
+# ---- global drift ----
+def estimate_global_shift(Iref, Iobj, downsample=1):
+    """
+    Rigid shift [dy, dx] of Iobj relative to Iref from one full-frame phase correlation.
+    downsample: block-average both images by this factor first (faster, result is scaled back).
+    Same sign convention as process_window (positive = object moved down/right).
+    """
+    a = np.asarray(Iref, dtype=np.float32)
+    b = np.asarray(Iobj, dtype=np.float32)
+    if downsample > 1:
+        a = bin_frames(a, downsample, downsample, mode='mean')
+        b = bin_frames(b, downsample, downsample, mode='mean')
+    H, W = a.shape
+    # Hann window against edge effects
+    win = np.outer(np.hanning(H), np.hanning(W)).astype(np.float32)
+    Fa = fft2((a - a.mean()) * win)
+    Fb = fft2((b - b.mean()) * win)
+    R = np.conjugate(Fa) * Fb
+    R /= np.maximum(np.abs(R), 1e-12)
+    r = np.real(ifft2(R))
+
+    pr, pc = np.unravel_index(np.argmax(r), r.shape)
+    # parabolic subpixel fit, indices wrap around (circular correlation)
+    def frac(cm, c0, cp):
+        denom = 2.0*(cm - 2.0*c0 + cp)
+        return 0.0 if denom == 0 else float(np.clip((cm - cp) / denom, -0.5, 0.5))
+    dy = frac(r[(pr-1) % H, pc], r[pr, pc], r[(pr+1) % H, pc])
+    dx = frac(r[pr, (pc-1) % W], r[pr, pc], r[pr, (pc+1) % W])
+    # peaks in the upper half of the array are negative shifts
+    sy = pr - H if pr > H//2 else pr
+    sx = pc - W if pc > W//2 else pc
+    return np.array([sy + dy, sx + dx]) * downsample
+
+# ---- ROI / mask helpers ----
+def mask_from_rois(shape, rois):
+    """
+    Build a boolean mask (H x W) from rectangular ROIs.
+    rois: list of (r0, c0, height, width) in pixels. Parts outside the frame are ignored.
+    """
+    H, W = shape
+    mask = np.zeros((H, W), dtype=bool)
+    for r0, c0, h, w in rois:
+        r0 = int(round(r0)); c0 = int(round(c0))
+        r1 = min(H, r0 + int(round(h))); c1 = min(W, c0 + int(round(w)))
+        mask[max(0, r0):max(0, r1), max(0, c0):max(0, c1)] = True
+    return mask
+
+def select_windows(rows, cols, mask=None):
+    """
+    Returns list of tasks (i, j, rr, cc) for the grid rows x cols.
+    If mask is given, only windows whose centre lies inside the mask are kept.
+    """
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    I, J = np.meshgrid(np.arange(len(rows)), np.arange(len(cols)), indexing='ij')
+    RR, CC = rows[I], cols[J]
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        inside = (RR >= 0) & (RR < mask.shape[0]) & (CC >= 0) & (CC < mask.shape[1])
+        keep = np.zeros_like(inside)
+        keep[inside] = mask[RR[inside], CC[inside]]
+        I, J, RR, CC = I[keep], J[keep], RR[keep], CC[keep]
+    return [(int(i), int(j), int(rr), int(cc)) for i, j, rr, cc in zip(I.ravel(), J.ravel(), RR.ravel(), CC.ravel())]
+
+class SparseField:
+    """
+    Results for a subset of the window grid (e.g. windows inside ROIs).
+    idx_r/idx_c: grid indices of computed windows, rows/cols: full grid centre positions.
+    """
+    def __init__(self, rows, cols, idx_r, idx_c, u, c, e, quality=None):
+        self.rows = list(rows)
+        self.cols = list(cols)
+        self.idx_r = np.asarray(idx_r, dtype=int)
+        self.idx_c = np.asarray(idx_c, dtype=int)
+        self.u = np.asarray(u, dtype=np.complex64)
+        self.c = np.asarray(c, dtype=np.float32)
+        self.e = np.asarray(e, dtype=np.int8)
+        self.quality = quality  # optional (n, 3) array of (ppr, snr, width) per computed window
+
+    def __len__(self):
+        return len(self.u)
+
+    def coordinates(self):
+        """Pixel centres (rr, cc) of the computed windows"""
+        return np.asarray(self.rows)[self.idx_r], np.asarray(self.cols)[self.idx_c]
+
+    def dense(self, fill=np.nan):
+        """
+        Expand to full grid images. Windows that were not computed get u = fill,
+        c = 0 and e = -1.
+        """
+        shape = (len(self.rows), len(self.cols))
+        u_image = np.full(shape, fill, dtype=np.complex64)
+        c_image = np.zeros(shape, dtype=np.float32)
+        e_image = np.full(shape, -1, dtype=np.int8)
+        u_image[self.idx_r, self.idx_c] = self.u
+        c_image[self.idx_r, self.idx_c] = self.c
+        e_image[self.idx_r, self.idx_c] = self.e
+        return u_image, c_image, e_image
+
+    def dense_quality(self):
+        """Quality metrics as full grid images {'ppr', 'snr', 'width'} (nan where not computed), or None"""
+        if self.quality is None:
+            return None
+        shape = (len(self.rows), len(self.cols))
+        images = {}
+        for k, name in enumerate(QUALITY_METRICS):
+            img = np.full(shape, np.nan, dtype=np.float32)
+            img[self.idx_r, self.idx_c] = self.quality[:, k]
+            images[name] = img
+        return images
+
 class SpeckleProcessor:
-    def __init__(self, M=64, rows=None, cols=None, n_workers=4):
+    def __init__(self, M=64, rows=None, cols=None, n_workers=4, mask=None, geometry=None,
+                 bayer=None, bayer_pattern='RGGB', validate=False, reprocess_scale=2,
+                 pre_register=False, register_downsample=1, quality_metrics=False,
+                 adaptive=False, window_sizes=(32, 64, 128), contrast_limits=(0.5, 0.25), windows_per_task=32,
+                 calibration=None, dtype=None, corr_mode='zmcc', min_overlap=0.25, phase_alpha=0.5,
+                 subpixel='chebyshev'):
         """
         M: subwindow size
         rows/cols: center positions (if None auto grid will be used)
         n_workers: parallel workers for windows
+        mask: optional boolean mask (H x W), only windows centred inside it are computed
+        geometry: optional dict(roi=(x0, y0, x1, y1), binx, biny) to reprocess full frames at a reduced
+                  sensor geometry (see CameraHandler.geometry). rows/cols/mask refer to the reduced frames.
+        bayer: None (raw mosaic), 'R', 'G', 'B' (one colour plane) or 'lum' (2x2 sum), applied after geometry.
+               Planes and 'lum' are half resolution, rows/cols/mask then refer to the half-resolution frames.
+               Needs binning 1, binned frames have no mosaic left.
+        bayer_pattern: Bayer layout of the frames passed in (see CameraHandler.bayer_pattern), the geometry
+                       ROI's offset is taken into account
+        validate: run the normalized median test after processing and re-process only failed and
+                  outlier windows, with window size reprocess_scale*M and the neighbour median as offset
+        pre_register: estimate a global rigid shift with a full-frame phase correlation (on images
+                      downsampled by register_downsample) and use it as start offset for every window.
+                      The estimate is stored in self.global_shift.
+        quality_metrics: also compute peak-to-second-peak ratio, peak-to-RMS SNR and peak width from the
+                         correlation maps, stored as images in self.quality_images after process()
+        adaptive: choose the window size per grid point from window_sizes using the local contrast of the
+                  reference (see choose_window_sizes). The grid still has step M; windows of the same
+                  size are processed together in batches of windows_per_task. Sizes used are stored in
+                  self.window_size_image.
+        calibration: optional processing.calibration.Calibration (dark/flat), applied to the raw frames
+                     before geometry and Bayer stages
+        dtype: precision policy for averages, contrast, windows and spectra, e.g. np.float32 to keep the
+               whole chain in single precision. None keeps the original mixed float64/float32 behaviour.
+        corr_mode: correlation map per window, 'zmcc' (original, normalised by the whole window energies),
+                   'zncc' (normalised per shift over the overlap, reliable peaks with smaller M) or
+                   'phase' (spectrum whitened by phase_alpha, sharp peak and few refinement steps)
+        min_overlap: 'zncc' only, shifts with less overlap than this fraction of M*M are ignored
+        phase_alpha: 'phase' only, 0 = plain cross-correlation ... 1 = pure phase correlation
+        subpixel: 'chebyshev' / 'quadratic' (zmcc fits, the other modes use their own estimator) or
+                  'gradient' (Lucas-Kanade on the M x M windows after the integer peak, any corr_mode)
         """
         self.M = M
         self.rows = rows
         self.cols = cols
         self.n_workers = n_workers
+        self.mask = mask
+        self.geometry = geometry
+        if bayer is not None and geometry is not None and (geometry.get('binx', 1) > 1 or geometry.get('biny', 1) > 1):
+            raise ValueError("Bayer modes need binning 1, binning averages the colour mosaic away")
+        self.bayer = bayer
+        self.bayer_pattern = bayer_pattern
+        self.validate = validate
+        self.reprocess_scale = reprocess_scale
+        self.reprocessed = None  # boolean grid image of re-processed windows after process()
+        self.pre_register = pre_register
+        self.register_downsample = register_downsample
+        self.global_shift = None  # [dy, dx] from the last process() if pre_register
+        self.quality_metrics = quality_metrics
+        self.quality_images = None  # {'ppr', 'snr', 'width'} grid images from the last process()
+        self.adaptive = adaptive
+        self.window_sizes = window_sizes
+        self.contrast_limits = contrast_limits
+        self.windows_per_task = windows_per_task
+        self.window_size_image = None
+        self.calibration = calibration
+        self.dtype = dtype
+        self.corr_mode = corr_mode
+        self.min_overlap = min_overlap
+        self.phase_alpha = phase_alpha
+        self.subpixel = subpixel
 
-    def process(self, Iref_stack, Iobj_stack, method='mean'):
-        """
-        Main entry point.
-        Iref_stack: list or array (Nref,H,W)
-        Iobj_stack: list or array (Nobj,H,W)
-        Returns: u_image (nrows x ncols) as complex, c_image (same), e_image (same), sc_image (temporal contrast)
-        """
-        # combine stacks
-        Iref = average_frames(Iref_stack, method=method)
-        Iobj = average_frames(Iobj_stack, method=method)
+    def prepare_stack(self, stack):
+        """Applies the calibration, software ROI/binning and Bayer stages to a stack (no-op if none is set)"""
+        if self.calibration is not None:
+            stack = self.calibration.apply_stack(stack)
+        pattern = self.bayer_pattern
+        if self.geometry is not None:
+            stack = apply_geometry(stack, **self.geometry)
+            if self.bayer is not None and self.geometry.get('roi') is not None:
+                pattern = crop_pattern(pattern, self.geometry['roi'])
+        return debayer(stack, self.bayer, pattern)
 
-        # temporal contrast for object stack as QC
-        sc_image = temporal_contrast(Iobj_stack)
+    def correlation_options(self):
+        """Keyword arguments for process_window / process_window_batch / process_window_series"""
+        corr_opts = None
+        if self.corr_mode == 'zncc':
+            corr_opts = {'min_overlap': self.min_overlap}
+        elif self.corr_mode == 'phase':
+            corr_opts = {'alpha': self.phase_alpha}
+        return {'method': self.subpixel, 'dtype': self.dtype, 'corr_mode': self.corr_mode, 'corr_opts': corr_opts}
 
-        H, W = Iref.shape
-        # determine grid
+    def grid(self, H, W):
+        """Window centre rows and cols for an image of size H x W"""
         if self.rows is None or self.cols is None:
             step = self.M
             rows = list(range(self.M//2, H - self.M//2, step))
@@ -251,36 +940,229 @@ class SpeckleProcessor:
         else:
             rows = self.rows
             cols = self.cols
+        return rows, cols
 
-        nrows = len(rows)
-        ncols = len(cols)
+    def _run_windows(self, Iref, Iobj, tasks, M=None, offsets=None):
+        """
+        Runs process_window for every task (i, j, rr, cc), returns u, c, e, q in task order.
+        M: window size (default self.M), offsets: optional list of (dy, dx) start offsets per task
+        q: (n, 3) quality metrics if self.quality_metrics, else None
+        """
+        if M is None:
+            M = self.M
+        u = np.zeros(len(tasks), dtype=np.complex64)
+        c = np.zeros(len(tasks), dtype=np.float32)
+        e = np.zeros(len(tasks), dtype=np.int8)
+        q = np.full((len(tasks), len(QUALITY_METRICS)), np.nan, dtype=np.float32) if self.quality_metrics else None
+        if not tasks:
+            return u, c, e, q
 
-        # prepare outputs
-        u_image = np.zeros((nrows, ncols), dtype=np.complex64)
-        c_image = np.zeros((nrows, ncols), dtype=np.float32)
-        e_image = np.zeros((nrows, ncols), dtype=np.int8)
+        # Use ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.n_workers) as ex:
+            futures = {ex.submit(process_window, Iref, Iobj, rr, cc, M,
+                                 offset=None if offsets is None else offsets[k],
+                                 quality=self.quality_metrics, **self.correlation_options()): k
+                    for k, (i, j, rr, cc) in enumerate(tasks)}
+            for future in as_completed(futures):
+                k = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    result = (0+0j, 0.0, 1)
+                u[k], c[k], e[k] = result[:3]
+                if q is not None and len(result) > 3:
+                    q[k] = result[3]
+        return u, c, e, q
 
-        # Build list of tasks (row, col)
-        # Build list of tasks (row, col)
-        tasks = []
-        for i, rr in enumerate(rows):
-            for j, cc in enumerate(cols):
-                tasks.append((i, j, rr, cc))
+    def _run_adaptive(self, Iref, Iobj, tasks, rows, cols, offsets=None):
+        """
+        Like _run_windows, but every window gets its size from the local contrast of Iref.
+        Windows are grouped by size and sent to the workers in batches.
+        """
+        K, _ = local_contrast(Iref, rows, cols, self.M)
+        sizes = choose_window_sizes(K, self.window_sizes, self.contrast_limits)
+        self.window_size_image = sizes
+        u = np.zeros(len(tasks), dtype=np.complex64)
+        c = np.zeros(len(tasks), dtype=np.float32)
+        e = np.zeros(len(tasks), dtype=np.int8)
+        q = np.full((len(tasks), len(QUALITY_METRICS)), np.nan, dtype=np.float32) if self.quality_metrics else None
+        task_sizes = np.array([sizes[i, j] for (i, j, _, _) in tasks], dtype=int)
 
-        # Use ProcessPoolExecutor
         with ProcessPoolExecutor(max_workers=self.n_workers) as ex:
-            futures = {ex.submit(process_window, Iref, Iobj, rr, cc, self.M): (i, j)
-                    for (i, j, rr, cc) in tasks}
+            futures = {}
+            for M in np.unique(task_sizes):
+                group = np.flatnonzero(task_sizes == M)
+                for b0 in range(0, len(group), self.windows_per_task):
+                    ks = group[b0:b0 + self.windows_per_task]
+                    centres = [(tasks[k][2], tasks[k][3]) for k in ks]
+                    offs = None if offsets is None else [offsets[k] for k in ks]
+                    fut = ex.submit(process_window_batch, Iref, Iobj, centres, int(M),
+                                    offsets=offs, quality=self.quality_metrics, **self.correlation_options())
+                    futures[fut] = ks
             for future in as_completed(futures):
-                i, j = futures[future]
+                ks = futures[future]
                 try:
-                    u_complex, peak_corr, err = future.result()
+                    results = future.result()
                 except Exception:
-                    u_complex, peak_corr, err = 0+0j, 0.0, 1
-                u_image[i, j] = u_complex
-                c_image[i, j] = peak_corr
-                e_image[i, j] = err
+                    results = [(0+0j, 0.0, 1)] * len(ks)
+                for k, result in zip(ks, results):
+                    u[k], c[k], e[k] = result[:3]
+                    if q is not None and len(result) > 3:
+                        q[k] = result[3]
+        return u, c, e, q
 
+    def process_sparse(self, Iref_stack, Iobj_stack, method='mean', mask=None, prepared=False):
+        """
+        Like process, but only computes windows whose centre is inside mask (default self.mask).
+        Returns: SparseField, sc_image
+        """
+        if mask is None:
+            mask = self.mask
+        if not prepared:
+            Iref_stack = self.prepare_stack(Iref_stack)
+            Iobj_stack = self.prepare_stack(Iobj_stack)
+        Iref = average_frames(Iref_stack, method=method, dtype=self.dtype)
+        Iobj = average_frames(Iobj_stack, method=method, dtype=self.dtype)
+        sc_image = temporal_contrast(Iobj_stack, dtype=self.dtype)
 
-        return u_image, c_image, e_image, sc_image, rows, cols
+        rows, cols = self.grid(*Iref.shape)
+        tasks = select_windows(rows, cols, mask)
+        offsets = None
+        if self.pre_register:
+            self.global_shift = estimate_global_shift(Iref, Iobj, self.register_downsample)
+            offsets = [tuple(self.global_shift)] * len(tasks)
+        if self.adaptive:
+            u, c, e, q = self._run_adaptive(Iref, Iobj, tasks, rows, cols, offsets=offsets)
+        else:
+            u, c, e, q = self._run_windows(Iref, Iobj, tasks, offsets=offsets)
+        idx_r = [t[0] for t in tasks]
+        idx_c = [t[1] for t in tasks]
+        field = SparseField(rows, cols, idx_r, idx_c, u, c, e, quality=q)
+        if self.validate:
+            self.reprocess_outliers(Iref, Iobj, field)
+        self.quality_images = field.dense_quality()
+        return field, sc_image
 
+    def reprocess_outliers(self, Iref, Iobj, field):
+        """
+        Flags failed windows and normalized median test outliers, then re-runs only those
+        with a larger window and the median of the valid neighbours as start offset.
+        Updates field in place where the new result succeeds. Returns number of re-processed windows.
+        """
+        u_image, c_image, e_image = field.dense()
+        outlier = normalized_median_test(u_image, e_image)
+        flagged = outlier | (e_image == 1)
+        self.reprocessed = flagged
+        k_flagged = np.flatnonzero(flagged[field.idx_r, field.idx_c])
+        if len(k_flagged) == 0:
+            return 0
+
+        valid = (e_image == 0) & ~outlier
+        pred = neighbour_prediction(u_image, valid)
+        # fallback when no neighbour is valid: median of all valid windows, else the window's own estimate
+        global_pred = np.median(u_image[valid].real) + 1j*np.median(u_image[valid].imag) if np.any(valid) else None
+        tasks = []
+        offsets = []
+        for k in k_flagged:
+            i, j = field.idx_r[k], field.idx_c[k]
+            tasks.append((i, j, field.rows[i], field.cols[j]))
+            p = pred[i, j]
+            if not np.isfinite(p):
+                p = global_pred if global_pred is not None else field.u[k]
+            offsets.append((p.real, p.imag) if np.isfinite(p) else (0, 0))
+        M = int(self.M * self.reprocess_scale)
+        u, c, e, q = self._run_windows(Iref, Iobj, tasks, M=M, offsets=offsets)
+        for n, (k, uk, ck, ek) in enumerate(zip(k_flagged, u, c, e)):
+            if ek == 0:
+                field.u[k] = uk
+                field.c[k] = ck
+                field.e[k] = 0
+                if q is not None and field.quality is not None:
+                    field.quality[k] = q[n]
+            else:
+                field.e[k] = 1  # outliers that could not be recovered are marked as failed
+        return len(k_flagged)
+
+    def process_series(self, Iref_stack, Iobj_stack, k=1, method='mean', mask=None,
+                       chunk_frames=64, windows_per_task=16):
+        """
+        Displacement field for every object frame (or every average of k frames) relative to the reference.
+        Iref_stack: list or array (Nref,H,W)
+        Iobj_stack: array or np.memmap (N,H,W), read chunk_frames frames at a time
+        k: number of consecutive object frames averaged per time step (trailing frames are dropped)
+        Work is split in tasks of windows_per_task windows x one frame chunk, so it is parallel over
+        both frames and windows, and only window data is sent to the workers. At most 2 * n_workers
+        tasks are pending, so memory stays bounded for memmapped stacks.
+        Returns: u_series (N//k, nrows, ncols) complex, c_series, e_series (same shape), rows, cols
+        Windows outside the mask get u = nan and e = -1, like process. pre_register/validate are not applied.
+        """
+        if mask is None:
+            mask = self.mask
+        Iref = average_frames(self.prepare_stack(Iref_stack), method=method, dtype=self.dtype)
+        rows, cols = self.grid(*Iref.shape)
+        tasks = select_windows(rows, cols, mask)
+        M = self.M
+        # reference windows are extracted once
+        I1_wins = np.stack([extract_window(Iref, rr - M//2, cc - M//2, M) for (_, _, rr, cc) in tasks]) \
+            if tasks else np.zeros((0, M, M))
+
+        nsteps = len(Iobj_stack) // k
+        chunk = max(1, chunk_frames // k) * k  # whole k-groups per chunk
+        u_series = np.full((nsteps, len(rows), len(cols)), np.nan, dtype=np.complex64)
+        c_series = np.zeros((nsteps, len(rows), len(cols)), dtype=np.float32)
+        e_series = np.full((nsteps, len(rows), len(cols)), -1, dtype=np.int8)
+        idx_r = np.array([t[0] for t in tasks], dtype=int)
+        idx_c = np.array([t[1] for t in tasks], dtype=int)
+
+        def store(future, s0, w0, nw, nf):
+            ir = idx_r[w0:w0 + nw]
+            ic = idx_c[w0:w0 + nw]
+            try:
+                u, c, e = future.result()
+            except Exception:
+                u = np.zeros((nw, nf), dtype=np.complex64)
+                c = np.zeros((nw, nf), dtype=np.float32)
+                e = np.ones((nw, nf), dtype=np.int8)
+            u_series[s0:s0 + nf, ir, ic] = u.T
+            c_series[s0:s0 + nf, ir, ic] = c.T
+            e_series[s0:s0 + nf, ir, ic] = e.T
+
+        # at most max_in_flight tasks are pending, so only their window copies are held in memory
+        # and the next chunk is read once earlier results have been stored
+        max_in_flight = 2 * self.n_workers
+        with ProcessPoolExecutor(max_workers=self.n_workers) as ex:
+            futures = {}
+            for f0 in range(0, nsteps * k, chunk):
+                f1 = min(f0 + chunk, nsteps * k)
+                frames = np.asarray(self.prepare_stack(Iobj_stack[f0:f1]))
+                if k > 1:
+                    frames = frames.reshape((-1, k) + frames.shape[1:]).mean(axis=1, dtype=self.dtype)
+                s0 = f0 // k
+                for w0 in range(0, len(tasks), windows_per_task):
+                    while len(futures) >= max_in_flight:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            store(future, *futures.pop(future))
+                    batch = tasks[w0:w0 + windows_per_task]
+                    I2_wins = np.stack([extract_window(frames, rr - M//2, cc - M//2, M) for (_, _, rr, cc) in batch])
+                    fut = ex.submit(process_window_series, I1_wins[w0:w0 + len(batch)], I2_wins,
+                                    **self.correlation_options())
+                    futures[fut] = (s0, w0, len(batch), len(frames))
+                del frames
+            for future in as_completed(futures):
+                store(future, *futures[future])
+
+        return u_series, c_series, e_series, rows, cols
+
+    def process(self, Iref_stack, Iobj_stack, method='mean', mask=None, prepared=False):
+        """
+        Main entry point.
+        Iref_stack: list or array (Nref,H,W)
+        Iobj_stack: list or array (Nobj,H,W)
+        mask: optional boolean mask (H,W), overrides self.mask. Windows outside it get e = -1 and u = nan
+        prepared: the stacks already went through prepare_stack (e.g. to reuse them for g2_stack)
+        Returns: u_image (nrows x ncols) as complex, c_image (same), e_image (same), sc_image (temporal contrast)
+        """
+        field, sc_image = self.process_sparse(Iref_stack, Iobj_stack, method=method, mask=mask, prepared=prepared)
+        u_image, c_image, e_image = field.dense()
+        return u_image, c_image, e_image, sc_image, field.rows, field.cols
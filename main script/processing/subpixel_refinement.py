@@ -15,6 +15,28 @@ def quadratic_refine(m):
     return np.array([dy, dx])
 
 
+# ---------- Gaussian fit (narrow peaks) ----------
+def subpixel_gaussian(m, dtype=None):
+    """
+    Three point Gaussian fit around max of 3x3 patch, in y and x separately. Suited to the narrow,
+    nearly Gaussian peaks of phase correlation, where a parabola underestimates the offset.
+    Falls back to the parabola where a value is not positive.
+    dtype: precision of the fit, None fits in float64
+    Returns dn = [dy, dx] subpixel offset.
+    """
+    m = np.asarray(m, dtype=np.float64 if dtype is None else dtype)
+    def offset(cm, c0, cp):
+        if min(cm, c0, cp) > 0:
+            cm, c0, cp = np.log(cm), np.log(c0), np.log(cp)
+        denom = cm - 2*c0 + cp
+        if denom >= 0:
+            return 0.0
+        return np.clip(0.5 * (cm - cp) / denom, -1.0, 1.0)
+    dy = offset(m[0, 1], m[1, 1], m[2, 1])
+    dx = offset(m[1, 0], m[1, 1], m[1, 2])
+    return np.array([dy, dx], dtype=m.dtype)
+
+
 # ---------- Chebyshev polynomial approximation ----------
 # Mostly translated from MATLAB code by Mikael Sjödahl
 def chebyshev_eval(xy, a):
@@ -36,10 +58,11 @@ def chebyshev_eval(xy, a):
     return C, dC, d2C
 
 
-def subpixel_chebyshev(m):
+def subpixel_chebyshev(m, dtype=None):
     """
     Subpixel peak refinement using Chebyshev expansion.
     m : 3x3 patch around peak
+    dtype: precision of the fit, None solves in float64 (original behaviour, also for float32 patches)
     Returns (dn, Cpeak)
     """
     b = m.flatten()
@@ -53,10 +76,10 @@ def subpixel_chebyshev(m):
                 2*xx**2-1, (2*xx**2-1)*yy, (2*xx**2-1)*(2*yy**2-1)
             ]
             Tmat.append(row)
-    Tmat = np.array(Tmat)
+    Tmat = np.array(Tmat, dtype=np.float64 if dtype is None else dtype)
     a = np.linalg.solve(Tmat, b)
 
-    xy = np.array([0.0, 0.0])
+    xy = np.zeros(2, dtype=a.dtype)
     for _ in range(5):
         C, dC, d2C = chebyshev_eval(xy, a)
         try:
@@ -69,3 +92,76 @@ def subpixel_chebyshev(m):
 
     C, _, _ = chebyshev_eval(xy, a)
     return xy, C
+
+
+# ---------- Gradient based (Lucas-Kanade) ----------
+def _cubic_weights(f):
+    # Keys cubic convolution (a = -0.5) weights of the samples at -1, 0, 1, 2 for fractional position f
+    return (((-0.5*f + 1.0)*f - 0.5)*f, (1.5*f - 2.5)*f*f + 1.0, ((-1.5*f + 2.0)*f + 0.5)*f, (0.5*f - 0.5)*f*f)
+
+def shifted_samples(img, u, r0, r1, c0, c1, dtype=None):
+    """
+    img sampled at (r + u[0], c + u[1]) for rows r0:r1 and cols c0:c1, with separable cubic
+    interpolation. The same fraction applies to every pixel, so this is a sum of 8 shifted slices.
+    The caller keeps the samples inside img (2 pixels margin after the integer part of u).
+    dtype: precision of the samples, None samples in float64
+    """
+    dtype = np.float64 if dtype is None else dtype
+    img = np.asarray(img, dtype=dtype)
+    iy, ix = int(np.floor(u[0])), int(np.floor(u[1]))
+    wy = [dtype(w) for w in _cubic_weights(u[0] - iy)]
+    wx = [dtype(w) for w in _cubic_weights(u[1] - ix)]
+    rows = sum(w * img[r0+iy+k:r1+iy+k, c0+ix-1:c1+ix+3] for k, w in zip(range(-1, 3), wy))
+    return sum(w * rows[:, k:k + c1 - c0] for k, w in enumerate(wx))
+
+def gradient_refine(I1_win, I2_win, u0, max_iter=10, tol=1e-3, dtype=None):
+    """
+    Displacement u = [dy, dx] of I2_win relative to I1_win (I2(p + u) = I1(p)) by inverse compositional
+    Lucas-Kanade, starting from u0 (e.g. the integer correlation peak). Gradients of I1_win and the
+    2x2 Hessian are computed once, each step only resamples I2_win (shifted_samples) on the pixels
+    that stay inside both windows, so no FFTs are needed. Both windows are normalised to zero mean
+    and unit variance over those pixels, which removes gain and offset changes.
+    dtype: precision of windows, gradients and Hessian, None computes in float64
+    Returns (u, e), e = 1 if not converged in max_iter steps, if the Hessian is singular or if u
+    leaves u0 by more than 1 pixel (the integer peak was wrong).
+    """
+    dtype = np.float64 if dtype is None else dtype
+    M = I1_win.shape[0]
+    u0 = np.asarray(u0, dtype=float)
+    iy0, ix0 = int(np.floor(u0[0])), int(np.floor(u0[1]))
+    # pixels that can be sampled for any u within 1 pixel of u0 (cubic needs 1 before, 2 after)
+    r0, r1 = max(1, 2 - iy0), min(M - 1, M - 3 - iy0)
+    c0, c1 = max(1, 2 - ix0), min(M - 1, M - 3 - ix0)
+    if r1 - r0 < 3 or c1 - c0 < 3:
+        return u0, 1
+
+    a = np.asarray(I1_win, dtype=dtype)
+    gy, gx = np.gradient(a)
+    a = a[r0:r1, c0:c1]
+    sa = a.std()
+    if sa == 0:
+        return u0, 1
+    a = (a - a.mean()) / sa
+    gy = gy[r0:r1, c0:c1] / sa
+    gx = gx[r0:r1, c0:c1] / sa
+    H = np.array([[np.sum(gy*gy), np.sum(gy*gx)],
+                  [np.sum(gy*gx), np.sum(gx*gx)]], dtype=dtype)
+    if np.linalg.det(H) <= 1e-12 * np.trace(H)**2:
+        return u0, 1
+    Hinv = np.linalg.inv(H)
+
+    b = np.asarray(I2_win, dtype=dtype)
+    u = u0.copy()
+    for _ in range(max_iter):
+        s = shifted_samples(b, u, r0, r1, c0, c1, dtype)
+        ss = s.std()
+        if ss == 0:
+            return u, 1
+        res = (s - s.mean()) / ss - a
+        du = Hinv @ np.array([np.sum(gy*res), np.sum(gx*res)])
+        u -= du
+        if np.any(np.abs(u - u0) > 1):
+            return u, 1
+        if np.hypot(du[0], du[1]) <= tol:
+            return u, 0
+    return u, 1
@@ -0,0 +1,50 @@
+# Synthetic speckle with known displacements, used by the benchmarks and the equivalence checks.
+
+import numpy as np
+
+def make_speckle(H, W, grain=4, rng=None):
+    """Fully developed speckle intensity with mean grain size of about grain pixels"""
+    rng = np.random.default_rng() if rng is None else rng
+    field = rng.standard_normal((H, W)) + 1j*rng.standard_normal((H, W))
+    ky = np.fft.fftfreq(H)[:, None]
+    kx = np.fft.fftfreq(W)[None, :]
+    aperture = (ky**2 + kx**2) < (1 / (2*grain))**2
+    return np.abs(np.fft.ifft2(field * aperture))**2
+
+def fourier_shift(img, dy, dx):
+    """Moves img by (dy, dx) pixels (rows, cols), periodic"""
+    ky = np.fft.fftfreq(img.shape[0])[:, None]
+    kx = np.fft.fftfreq(img.shape[1])[None, :]
+    return np.real(np.fft.ifft2(np.fft.fft2(img) * np.exp(-2j*np.pi*(ky*dy + kx*dx))))
+
+def to_counts(img, rng, bits=12, noise=0.01, peak=None):
+    """
+    Scales to camera counts with a little read noise, uint16 like CameraHandler frames.
+    peak: intensity mapped to 80 % of full scale (default img.max())
+    """
+    peak = img.max() if peak is None else peak
+    img = img / peak * (2**bits - 1) * 0.8
+    img = img + rng.normal(0, noise * img.mean(), img.shape)
+    return np.clip(img, 0, 2**bits - 1).astype(np.uint16)
+
+def speckle_pair(H, W, shift, n_frames=4, grain=4, noise=0.01, rng=None, period=None):
+    """
+    Reference and object stacks (n_frames, H, W) uint16, the object moved by shift = (dy, dx).
+    Every frame gets its own read noise, so the stacks also have a temporal contrast.
+    period: the speckle repeats every period pixels, a period x period window starting at a multiple
+            of period then sees an integer shift as a circular roll of its content
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    if period is None:
+        base = make_speckle(H, W, grain, rng)
+        moved = fourier_shift(base, *shift)
+    else:
+        # whole tiles, so the periodic shift keeps the tiling, then cropped to H x W
+        base = np.tile(make_speckle(period, period, grain, rng), (-(-H // period), -(-W // period)))
+        moved = fourier_shift(base, *shift)[:H, :W]
+        base = base[:H, :W]
+    # common peak so both stacks have the same counts for the same intensity
+    peak = base.max()
+    ref = np.stack([to_counts(base, rng, noise=noise, peak=peak) for _ in range(n_frames)])
+    obj = np.stack([to_counts(moved, rng, noise=noise, peak=peak) for _ in range(n_frames)])
+    return ref, obj
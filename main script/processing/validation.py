@@ -0,0 +1,58 @@
+# Vectorized validation of displacement fields.
+# Outliers are detected with the normalized median test (Westerweel & Scarano, 2005)
+# over the 3x3 neighbourhood of every window, so only suspicious windows need to be re-processed.
+
+import numpy as np
+import warnings
+from numpy.lib.stride_tricks import sliding_window_view
+
+def _neighbours(img):
+    """(nrows, ncols, 8) array of the 3x3 neighbours of every element (nan outside the grid)"""
+    padded = np.pad(img, 1, mode='constant', constant_values=np.nan)
+    win = sliding_window_view(padded, (3, 3)).reshape(img.shape + (9,))
+    return np.delete(win, 4, axis=-1)  # drop the centre element
+
+def valid_vectors(u_image, e_image=None):
+    """Float (U, V) images with nan where the window failed (e != 0) or was not computed"""
+    U = np.real(u_image).astype(np.float64)
+    V = np.imag(u_image).astype(np.float64)
+    if e_image is not None:
+        bad = np.asarray(e_image) != 0
+        U[bad] = np.nan
+        V[bad] = np.nan
+    return U, V
+
+def normalized_median_test(u_image, e_image=None, threshold=2.0, eps=0.1, min_neighbours=3):
+    """
+    Normalized median test on the whole field at once.
+    u_image: complex (nrows x ncols), e_image: optional error flags (failed windows are not used as neighbours)
+    threshold: normalized residual above which a vector is an outlier (2 is the usual choice)
+    eps: expected measurement noise in pixels, avoids flagging in perfectly uniform regions
+    Returns boolean image, True for outliers. Windows with fewer than min_neighbours valid
+    neighbours are not flagged.
+    """
+    U, V = valid_vectors(u_image, e_image)
+    residual = np.zeros(U.shape)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-nan neighbourhoods
+        for comp in (U, V):
+            nb = _neighbours(comp)
+            med = np.nanmedian(nb, axis=-1)
+            res = np.nanmedian(np.abs(nb - med[..., None]), axis=-1)
+            residual += ((comp - med) / (res + eps)) ** 2
+        count = np.sum(np.isfinite(_neighbours(U)), axis=-1)
+    residual = np.sqrt(residual)
+    return (residual > threshold) & (count >= min_neighbours) & np.isfinite(U)
+
+def neighbour_prediction(u_image, valid):
+    """
+    Median of the valid 3x3 neighbours of every window, as complex image (nan if no valid neighbour).
+    Used as starting offset when re-processing outliers.
+    """
+    U = np.where(valid, np.real(u_image), np.nan)
+    V = np.where(valid, np.imag(u_image), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        pu = np.nanmedian(_neighbours(U), axis=-1)
+        pv = np.nanmedian(_neighbours(V), axis=-1)
+    return pu + 1j*pv
@@ -0,0 +1,66 @@
+import time
+import numpy as np
+
+from processing.pipeline import FramePipeline
+from processing.speckle import SpeckleProcessor
+
+# A stage that fails while the queue after it is full must still end every later stage
+# (the end marker cannot be queued then). Run with python test_pipeline.py or pytest.
+
+def make_source(fail_at):
+    rng = np.random.default_rng(0)
+    def source():
+        source.count += 1
+        if source.count == fail_at:
+            raise RuntimeError("source failed")
+        return rng.random((64, 64), dtype=np.float32)
+    source.count = 0
+    return source
+
+def slow(frame):
+    time.sleep(0.2)
+    return frame
+
+def finish(pipeline, timeout=20.0):
+    """Runs the pipeline and returns (seconds until every stage ended, error raised by wait)"""
+    t0 = time.perf_counter()
+    pipeline.start()
+    for t in pipeline._threads:
+        t.join(max(0.0, timeout - (time.perf_counter() - t0)))
+    assert not pipeline.is_running(), "a stage is still blocked"
+    try:
+        pipeline.wait()
+    except RuntimeError as e:
+        return time.perf_counter() - t0, e
+    return time.perf_counter() - t0, None
+
+def test_source_error_with_full_preprocess_queue():
+    Iref = np.random.default_rng(1).random((64, 64), dtype=np.float32)
+    pipeline = FramePipeline(make_source(fail_at=8), 100, Iref, preprocess=[slow],
+                             processor=SpeckleProcessor(M=32, n_workers=1), queue_size=2)
+    # slow preprocessing keeps q_pre full when the source fails
+    t, error = finish(pipeline)
+    assert str(error) == "source failed"
+    print(f"source error: all stages ended after {t:.1f} s")
+
+def test_preprocess_error_with_full_correlate_queue():
+    Iref = np.random.default_rng(1).random((64, 64), dtype=np.float32)
+    def fail_late(frame):
+        fail_late.count += 1
+        if fail_late.count == 6:  # the reference is the first call
+            raise RuntimeError("preprocess failed")
+        return frame
+    fail_late.count = 0
+    pipeline = FramePipeline(make_source(fail_at=None), 100, Iref, preprocess=[fail_late],
+                             processor=SpeckleProcessor(M=32, n_workers=1), queue_size=1)
+    # slow correlation keeps q_corr full when preprocessing fails
+    correlate = pipeline._correlate_frame
+    pipeline._correlate_frame = lambda ex, frame: correlate(ex, slow(frame))
+    t, error = finish(pipeline)
+    assert str(error) == "preprocess failed"
+    print(f"preprocess error: all stages ended after {t:.1f} s")
+
+
+if __name__ == '__main__':
+    test_source_error_with_full_preprocess_queue()
+    test_preprocess_error_with_full_correlate_queue()
@@ -0,0 +1,49 @@
+# Checks the processing chain against the frozen reference implementation (processing.reference)
+# on synthetic speckle with known shifts, for every engine / precision / executor combination,
+# and reports the fastest backend within tolerance (see processing.equivalence).
+# Exit code 1 if the default backend (zmcc chebyshev, mixed precision) or a component check fails.
+#
+# Run from "main script":  python verify_processing.py [--size 256] [--M 32] [--engines zncc phase]
+
+import argparse
+import sys
+
+from processing.equivalence import (ENGINES, PRECISIONS, EXECUTORS, make_cases, check_components,
+                                    check_backends, fastest_passing)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Compare the processing backends with the reference implementation')
+    ap.add_argument('--size', type=int, default=256, help='synthetic image size (square)')
+    ap.add_argument('--M', type=int, default=32, help='window size')
+    ap.add_argument('--frames', type=int, default=4, help='frames per stack')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--engines', nargs='+', choices=[n for n, _ in ENGINES], default=None)
+    ap.add_argument('--precisions', nargs='+', choices=list(PRECISIONS), default=None)
+    ap.add_argument('--executors', nargs='+', choices=list(EXECUTORS), default=None)
+    ap.add_argument('--skip-components', action='store_true')
+    args = ap.parse_args()
+
+    cases = make_cases(args.size, n_frames=args.frames, seed=args.seed, M=args.M)
+    print(f"{len(cases)} cases of {args.size}x{args.size}, shifts {[s for s, _, _ in cases]}, M = {args.M}")
+    ok = True
+    if not args.skip_components:
+        components = check_components(cases, args.M, args.precisions, seed=args.seed)
+        ok = all(r['passed'] for r in components)
+
+    results = check_backends(cases, args.M, args.engines, args.precisions, args.executors, args.workers)
+    default = [r for r in results if r['engine'] == 'zmcc chebyshev' and r['precision'] == 'mixed']
+    ok = ok and all(r['passed'] for r in default)
+    failed = [r for r in results if not r['passed']]
+    print(f"{len(results) - len(failed)} of {len(results)} backends within tolerance")
+    best = fastest_passing(results)
+    if best is None:
+        print("no backend passed")
+    else:
+        print(f"fastest passing: {best['engine']}, {best['precision']}, {best['executor']} ({best['seconds']:.2f} s)")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())